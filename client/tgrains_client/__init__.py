@@ -0,0 +1,3 @@
+from .cache import ResultCache, canonical_inputs, input_hash
+from .client import CropModelClient, ModelError, run_scenarios
+from .frames import results_arrays, results_frame
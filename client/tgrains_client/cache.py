@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tgrains')
+
+
+##
+# Reduce model inputs to a flat {name: float} dict of crop and livestock areas, as the server does
+# (server/tasks/results.py): accepts both flat /model bodies and the nested 'inputs' of a session state
+def canonical_inputs(data):
+    if 'crops' in data or 'livestock' in data:
+        data = {name: item['value']
+                for group in ('crops', 'livestock')
+                for name, item in data.get(group, {}).items()}
+
+    inputs = {}
+    for name, value in data.items():
+        if name == 'landscape_id':
+            continue
+        try:
+            inputs[name] = float(value)
+        except (TypeError, ValueError):
+            continue
+    return inputs
+
+
+##
+# Stable hash identifying a scenario: the landscape plus its canonical inputs. The same as the server's, so
+# local and server cache entries agree
+def input_hash(landscape_id, inputs):
+    key = json.dumps([int(landscape_id), sorted(canonical_inputs(inputs).items())], separators=(',', ':'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+##
+# Model results on disk, by input hash, in an SQLite file: safe to share between notebooks and processes.
+# Results only change when the model does, so entries are kept until clear() (e.g. after a model update)
+class ResultCache:
+
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+            path = os.path.join(DEFAULT_CACHE_DIR, 'results.sqlite')
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                '(hash TEXT PRIMARY KEY, landscape_id INTEGER NOT NULL, result TEXT NOT NULL)')
+
+    def get_many(self, hashes):
+        hashes = list(hashes)
+        found = {}
+        with self.lock:
+            # Within SQLite's limit on bound parameters
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                rows = self.connection.execute(
+                    'SELECT hash, result FROM results WHERE hash IN ({})'.format(','.join('?' * len(chunk))), chunk)
+                found.update((h, json.loads(r)) for h, r in rows)
+        return found
+
+    def put_many(self, landscape_id, results):
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO results (hash, landscape_id, result) VALUES (?, ?, ?)',
+                                        [(h, int(landscape_id), json.dumps(r)) for h, r in results.items()])
+
+    def clear(self, landscape_id=None):
+        with self.lock:
+            if landscape_id is None:
+                self.connection.execute('DELETE FROM results')
+            else:
+                self.connection.execute('DELETE FROM results WHERE landscape_id = ?', (int(landscape_id),))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .cache import ResultCache, input_hash
+from .frames import results_frame
+
+log = logging.getLogger(__name__)
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_MSGPACK = 'application/msgpack'
+
+# Task states after which a task's status no longer changes
+READY_STATES = {'SUCCESS', 'FAILURE', 'REVOKED'}
+
+
+class ModelError(Exception):
+    pass
+
+
+# The server has no such endpoint (an older deployment): fall back to the one-at-a-time API
+class _Unsupported(Exception):
+    pass
+
+
+##
+# Asynchronous client for the crop model API, on one pooled HTTP session.
+#
+# run() evaluates many scenarios at once. Identical scenarios are only evaluated once, and results already in the
+# local cache (cache.py) aren't requested at all. The rest go to POST /model/batch, in batches of batch_size, and
+# their tasks are polled together with POST /status. Against servers without those endpoints, scenarios are POSTed
+# to /model one at a time and each task is polled with GET /status/<id>. At most `concurrency` requests are in
+# flight at once either way.
+#
+#   async with CropModelClient('https://model.tgrains.net/api') as client:
+#       frame = await client.run_frame(101, scenarios)
+class CropModelClient:
+
+    def __init__(self, base_url, concurrency=16, batch_size=200, poll_interval=0.5, timeout=900, cache=True,
+                 cache_path=None):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.cache = ResultCache(cache_path) if cache else None
+        self.session = None
+        self.semaphore = None
+
+        # None until the first request tells us whether the server has them
+        self.batch_supported = None
+        self.status_batch_supported = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers={'Accept': MIMETYPE_MSGPACK if msgpack else MIMETYPE_JSON})
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, method, path, **kwargs):
+        async with self.semaphore:
+            async with self.session.request(method, self.base_url + path, allow_redirects=False,
+                                            **kwargs) as response:
+                body = await response.read()
+                if response.content_type == MIMETYPE_MSGPACK:
+                    return response.status, msgpack.unpackb(body, raw=False)
+                if response.content_type == MIMETYPE_JSON:
+                    return response.status, json.loads(body)
+                return response.status, body.decode('utf-8', errors='replace')
+
+    ##
+    # The landscape's BAU (business as usual) result
+    async def bau(self, landscape_id):
+        status, body = await self._request('GET', '/model', params={'landscape_id': landscape_id})
+        if status != 200:
+            raise ModelError("GET /model returned {}: {}".format(status, body))
+        return body
+
+    ##
+    # The landscape's crop and livestock names
+    async def strings(self, landscape_id):
+        status, body = await self._request('GET', '/strings', params={'landscape_id': landscape_id})
+        if status != 303:
+            raise ModelError("GET /strings returned {}: {}".format(status, body))
+        response = (await self._wait([body['task_id']]))[body['task_id']]
+        return response.get('result')
+
+    ##
+    # Results of scenarios ({name: area} dicts) on a landscape, in the order of `scenarios`. A scenario which
+    # failed, or didn't finish within the timeout, has the result None
+    async def run(self, landscape_id, scenarios):
+        await self.open()
+        hashes = [input_hash(landscape_id, s) for s in scenarios]
+        unique = {}
+        for h, scenario in zip(hashes, scenarios):
+            unique.setdefault(h, scenario)
+
+        results = self.cache.get_many(unique) if self.cache is not None else {}
+        todo = [(h, unique[h]) for h in unique if h not in results]
+        log.info("{} scenarios, {} unique, {} cached locally".format(len(scenarios), len(unique), len(results)))
+
+        if todo:
+            fetched = await self._run_remote(landscape_id, todo)
+            results.update(fetched)
+            if self.cache is not None:
+                self.cache.put_many(landscape_id, {h: r for h, r in fetched.items() if r is not None})
+
+        return [results.get(h) for h in hashes]
+
+    ##
+    # As run(), as a pandas DataFrame of inputs and outputs (see frames.results_frame)
+    async def run_frame(self, landscape_id, scenarios):
+        return results_frame(scenarios, await self.run(landscape_id, scenarios))
+
+    async def _run_remote(self, landscape_id, jobs):
+        if self.batch_supported is not False:
+            try:
+                return await self._run_batches(landscape_id, jobs)
+            except _Unsupported:
+                log.info("Server has no POST /model/batch: submitting scenarios one at a time")
+                self.batch_supported = False
+        return await self._run_single(landscape_id, jobs)
+
+    async def _run_batches(self, landscape_id, jobs):
+        results = {}
+        pending = {}
+
+        async def submit(chunk):
+            status, body = await self._request('POST', '/model/batch',
+                                               json={'landscape_id': landscape_id, 'scenarios': [s for _, s in chunk]})
+            if status in (404, 405):
+                raise _Unsupported()
+            if status != 202:
+                raise ModelError("POST /model/batch returned {}: {}".format(status, body))
+            self.batch_supported = True
+
+            for i, result in body['cached']:
+                results[chunk[i][0]] = result
+            for task in body['tasks']:
+                pending[task['task_id']] = [chunk[i][0] for i in task['indices']]
+
+        chunks = [jobs[start:start + self.batch_size] for start in range(0, len(jobs), self.batch_size)]
+        # The first batch finds out whether the server has the endpoint, before the rest are sent
+        if self.batch_supported is None:
+            await submit(chunks.pop(0))
+        await asyncio.gather(*[submit(chunk) for chunk in chunks])
+
+        responses = await self._wait(list(pending))
+        for task_id, chunk_hashes in pending.items():
+            response = responses.get(task_id, {})
+            values = response.get('result') if response.get('state') == 'SUCCESS' else None
+            for i, h in enumerate(chunk_hashes):
+                results[h] = values[i] if values else None
+        return results
+
+    async def _run_single(self, landscape_id, jobs):
+        async def submit(h, scenario):
+            status, body = await self._request('POST', '/model', json={**scenario, 'landscape_id': landscape_id})
+            if status != 303:
+                raise ModelError("POST /model returned {}: {}".format(status, body))
+            return h, body['task_id']
+
+        submitted = await asyncio.gather(*[submit(h, s) for h, s in jobs])
+        responses = await self._wait([task_id for _, task_id in submitted])
+        return {h: responses[task_id].get('result') if responses.get(task_id, {}).get('state') == 'SUCCESS' else None
+                for h, task_id in submitted}
+
+    ##
+    # Poll tasks until they are all ready, or until the timeout. Returns {task_id: status response} of the ready ones.
+    # While every task is still queued, polls back off to half the server's shortest expected wait
+    async def _wait(self, task_ids):
+        deadline = time.monotonic() + self.timeout
+        remaining = set(task_ids)
+        done = {}
+
+        while remaining:
+            waits = []
+            for task_id, response in (await self._statuses(sorted(remaining))).items():
+                waits.append(response.get('expected_wait') if response.get('state') == 'PENDING' else 0)
+                if response.get('state') in READY_STATES:
+                    done[task_id] = response
+                    remaining.discard(task_id)
+                    if response['state'] != 'SUCCESS':
+                        log.warning("Task {} {}: {}".format(task_id, response['state'], response.get('status')))
+
+            if remaining:
+                if time.monotonic() > deadline:
+                    log.warning("Gave up on {} tasks after {}s".format(len(remaining), self.timeout))
+                    break
+                known = [w for w in waits if w is not None]
+                back_off = min(known) / 2 if known and len(known) == len(waits) else 0
+                await asyncio.sleep(min(max(self.poll_interval, back_off), max(deadline - time.monotonic(), 0)))
+        return done
+
+    async def _statuses(self, task_ids):
+        if self.status_batch_supported is not False:
+            try:
+                statuses = {}
+                for start in range(0, len(task_ids), self.batch_size):
+                    status, body = await self._request('POST', '/status',
+                                                       json={'task_ids': task_ids[start:start + self.batch_size]})
+                    if status in (404, 405):
+                        raise _Unsupported()
+                    if status != 200:
+                        raise ModelError("POST /status returned {}: {}".format(status, body))
+                    statuses.update(body['tasks'])
+                self.status_batch_supported = True
+                return statuses
+            except _Unsupported:
+                log.info("Server has no POST /status: polling tasks one at a time")
+                self.status_batch_supported = False
+
+        async def status(task_id):
+            code, body = await self._request('GET', '/status/{}'.format(task_id))
+            return task_id, body if code == 200 else {'state': 'PENDING'}
+
+        return dict(await asyncio.gather(*[status(t) for t in task_ids]))
+
+
+##
+# Evaluate scenarios from synchronous code (not from a running event loop, e.g. a notebook cell: there, use
+# `await client.run(...)` instead). Keyword arguments are as for CropModelClient
+def run_scenarios(base_url, landscape_id, scenarios, frame=False, **kwargs):
+    async def _run():
+        async with CropModelClient(base_url, **kwargs) as client:
+            if frame:
+                return await client.run_frame(landscape_id, scenarios)
+            return await client.run(landscape_id, scenarios)
+
+    return asyncio.run(_run())
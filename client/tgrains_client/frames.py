@@ -0,0 +1,54 @@
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+##
+# Results as NumPy arrays by output: scalar outputs as 1-d float arrays, list outputs as 2-d (scenario, item) arrays.
+# Failed scenarios (None) are rows of NaN
+def results_arrays(results):
+    template = next((r for r in results if r), None)
+    if template is None:
+        return {}
+
+    arrays = {}
+    for name, value in template.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float, list)):
+            continue
+        if isinstance(value, list):
+            if not all(isinstance(v, (int, float)) for v in value):
+                continue
+            array = np.full((len(results), len(value)), np.nan)
+            for i, r in enumerate(results):
+                if r and len(r.get(name) or []) == len(value):
+                    array[i] = r[name]
+        else:
+            array = np.full(len(results), np.nan)
+            for i, r in enumerate(results):
+                if r and isinstance(r.get(name), (int, float)):
+                    array[i] = r[name]
+        arrays[name] = array
+    return arrays
+
+
+##
+# Scenarios and their results as a pandas DataFrame: a row per scenario, with its inputs, then every scalar output,
+# then list outputs expanded to columns `<output>_<i>`. Needs pandas
+def results_frame(scenarios, results):
+    if pd is None:
+        raise ImportError("results_frame() needs pandas: use results_arrays() without it")
+
+    inputs = pd.DataFrame.from_records(scenarios)
+    columns = {}
+    for name, array in results_arrays(results).items():
+        if array.ndim == 1:
+            columns[name] = array
+        else:
+            for i in range(array.shape[1]):
+                columns['{}_{}'.format(name, i)] = array[:, i]
+    outputs = pd.DataFrame(columns, index=inputs.index)
+    outputs['ok'] = [r is not None for r in results]
+    return pd.concat([inputs, outputs], axis=1)
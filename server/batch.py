@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+from time import monotonic, sleep
+
+from tasks.results import input_hash, cached_results
+
+log = logging.getLogger(__name__)
+
+# BAU record stored in Redis by pre_calculate_bau
+BAU_KEY = 'flask:celery_model_get_bau:{}'
+
+# Seconds a chunk may take from being sent, queueing included. A chunk whose worker died never finishes: after this
+# its task expires, and its scenarios are given up on. Longer than the worker's BATCH_TASK_TIME_LIMIT
+CHUNK_TIMEOUT = int(os.environ.get('BATCH_CHUNK_TIMEOUT', 3600))
+
+
+##
+# Evaluate many scenarios for one landscape across the Celery worker fleet.
+#
+# Identical scenarios are only run once, and scenarios already in the result cache aren't run at all.
+# The rest are sent out in chunks of chunk_size as celery_model_run_batch tasks, so that each worker
+# initialises the model once per chunk rather than once per scenario.
+#
+# At most max_in_flight chunks are queued at once, so that very large batches don't flood the broker.
+# Given a cost(scenario) estimate in seconds, chunks are also kept under max_chunk_cost (see pack_chunks).
+#
+# Yields (index, result) pairs as results become available, in no particular order. index refers to the
+# position in `scenarios`; result is None if that scenario failed, or its chunk didn't finish within chunk_timeout.
+def iter_batch(celery, client, landscape_id, scenarios, chunk_size=8, poll_interval=0.5, priority=None,
+               max_in_flight=64, cost=None, max_chunk_cost=None, chunk_timeout=CHUNK_TIMEOUT):
+    by_hash = {}
+    for i, scenario in enumerate(scenarios):
+        by_hash.setdefault(input_hash(landscape_id, scenario), []).append(i)
+
+    cached = cached_results(client, landscape_id, by_hash.keys())
+    for h, result in cached.items():
+        for i in by_hash[h]:
+            yield i, result
+
+    misses = [h for h in by_hash if h not in cached]
+    log.info("Batch for landscape {}: {} scenarios, {} unique, {} cached".format(
+        landscape_id, len(scenarios), len(by_hash), len(cached)))
+
+    options = {} if priority is None else {'priority': priority}
+    costs = None if cost is None else [cost(scenarios[by_hash[h][0]]) for h in misses]
+    chunks = pack_chunks(misses, chunk_size, costs, max_chunk_cost)
+    chunks.reverse()
+    pending = []
+
+    while pending or chunks:
+        while chunks and len(pending) < max_in_flight:
+            chunk = chunks.pop()
+            task = celery.send_task('celery_model_run_batch',
+                                    kwargs={'landscape_id': landscape_id,
+                                            'scenarios': [scenarios[by_hash[h][0]] for h in chunk]},
+                                    expires=chunk_timeout, **options)
+            pending.append((task, chunk, monotonic() + chunk_timeout))
+
+        still_pending = []
+        for task, chunk, deadline in pending:
+            if not task.ready():
+                if monotonic() < deadline:
+                    still_pending.append((task, chunk, deadline))
+                    continue
+                log.error("Batch chunk {} didn't finish within {}s: giving up on it".format(task.id, chunk_timeout))
+                results = [None] * len(chunk)
+            else:
+                try:
+                    results = task.get()['result']
+                except Exception as e:
+                    log.error("Batch chunk {} failed: {}".format(task.id, e))
+                    results = [None] * len(chunk)
+            task.forget()
+
+            for h, result in zip(chunk, results):
+                for i in by_hash[h]:
+                    yield i, result
+
+        if still_pending and len(still_pending) == len(pending):
+            sleep(poll_interval)
+        pending = still_pending
+
+
+##
+# Split items into chunks of at most chunk_size, in order. With a cost per item, a chunk is also closed before it
+# would cost more than max_cost in total, so that no task holds a worker for much longer than that. An item
+# costing more than max_cost on its own gets a chunk to itself
+def pack_chunks(items, chunk_size, costs=None, max_cost=None):
+    if costs is None or max_cost is None:
+        return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+    chunks, chunk, total = [], [], 0.0
+    for item, item_cost in zip(items, costs):
+        if chunk and (len(chunk) == chunk_size or total + item_cost > max_cost):
+            chunks.append(chunk)
+            chunk, total = [], 0.0
+        chunk.append(item)
+        total += item_cost
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+##
+# Evaluate many scenarios, returning a list of results (or None for failures) in the order of `scenarios`
+def evaluate(celery, client, landscape_id, scenarios, **kwargs):
+    results = [None] * len(scenarios)
+    for i, result in iter_batch(celery, client, landscape_id, scenarios, **kwargs):
+        results[i] = result
+    return results
+
+
+##
+# Crop and livestock names and BAU areas for a landscape, from its BAU record and strings.
+# Returns (names, bau_areas, number of crops, BAU result)
+def landscape_inputs(celery, client, landscape_id):
+    bau = client.get(BAU_KEY.format(landscape_id))
+    if not bau:
+        raise RuntimeError("No BAU result for landscape {}: start the server first".format(landscape_id))
+    bau = json.loads(bau)['result']
+
+    strings = celery.send_task('celery_get_strings', kwargs={'landscape_id': landscape_id}).get()['result']
+
+    names = strings['crops'] + strings['livestock']
+    areas = list(bau['cropAreas']) + list(bau['livestockAreas'])
+    return names, areas, len(strings['crops']), bau
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import logging
+import os
+
+from redis.exceptions import LockNotOwnedError
+from sqlalchemy import inspect
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from database import setup_db, db
+
+# One-shot initialisation of a deployment: create the database, tables and tags (setup_db), then precalculate
+# the BAU results. Runs once, before the web workers start: from gunicorn's master process (gunicorn.conf.py),
+# from `python server.py`, or by hand:
+#   python bootstrap.py [--force]
+#
+# Replicas starting together take turns on a Redis lock. Whoever holds it runs the DDL, and records the schema
+# version it applied, so everyone after finds the work done and only checks that the BAU results are present.
+# The version is only trusted while the tables are there too: Redis can outlive the database (a recreated volume,
+# or a new database URI).
+# Workers themselves do no DDL and connect lazily, on their first request.
+
+LOCK_KEY = 'flask:bootstrap:lock'
+SCHEMA_KEY = 'flask:bootstrap:schema'
+
+# Longer than the BAU precalculation, which waits at most BAU_PRECALC_TIMEOUT per landscape; the lock is released as
+# soon as bootstrap finishes
+LOCK_TIMEOUT = int(os.environ.get('BOOTSTRAP_LOCK_TIMEOUT', 1800))
+
+TAGS_SQL = 'sql/tgrains_tags.sql'
+
+
+##
+# Version of the schema setup_db creates: the tables' DDL and the tag list. Changes when a deploy changes either
+def schema_version():
+    sha = hashlib.sha256()
+    for table in sorted(db.metadata.tables.values(), key=lambda t: t.name):
+        sha.update(str(CreateTable(table).compile(dialect=mysql.dialect())).encode('utf-8'))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            sha.update(str(CreateIndex(index).compile(dialect=mysql.dialect())).encode('utf-8'))
+    with open(TAGS_SQL, 'rb') as file:
+        sha.update(file.read())
+    return sha.hexdigest()
+
+
+##
+# Whether the database has every table setup_db creates. False if it can't be reached, e.g. doesn't exist yet
+def tables_present(app):
+    try:
+        with app.app_context():
+            return set(db.metadata.tables) <= set(inspect(db.engine).get_table_names())
+    except OperationalError:
+        return False
+
+
+##
+# Bring the database and the BAU results up to date, unless another process already has.
+# precalculate is server.pre_calculate_bau, which skips landscapes whose BAU result is already stored
+def bootstrap(app, client, precalculate, force=False):
+    log = app.logger
+    version = schema_version()
+
+    # Outlasting the lock only means another process may have started on the same work: not worth failing over
+    try:
+        with client.lock(LOCK_KEY, timeout=LOCK_TIMEOUT):
+            applied = client.get(SCHEMA_KEY)
+            if force or applied is None or applied.decode() != version or not tables_present(app):
+                log.info("Bootstrapping database (schema {})".format(version[:12]))
+                setup_db(app, db)
+                client.set(SCHEMA_KEY, version)
+            else:
+                log.info("Database already bootstrapped (schema {})".format(version[:12]))
+
+            with app.app_context():
+                precalculate()
+    except LockNotOwnedError:
+        log.warning("Bootstrap took longer than its lock ({}s): raise BOOTSTRAP_LOCK_TIMEOUT".format(LOCK_TIMEOUT))
+
+    # Connections opened here belong to this process: don't hand them to forked workers
+    with app.app_context():
+        db.engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the database and precalculate BAU results")
+    parser.add_argument('--force', action='store_true', help="Run setup_db even if this schema was applied")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    from config import redis
+    from server import app, pre_calculate_bau
+
+    bootstrap(app, redis, pre_calculate_bau, force=args.force)
@@ -0,0 +1,63 @@
+import hashlib
+import json
+
+PAGE_KEY = 'flask:comments:page:{}'
+GENERATION_KEY = 'flask:comments:gen:{}'
+
+# Generations. A page's entry is stored under the generations it depends on, so bumping one makes every page
+# which could show a change miss, and leaves all the others cached. Orphaned entries expire with their TTL.
+#   all:              anything on every page, e.g. an author's name
+#   landscape:<id>:   listings of one landscape. landscape:any covers listings without a landscape_id
+#   reply:<id>:       the replies to one comment (filter=3)
+ALL = 'all'
+ANY_LANDSCAPE = 'landscape:any'
+
+
+def landscape_scope(landscape_id):
+    return 'landscape:{}'.format(landscape_id)
+
+
+def reply_scope(reply_id):
+    return 'reply:{}'.format(reply_id)
+
+
+##
+# Pre-serialised (JSON) /comment responses in Redis, shared by every worker
+class CommentPages:
+
+    def __init__(self, client, ttl=300):
+        self.client = client
+        self.ttl = ttl
+
+    ##
+    # Generations a page with these query parameters depends on
+    @staticmethod
+    def scopes(params):
+        if params.get('filter') == 3:
+            return [ALL, reply_scope(params.get('reply_id'))]
+        if params.get('landscape_id') is None:
+            return [ALL, ANY_LANDSCAPE]
+        return [ALL, landscape_scope(params['landscape_id'])]
+
+    ##
+    # Key for a page: its query parameters and the current generations of its scopes. Must be taken before
+    # the page is queried, so that a page built while a comment is posted is stored under the old generation
+    def key(self, params):
+        generations = self.client.mget([GENERATION_KEY.format(s) for s in self.scopes(params)])
+        digest = hashlib.sha1(json.dumps([sorted((k, str(v)) for k, v in params.items()),
+                                          [int(g or 0) for g in generations]]).encode('utf-8')).hexdigest()
+        return PAGE_KEY.format(digest)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def put(self, key, body):
+        self.client.setex(key, self.ttl, body)
+
+    ##
+    # Bump the generations of the pages a change can appear on. Arguments are scopes
+    def invalidate(self, *scopes):
+        pipe = self.client.pipeline(transaction=False)
+        for scope in set(scopes):
+            pipe.incr(GENERATION_KEY.format(scope))
+        pipe.execute()
@@ -1,12 +1,18 @@
-import re
+import json
 import logging
+import threading
+import time
 from datetime import datetime
+from functools import wraps
 
-from config import Config
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine, text, and_
+from config import Config, redis
+from history import rebuild, encode_state
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, inspect, insert, orm, text, and_
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
 
-db = SQLAlchemy()
 log = logging.getLogger(__name__)
 strh = logging.StreamHandler()
 strh.setLevel(logging.DEBUG)
@@ -15,6 +21,94 @@ log.addHandler(strh)
 log.setLevel(logging.DEBUG)
 
 
+# ==================
+# Connection pooling
+
+##
+# Per-process statistics on how long requests wait for a pooled connection
+class PoolStats:
+
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.slow = 0
+        self.lock = threading.Lock()
+
+    def record(self, pool, wait):
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait > Config.SQLALCHEMY_POOL_SLOW_WAIT:
+                self.slow += 1
+                log.warning('Waited {:.3f}s for a database connection ({})'.format(wait, pool.status()))
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'mean_wait': self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait': self.max_wait,
+                'slow': self.slow
+            }
+
+
+pool_stats = PoolStats()
+
+
+##
+# QueuePool which times how long each checkout waits for a free connection
+class TimedQueuePool(QueuePool):
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record(self, time.perf_counter() - start)
+
+
+##
+# Session which sends reads to the replica engine during requests marked @read_only.
+# Anything flushed (i.e. writes) always goes to the primary.
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and has_app_context() and g.get('use_replica', False) \
+                and 'replica' in self.app.config['SQLALCHEMY_BINDS']:
+            return self.db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.get_backend_name() != 'sqlite':
+            options.setdefault('poolclass', TimedQueuePool)
+        return sa_url, options
+
+
+##
+# Route decorator: this request only reads, so its queries may be served by the replica
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+db = RoutingSQLAlchemy()
+
+# Bumped whenever the tags table is (re)populated, so that cached tag responses are invalidated
+TAGS_VERSION_KEY = 'flask:tags:version'
+
+
 # Mixins for database class methods
 class BaseMixin(object):
     @classmethod
@@ -27,6 +121,23 @@ class BaseMixin(object):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+# Model results of the scenarios in stored states, by input hash (see tasks.results.input_hash).
+# States with the same inputs share one row, so a result is only stored once however often it is explored.
+class Results(BaseMixin, db.Model):
+    hash = db.Column(db.String(64), primary_key=True, nullable=False)
+    landscape_id = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    result = db.Column(db.Text, nullable=False)
+
+    ##
+    # Add a result unless one is already stored under its hash. Not committed: the caller commits it with the
+    # state which refers to it.
+    @classmethod
+    def store(cls, result_hash, landscape_id, result):
+        db.session.execute(insert(cls.__table__).prefix_with('IGNORE', dialect='mysql').values(
+            hash=result_hash, landscape_id=landscape_id, timestamp=datetime.utcnow(), result=json.dumps(result)))
+
+
 # Store history states from users in DB
 class State(BaseMixin, db.Model):
     session_id = db.Column(db.String(Config.STRING_LENGTH_UNIQUE_ID), primary_key=True, nullable=False)
@@ -40,6 +151,63 @@ class State(BaseMixin, db.Model):
     # TEXT column holds 65,535 (2^16 - 1) characters or 64kb of data. Better for DoS attack protection!
     state = db.Column(db.Text)
 
+    # Delta or snapshot encoding of the state, compressed, in place of `state` (see history.py)
+    encoding = db.Column(db.String(8))
+    data = db.Column(db.LargeBinary)
+
+    # The state's outputs, when they are stored in the results table rather than in `state`
+    result_hash = db.Column(db.String(64), db.ForeignKey('results.hash'), index=True)
+
+
+##
+# Stored states as dicts, rebuilt from their snapshots and deltas. The rows of sessions which weren't all
+# given (e.g. states filtered by date) are fetched, a session at a time
+def stored_states(states):
+    rebuilt, incomplete = rebuild(states)
+    if incomplete:
+        rows = db.session.query(State.session_id, State.index, State.state, State.encoding, State.data) \
+            .filter(State.session_id.in_(incomplete)).all()
+        rebuilt.update(rebuild(rows)[0])
+    return [rebuilt.get((s.session_id, s.index)) for s in states]
+
+
+##
+# Encode a state for storage at index in a session, as STATE_STORAGE says. Returns (state, encoding, data)
+# to store: the JSON in state, or the encoding and data
+def encode_stored_state(state, session_id, index):
+    if current_app.config['STATE_STORAGE'] != 'delta':
+        return json.dumps(state), None, None
+
+    # The state before, to take the delta from: only the rows back to the last snapshot are needed
+    every = current_app.config['STATE_SNAPSHOT_EVERY']
+    previous = None
+    if index % every:
+        rows = db.session.query(State.session_id, State.index, State.state, State.encoding, State.data) \
+            .filter(State.session_id == session_id, State.index < index,
+                    State.index >= (index - 1) // every * every).all()
+        previous = dict(zip([r.index for r in rows], stored_states(rows))).get(index - 1)
+
+    encoding, data = encode_state(state, index, previous, every)
+    return None, encoding, data
+
+
+##
+# Stored states as dicts, with their outputs put back from the results table.
+# Results are fetched in one query, however many states there are.
+def load_states(states):
+    hashes = {s.result_hash for s in states if s.result_hash}
+    results = {}
+    if hashes:
+        results = {r.hash: json.loads(r.result)
+                   for r in db.session.query(Results.hash, Results.result).filter(Results.hash.in_(hashes))}
+
+    loaded = []
+    for s, state in zip(states, stored_states(states)):
+        if s.result_hash in results:
+            state['outputs'] = results[s.result_hash]
+        loaded.append(state)
+    return loaded
+
 
 # Store users in DB
 class User(BaseMixin, db.Model):
@@ -73,8 +241,9 @@ class Comments(BaseMixin, db.Model):
                               primaryjoin=and_(State.session_id == session_id),
                               uselist=True, viewonly=True)
 
-    # FK Relationship
-    __table_args__ = db.ForeignKeyConstraint([session_id, state_index], [State.session_id, State.index]), {}
+    # FK Relationship, and the FULLTEXT index used by comment search (indexes.search_terms)
+    __table_args__ = (db.ForeignKeyConstraint([session_id, state_index], [State.session_id, State.index]),
+                      db.Index('ix_comments_text', 'text', mysql_prefix='FULLTEXT'), {})
 
 
 # SQLAlchemy Tags class
@@ -90,6 +259,41 @@ class CommentTags(BaseMixin, db.Model):
     tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
 
 
+# In-process index of the tags table: id -> tag and group -> ids. Tags only change when _insert_tags seeds
+# them, which bumps TAGS_VERSION_KEY in Redis; the catalogue reloads when that differs from the version it holds.
+class TagCatalogue:
+
+    def __init__(self):
+        self.version = None
+        self.tags = {}
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    # Reload from the database if the tags table has changed since the last load. Needs an app context.
+    def refresh(self):
+        version = redis.get(TAGS_VERSION_KEY) or b'0'
+        if version == self.version:
+            return self
+
+        with self.lock:
+            if version != self.version:
+                tags = {}
+                groups = {}
+                for tag in Tags.query.order_by(Tags.id):
+                    tags[tag.id] = {'name': tag.name, 'group': tag.group}
+                    groups.setdefault(tag.group, []).append(tag.id)
+
+                self.tags, self.groups, self.version = tags, groups, version
+                log.info('Loaded {} tags in {} groups (version {})'.format(len(tags), len(groups), version))
+        return self
+
+    def unknown(self, tag_ids):
+        return [t for t in tag_ids if t not in self.tags]
+
+
+tag_catalogue = TagCatalogue()
+
+
 # ==================
 # Methods
 
@@ -98,32 +302,60 @@ def setup_db(_app, _db):
     # Initialize application for use with this database setup
     _db.init_app(_app)
 
-    # Get SQL Database connection parameters
-    # Capture groups for each part of connection string
-    p = re.compile(r'^(?P<proto>[A-Za-z+]+)://(?P<user>.+):(?P<pass>.+)@'
-                   r'(?P<host>[A-Za-z0-9.]+):?(?P<port>\d+)?/'
-                   r'(?P<db>[A-Za-z0-9]+)?(\?(?P<params>.+))?$')
-    m = p.match(_app.config['SQLALCHEMY_DATABASE_URI'])
-
-    # Connect to the database and create the tgrains database if it doesn't exist
+    # Connect to the server without selecting a database, and create the tgrains database if it doesn't exist
     # We need to do this because SQLAlchemy won't do it for us.
-    engine = create_engine('{0}://{1}:{2}@{3}:{4}/?{5}'.format(
-        m['proto'],
-        m['user'],
-        m['pass'],
-        m['host'],
-        m['port'] or '3306',
-        m['params'] or 'charset=utf8mb4')
-    )
-    db_name = m['db'] if 'db' in m.groupdict() else 'tgrains'
-    engine.execute('CREATE DATABASE IF NOT EXISTS {0};'.format(db_name))
-    engine.execute('USE {0};'.format(db_name))
+    # This engine is only used once, so don't build a pool for it
+    url = make_url(_app.config['SQLALCHEMY_DATABASE_URI'])
+    db_name = url.database or 'tgrains'
+    url = url.set(database=None)
+    if not url.query:
+        url = url.update_query_dict({'charset': 'utf8mb4'})
+
+    engine = create_engine(url, poolclass=NullPool)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE DATABASE IF NOT EXISTS {0};'.format(db_name)))
+    engine.dispose()
 
     with _app.app_context():
         _db.create_all()
-        _insert_tags(_db, engine)
+        _add_columns(_db)
+        _add_indexes(_db)
+        _insert_tags(_db, _db.engine)
 
-    engine.dispose()
+
+##
+# Forget pooled connections inherited from a parent process (gunicorn --preload) without closing them:
+# the parent's sockets are left alone and each worker opens its own on first use
+def dispose_engines(_app, _db):
+    with _app.app_context():
+        for bind in [None] + list(_app.config['SQLALCHEMY_BINDS']):
+            _db.get_engine(_app, bind).dispose(close=False)
+
+##
+# create_all() only creates missing tables: add columns introduced since a table was created
+def _add_columns(_db):
+    columns = {c['name'] for c in inspect(_db.engine).get_columns(State.__tablename__)}
+    if 'encoding' not in columns:
+        log.info('Adding encoding and data columns to state table...')
+        with _db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE {0} ADD COLUMN encoding VARCHAR(8) NULL, ADD COLUMN data BLOB NULL'
+                                    .format(State.__tablename__)))
+    if 'result_hash' not in columns:
+        log.info('Adding result_hash column to state table...')
+        with _db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE {0} ADD COLUMN result_hash VARCHAR(64) NULL, '
+                                    'ADD INDEX ix_state_result_hash (result_hash), '
+                                    'ADD FOREIGN KEY (result_hash) REFERENCES {1} (hash)'
+                                    .format(State.__tablename__, Results.__tablename__)))
+
+
+def _add_indexes(_db):
+    indexes = {i['name'] for i in inspect(_db.engine).get_indexes(Comments.__tablename__)}
+    if 'ix_comments_text' not in indexes:
+        log.info('Adding full-text index to comments table...')
+        with _db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE {0} ADD FULLTEXT INDEX ix_comments_text (text)'
+                                    .format(Comments.__tablename__)))
 
 
 def _insert_tags(_db, _engine):
@@ -137,4 +369,5 @@ def _insert_tags(_db, _engine):
             _engine.execute(escaped_sql)
 
         _db.session.commit()
+        redis.incr(TAGS_VERSION_KEY)
 
@@ -0,0 +1,180 @@
+import logging
+import threading
+
+import numpy as np
+
+from tasks.results import count_runs, load_runs
+
+log = logging.getLogger(__name__)
+
+# Model outputs the emulator predicts: single values, and lists of values
+SCALAR_OUTPUTS = ['greenhouseGasEmissions', 'nLeach', 'profit', 'production']
+LIST_OUTPUTS = ['pesticideImpacts', 'nutritionaldelivery']
+
+
+##
+# Gaussian process regression from a landscape's crop/livestock areas to the model outputs.
+#
+# Inputs and outputs are standardised and share one squared-exponential kernel, so a single Cholesky
+# factorisation serves every output. The nugget absorbs the model's run-to-run (weather) noise.
+class Emulator:
+
+    def __init__(self, runs, noise=1e-2):
+        self.names = sorted({name for run in runs for name in run['inputs']})
+        self.layout = [(k, None) for k in SCALAR_OUTPUTS] + \
+                      [(k, len(runs[0]['result'][k])) for k in LIST_OUTPUTS]
+        self.samples = len(runs)
+        self.noise = noise
+
+        x = np.array([[run['inputs'].get(n, 0.0) for n in self.names] for run in runs], dtype=np.float64)
+        y = np.array([self.flatten(run['result']) for run in runs], dtype=np.float64)
+
+        self.x_mean, self.x_std = x.mean(axis=0), x.std(axis=0)
+        self.x_std[self.x_std == 0] = 1.0
+        self.y_mean, self.y_spread = y.mean(axis=0), y.std(axis=0)
+        self.y_std = np.where(self.y_spread == 0, 1.0, self.y_spread)
+
+        self.x = (x - self.x_mean) / self.x_std
+        y = (y - self.y_mean) / self.y_std
+
+        # Length scale from the median distance between training points
+        distances = np.sqrt(self.sq_distances(self.x, self.x))
+        self.length_scale = float(np.median(distances[distances > 0])) if np.any(distances > 0) else 1.0
+
+        k = self.kernel(self.x, self.x) + noise * np.eye(len(self.x))
+        self.chol = np.linalg.cholesky(k)
+        self.alpha = np.linalg.solve(self.chol.T, np.linalg.solve(self.chol, y))
+
+    @staticmethod
+    def sq_distances(a, b):
+        return np.maximum((a ** 2).sum(axis=1)[:, None] + (b ** 2).sum(axis=1)[None, :] - 2 * a @ b.T, 0.0)
+
+    def kernel(self, a, b):
+        return np.exp(-0.5 * self.sq_distances(a, b) / self.length_scale ** 2)
+
+    def flatten(self, result):
+        values = []
+        for key, length in self.layout:
+            values.extend([result[key]] if length is None else list(result[key])[:length])
+        return values
+
+    def unflatten(self, values):
+        result, i = {}, 0
+        for key, length in self.layout:
+            if length is None:
+                result[key] = float(values[i])
+                i += 1
+            else:
+                result[key] = [float(v) for v in values[i:i + length]]
+                i += length
+        return result
+
+    ##
+    # Predict outputs for a {name: area} dict. Returns (mean, standard deviation), each shaped like a model result.
+    def predict(self, inputs):
+        missing = [n for n in self.names if n not in inputs]
+        if missing:
+            raise KeyError(', '.join(missing))
+
+        x = (np.array([[float(inputs[n]) for n in self.names]]) - self.x_mean) / self.x_std
+        k = self.kernel(x, self.x)
+
+        mean = (k @ self.alpha)[0] * self.y_std + self.y_mean
+        v = np.linalg.solve(self.chol, k.T)
+        variance = max(1.0 + self.noise - float((v ** 2).sum()), 0.0)
+        std = np.sqrt(variance) * self.y_spread
+
+        return self.unflatten(mean), self.unflatten(std)
+
+
+##
+# Ridge regression of a landscape's model run times on its crop/livestock areas, for scheduling (tasks/schedule.py).
+#
+# Run times are fitted in log space, where the effect of an input is a factor rather than a number of seconds,
+# with the number of non-zero inputs as a feature of the input mix. The ridge keeps a small run log from
+# overfitting. Predictions are means, corrected for the spread of the residuals.
+class CostModel:
+
+    def __init__(self, runs, ridge=1.0):
+        self.names = sorted({name for run in runs for name in run['inputs']})
+        self.samples = len(runs)
+
+        x = np.array([self.features(run['inputs']) for run in runs], dtype=np.float64)
+        y = np.log(np.maximum(np.array([run['duration'] for run in runs], dtype=np.float64), 1e-3))
+
+        self.x_mean, self.x_std = x.mean(axis=0), x.std(axis=0)
+        self.x_std[self.x_std == 0] = 1.0
+        x = (x - self.x_mean) / self.x_std
+        self.y_mean = float(y.mean())
+
+        self.weights = np.linalg.solve(x.T @ x + ridge * np.eye(x.shape[1]), x.T @ (y - self.y_mean))
+        residuals = y - self.y_mean - x @ self.weights
+        self.spread = float(residuals.std())
+
+    def features(self, inputs):
+        areas = [float(inputs.get(n, 0.0)) for n in self.names]
+        return areas + [sum(1 for a in areas if a > 0)]
+
+    ##
+    # Expected run time in seconds for a {name: area} dict. Inputs the model wasn't trained on are ignored
+    def predict(self, inputs):
+        x = (np.array(self.features(inputs)) - self.x_mean) / self.x_std
+        return float(np.exp(self.y_mean + x @ self.weights + self.spread ** 2 / 2))
+
+
+##
+# Per-process emulators, one per landscape, trained from the run log the workers keep in Redis. `factory` is the
+# kind of model trained: Emulator, or CostModel for run times.
+#
+# The first emulator for a landscape is trained on request. After that, once `retrain_every` new runs
+# have been logged, a background thread retrains it while the current one keeps serving.
+class EmulatorRegistry:
+
+    def __init__(self, client, min_samples=30, max_samples=1000, retrain_every=50, factory=Emulator):
+        self.client = client
+        self.factory = factory
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.retrain_every = retrain_every
+        self.emulators = {}
+        self.trained_at = {}
+        self.training = set()
+        self.lock = threading.Lock()
+
+    def train(self, landscape_id, logged):
+        try:
+            runs = load_runs(self.client, landscape_id, self.max_samples)
+            emulator = self.factory(runs)
+            with self.lock:
+                self.emulators[landscape_id] = emulator
+            log.info("Trained {} for landscape {} on {} runs".format(self.factory.__name__, landscape_id,
+                                                                     emulator.samples))
+        except (KeyError, IndexError, ValueError, np.linalg.LinAlgError) as e:
+            log.error("{} training failed for landscape {}: {}".format(self.factory.__name__, landscape_id, e))
+        finally:
+            # Also on failure, so a bad run log isn't retried on every request
+            with self.lock:
+                self.trained_at[landscape_id] = logged
+                self.training.discard(landscape_id)
+
+    ##
+    # Emulator for the landscape, or None if too few runs have been logged to train one
+    def get(self, landscape_id):
+        landscape_id = int(landscape_id)
+        logged = count_runs(self.client, landscape_id)
+
+        with self.lock:
+            emulator = self.emulators.get(landscape_id)
+            stale = landscape_id not in self.trained_at or \
+                logged - self.trained_at[landscape_id] >= self.retrain_every
+            start = logged >= self.min_samples and stale and landscape_id not in self.training
+            if start:
+                self.training.add(landscape_id)
+
+        if start and emulator is None:
+            self.train(landscape_id, logged)
+        elif start:
+            threading.Thread(target=self.train, args=(landscape_id, logged), daemon=True).start()
+
+        with self.lock:
+            return self.emulators.get(landscape_id)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database import db, Comments, CommentTags, Results, State, User
+from history import rebuild
+
+# Bulk export of the workshop data, for analysis: comments (with their tags, and their author's name and hash),
+# session states, users and model results. Email addresses are never exported.
+#
+# Rows are read with server-side cursors and written as they arrive, as NDJSON lines or as Parquet row groups of
+# `chunk` rows, so an export never holds more than a chunk in memory. Exports can be incremental: only rows
+# stamped at or after `since`, and for comments, only IDs after `after_id`.
+#
+# Served by GET /export/<table> (with EXPORT_TOKEN), or run offline:
+#   python export.py comments comments.parquet [--since 2024-05-01] [--after-id 1200] [--chunk 5000]
+
+log = logging.getLogger(__name__)
+
+MIMETYPE_NDJSON = 'application/x-ndjson'
+MIMETYPE_PARQUET = 'application/vnd.apache.parquet'
+
+# Parquet columns of each export. Nested values (states, results) are JSON strings
+SCHEMAS = {
+    'comments': pa.schema([
+        ('id', pa.int64()), ('landscape_id', pa.int64()), ('timestamp', pa.float64()), ('user_id', pa.string()),
+        ('author', pa.string()), ('hash', pa.string()), ('text', pa.string()), ('reply_id', pa.int64()),
+        ('distance', pa.int64()), ('session_id', pa.string()), ('state_index', pa.int64()),
+        ('tags', pa.list_(pa.int64()))]),
+    'states': pa.schema([
+        ('session_id', pa.string()), ('index', pa.int64()), ('user_id', pa.string()), ('forked_from', pa.string()),
+        ('timestamp', pa.float64()), ('deleted', pa.bool_()), ('state', pa.string()), ('result_hash', pa.string())]),
+    'users': pa.schema([('id', pa.string()), ('name', pa.string()), ('hash', pa.string())]),
+    'results': pa.schema([
+        ('hash', pa.string()), ('landscape_id', pa.int64()), ('timestamp', pa.float64()), ('result', pa.string())])
+}
+JSON_COLUMNS = {'states': ['state'], 'results': ['result']}
+
+
+##
+# `since` as given to the export: epoch seconds (as the API's timestamps), or an ISO 8601 date or time. Returned
+# as a naive UTC datetime, as the tables store their timestamps: times with an offset are converted to UTC
+def parse_since(since):
+    if since is None:
+        return None
+    try:
+        return datetime.utcfromtimestamp(float(since))
+    except ValueError:
+        since = datetime.fromisoformat(since)
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+##
+# Epoch seconds of a stored timestamp: naive, in UTC, whatever the local time zone. parse_since reads them back
+def epoch(timestamp):
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _stream(query, chunk):
+    return query.execution_options(stream_results=True).yield_per(chunk)
+
+
+def comment_records(since=None, after_id=None, chunk=1000):
+    query = db.session.query(Comments.id, Comments.landscape_id, Comments.timestamp, Comments.user_id,
+                             User.name, User.hash, Comments.text, Comments.reply_id, Comments.distance,
+                             Comments.session_id, Comments.state_index,
+                             db.func.group_concat(CommentTags.tag_id).label('tags')) \
+        .outerjoin(User, User.id == Comments.user_id) \
+        .outerjoin(CommentTags, CommentTags.comment_id == Comments.id) \
+        .group_by(Comments.id) \
+        .order_by(Comments.id)
+    if since is not None:
+        query = query.filter(Comments.timestamp >= since)
+    if after_id is not None:
+        query = query.filter(Comments.id > after_id)
+
+    for c in _stream(query, chunk):
+        yield {
+            'id': c.id, 'landscape_id': c.landscape_id, 'timestamp': epoch(c.timestamp),
+            'user_id': c.user_id, 'author': c.name, 'hash': c.hash, 'text': c.text, 'reply_id': c.reply_id,
+            'distance': c.distance, 'session_id': c.session_id, 'state_index': c.state_index,
+            'tags': sorted(int(t) for t in c.tags.split(',')) if c.tags else []
+        }
+
+
+##
+# States, rebuilt from their snapshots and deltas (without outputs: see result_hash and the results export).
+# Rows come a session at a time, so that each session is rebuilt from its own rows as it streams past: an
+# incremental export reads the earlier rows of the sessions it exports, but only writes the new ones
+def state_records(since=None, after_id=None, chunk=1000):
+    query = db.session.query(State.session_id, State.index, State.user_id, State.forked_from, State.timestamp,
+                             State.deleted, State.state, State.encoding, State.data, State.result_hash) \
+        .order_by(State.session_id, State.index)
+    if since is not None:
+        recent = db.session.query(State.session_id).filter(State.timestamp >= since).distinct()
+        query = query.filter(State.session_id.in_(recent))
+
+    def session_records(rows):
+        states = rebuild(rows)[0]
+        for s in rows:
+            if since is None or s.timestamp >= since:
+                yield {
+                    'session_id': s.session_id, 'index': s.index, 'user_id': s.user_id,
+                    'forked_from': s.forked_from, 'timestamp': epoch(s.timestamp), 'deleted': s.deleted,
+                    'state': states.get((s.session_id, s.index)), 'result_hash': s.result_hash
+                }
+
+    rows = []
+    for row in _stream(query, chunk):
+        if rows and row.session_id != rows[0].session_id:
+            yield from session_records(rows)
+            rows = []
+        rows.append(row)
+    yield from session_records(rows)
+
+
+def user_records(since=None, after_id=None, chunk=1000):
+    for u in _stream(db.session.query(User.id, User.name, User.hash).order_by(User.id), chunk):
+        yield {'id': u.id, 'name': u.name, 'hash': u.hash}
+
+
+def result_records(since=None, after_id=None, chunk=1000):
+    query = db.session.query(Results.hash, Results.landscape_id, Results.timestamp, Results.result) \
+        .order_by(Results.hash)
+    if since is not None:
+        query = query.filter(Results.timestamp >= since)
+
+    for r in _stream(query, chunk):
+        yield {'hash': r.hash, 'landscape_id': r.landscape_id, 'timestamp': epoch(r.timestamp),
+               'result': json.loads(r.result)}
+
+
+EXPORTS = {
+    'comments': comment_records,
+    'states': state_records,
+    'users': user_records,
+    'results': result_records
+}
+
+# The incremental filters each export supports: others are refused rather than ignored
+FILTERS = {
+    'comments': {'since', 'after_id'},
+    'states': {'since'},
+    'users': set(),
+    'results': {'since'}
+}
+
+
+def ndjson_chunks(records, chunk=1000):
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, separators=(',', ':')))
+        if len(lines) >= chunk:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+##
+# Write-only file which hands back what was written to it, so a Parquet file can be streamed as it is written
+class _Sink:
+
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.buffer.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.buffer = b''.join(self.buffer), []
+        return data
+
+
+def parquet_chunks(name, records, chunk=1000):
+    schema = SCHEMAS[name]
+    json_columns = JSON_COLUMNS.get(name, [])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def row_group(rows):
+        for row in rows:
+            for column in json_columns:
+                row[column] = json.dumps(row[column], separators=(',', ':'))
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        return sink.drain()
+
+    rows = []
+    for record in records:
+        rows.append(record)
+        if len(rows) >= chunk:
+            yield row_group(rows)
+            rows = []
+    if rows:
+        yield row_group(rows)
+
+    writer.close()
+    yield sink.drain()
+
+
+##
+# An export as chunks of bytes in the given format ('ndjson' or 'parquet'). Needs an app context.
+def export_chunks(name, fmt='ndjson', since=None, after_id=None, chunk=1000):
+    records = EXPORTS[name](since=since, after_id=after_id, chunk=chunk)
+    if fmt == 'parquet':
+        return parquet_chunks(name, records, chunk)
+    return ndjson_chunks(records, chunk)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export comments, states, users or results')
+    parser.add_argument('table', choices=sorted(EXPORTS))
+    parser.add_argument('output', help='Output file: .parquet, or NDJSON otherwise')
+    parser.add_argument('--since', help='Only rows stamped at or after this: epoch seconds or ISO 8601')
+    parser.add_argument('--after-id', type=int, help='Only comments with a greater ID')
+    parser.add_argument('--chunk', type=int, default=5000, help='Rows per fetch and per Parquet row group')
+    args = parser.parse_args()
+    for name, value in (('since', args.since), ('after_id', args.after_id)):
+        if value is not None and name not in FILTERS[args.table]:
+            parser.error("the {} export doesn't support --{}".format(args.table, name.replace('_', '-')))
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    from config import create_app
+
+    app = create_app()
+    db.init_app(app)
+
+    with app.app_context(), open(args.output, 'wb') as file:
+        size = 0
+        for data in export_chunks(args.table,
+                                  'parquet' if args.output.endswith('.parquet') else 'ndjson',
+                                  since=parse_since(args.since), after_id=args.after_id, chunk=args.chunk):
+            file.write(data)
+            size += len(data)
+        log.info("Exported {} to {} ({} bytes)".format(args.table, args.output, size))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# ASGI entry point: the model submission and status routes served on asyncio, and everything else by the
+# Flask app, unchanged, in a thread pool.
+#
+# A client polling /status holds no thread between polls, and each poll is one async Redis read, so a
+# process can serve thousands of pending clients. Slow SQL in the comment routes can't block them either.
+# Routes, status codes and response bodies are the same as the Flask versions in server.py.
+#
+# Run with:
+#   gunicorn -k uvicorn.workers.UvicornWorker --workers=2 --bind=0.0.0.0:5000 gateway:app
+import hashlib
+import logging
+import pickle
+
+import redis.asyncio
+from celery import states
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, JSONResponse, PlainTextResponse
+from starlette.routing import Route, Mount
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+from server import app as flask_app, celery, submit_model_run, stored_task_meta, status_body, request_landscape_id
+from serialisation import negotiate, encoded_body
+from tasks.results import input_errors
+from tasks.quarantine import QUARANTINE_TTL, QuarantinedError
+from tasks.schedule import QUEUED_KEY, WORKERS_KEY, QueueEstimate
+
+log = logging.getLogger(__name__)
+
+config = flask_app.config
+prefix = config['APPLICATION_ROOT'].rstrip('/')
+aredis = redis.asyncio.Redis.from_url(config['REDIS_URL'])
+
+BAD_LANDSCAPE = 'Bad Request: Must provide landscape_id=101 or 102 as parameter!'
+
+
+##
+# Response in the format negotiated with the client, as serialisation.encoded_response
+def encoded(request, obj=None, raw=None, cache_key=None, status=200, max_age=None, headers=None):
+    mimetype, encoding = negotiate(parse_accept_header(request.headers.get('accept'), MIMEAccept),
+                                   parse_accept_header(request.headers.get('accept-encoding')))
+    body, etag, encoding = encoded_body(mimetype, encoding, obj=obj, raw=raw, cache_key=cache_key,
+                                        etag=max_age is not None)
+
+    headers = dict(headers or {})
+    headers['Vary'] = 'Accept, Accept-Encoding'
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+
+    if max_age is not None and status == 200:
+        headers['ETag'] = '"{}"'.format(etag)
+        headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+        # Weak comparison against each listed ETag, or `*`, as Flask's make_conditional
+        if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+            return Response(status_code=304, headers=headers)
+
+    return Response(body, status_code=status, media_type=mimetype, headers=headers)
+
+
+def status_location(request, task_id):
+    return request.url_for('task_status', task_id=task_id).path
+
+
+# As server.see_other_redirect: always JSON. Keyword arguments are added to the body
+def see_other(request, task_id, max_age=None, **body):
+    headers = {'Location': status_location(request, task_id)}
+    if max_age is not None:
+        headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+    return JSONResponse({'task_id': task_id, **body}, status_code=303, headers=headers)
+
+
+##
+# Expected waits of queued tasks, as server's QueueEstimate.load(): this process's recent snapshot, or one async read
+async def queue_estimate():
+    estimate = QueueEstimate.cached()
+    if estimate is not None:
+        return estimate
+
+    async with aredis.pipeline(transaction=False) as pipe:
+        estimate = QueueEstimate(*await pipe.hgetall(QUEUED_KEY).hgetall(WORKERS_KEY).execute())
+    QueueEstimate.latest = estimate
+    if estimate.stale:
+        await aredis.hdel(QUEUED_KEY, *estimate.stale)
+    return estimate
+
+
+##
+# A task's state and info, as AsyncResult.state and .info would give them, from one async read of the
+# result backend. Tasks with no stored result yet are PENDING
+async def task_meta(task_id):
+    value = await aredis.get(celery.backend.get_key_for_task(task_id))
+    if value is None:
+        return states.PENDING, None
+    return stored_task_meta(value)
+
+
+async def model_post(request):
+    # A body which isn't a JSON object is a bad request, as Flask's get_json() makes it
+    try:
+        data = await request.json()
+    except ValueError:
+        return PlainTextResponse("Bad request: the body must be a JSON object", 400)
+    if not isinstance(data, dict):
+        return PlainTextResponse("Bad request: the body must be a JSON object", 400)
+    log.info(data)
+    if request_landscape_id(data) is None:
+        return PlainTextResponse("Bad request: landscape_id must be an integer, e.g. 101", 400)
+    if input_errors(data):
+        return PlainTextResponse("Bad request: {}".format(input_errors(data)), 400)
+
+    # As the Flask route: cached scenarios are answered without a model run, and known-bad ones rejected.
+    # Estimating the run's cost may train the cost model: not on the event loop
+    try:
+        task = await run_in_threadpool(submit_model_run, data)
+    except QuarantinedError as e:
+        return PlainTextResponse("Unprocessable: this scenario is quarantined after failing the model ({})"
+                                 .format(e), 422, headers={'Retry-After': str(QUARANTINE_TTL)})
+
+    return see_other(request, task.id, expected_wait=(await queue_estimate()).wait_for(task.id))
+
+
+async def model_get(request):
+    result = await aredis.get("flask:{0}:{1}".format('celery_model_get_bau', request.query_params.get('landscape_id')))
+    if not result:
+        log.error('BAU result was not found in Redis store!')
+        return PlainTextResponse("500 Error: Failed to retrieve BAU result", 500)
+
+    return encoded(request, raw=result, cache_key=('bau', hashlib.sha1(result).hexdigest()),
+                   max_age=config['HTTP_CACHE_MAX_AGE'])
+
+
+async def strings_get(request):
+    landscape_id = request.query_params.get('landscape_id')
+    if landscape_id is None:
+        return PlainTextResponse(BAD_LANDSCAPE, 400)
+
+    # Shares its Redis entry with server.cached_task
+    redis_key = "flask:{0}:{1}".format('celery_get_strings', landscape_id)
+    exists = await aredis.get(redis_key)
+    if exists:
+        task_id = pickle.loads(exists).id
+        state, _ = await task_meta(task_id)
+        # As server.cached_task: only a finished task's redirect may be cached
+        if state != states.FAILURE:
+            return see_other(request, task_id,
+                             max_age=config['HTTP_CACHE_MAX_AGE'] if state == states.SUCCESS else None)
+
+    task = await run_in_threadpool(celery.send_task, 'celery_get_strings', kwargs={'landscape_id': landscape_id},
+                                   expires=120, retry_limit=5)
+    await aredis.setex(redis_key, 86400, pickle.dumps(task))
+    return see_other(request, task.id)
+
+
+async def task_status(request):
+    task_id = request.path_params['task_id']
+    state, info = await task_meta(task_id)
+    expected_wait = (await queue_estimate()).wait_for(task_id) if state == states.PENDING else None
+    response = status_body(state, info, expected_wait)
+
+    if state == states.SUCCESS:
+        return encoded(request, response, cache_key=('status', task_id),
+                       max_age=config['HTTP_CACHE_MAX_AGE_RESULTS'])
+    return encoded(request, response)
+
+
+app = Starlette(routes=[
+    Route(prefix + '/model', model_post, methods=['POST']),
+    Route(prefix + '/model', model_get, methods=['GET']),
+    Route(prefix + '/strings', strings_get, methods=['GET']),
+    Route(prefix + '/status/{task_id}', task_status, methods=['GET'], name='task_status'),
+    Mount('', app=WSGIMiddleware(flask_app)),
+], on_shutdown=[aredis.close])
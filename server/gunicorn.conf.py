@@ -0,0 +1,30 @@
+import os
+import sys
+
+# Gunicorn reads this from its working directory. Bind address, workers, etc. are still given on the command line
+# (Dockerfile, docker-compose.yml): this only adds the server hooks.
+
+# Set to 0 where `python bootstrap.py` runs as a separate one-shot job before the web servers start
+BOOTSTRAP_ON_START = os.environ.get('BOOTSTRAP_ON_START', '1') == '1'
+
+
+##
+# Bootstrap once, in the master, before any worker is forked (see bootstrap.py)
+def on_starting(server):
+    if not BOOTSTRAP_ON_START:
+        return
+
+    from bootstrap import bootstrap
+    from config import redis
+    from server import app, pre_calculate_bau
+
+    bootstrap(app, redis, pre_calculate_bau)
+
+
+##
+# Workers forked from a master which imported the app (after on_starting, or with --preload) must not share its
+# database connections
+def post_fork(server, worker):
+    if 'server' in sys.modules:
+        from database import db, dispose_engines
+        dispose_engines(sys.modules['server'].app, db)
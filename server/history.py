@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import zlib
+
+# Storage of session states (the State table).
+#
+# Successive states of a session usually differ by a slider or two, so rather than the whole state, most rows
+# hold the difference from the state before. Every `every`th index (and any state whose predecessor isn't
+# stored) is a full snapshot, so rebuilding a state never reads more than `every` rows. Both are compressed.
+#
+#   encoding   column   contents
+#   NULL       state    the state as JSON text (rows stored before this, or with STATE_STORAGE=json)
+#   z          data     zlib-compressed JSON snapshot
+#   zd         data     zlib-compressed JSON delta from the state at index - 1: {"s": [[path, value], ...],
+#                       "d": [path, ...]}, values set and keys deleted, where a path is the list of dict keys
+#
+# Offline conversion of existing rows, in either direction:
+#   python history.py migrate [--to delta|json] [--every 16] [--batch 200]
+
+SNAPSHOT = 'z'
+DELTA = 'zd'
+
+log = logging.getLogger(__name__)
+
+
+def _same(a, b):
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (list, dict)):
+        return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+    return a == b
+
+
+##
+# Changes from old to new, both dicts: nested dicts are compared key by key, anything else as a whole
+def diff(old, new, path=()):
+    sets, deletes = [], []
+    for key, value in new.items():
+        if key not in old:
+            sets.append([[*path, key], value])
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            s, d = diff(old[key], value, (*path, key))
+            sets.extend(s)
+            deletes.extend(d)
+        elif not _same(old[key], value):
+            sets.append([[*path, key], value])
+    deletes.extend([*path, key] for key in old if key not in new)
+    return sets, deletes
+
+
+def patch(state, delta):
+    state = json.loads(json.dumps(state))
+    for path, value in delta.get('s', []):
+        target = state
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+    for path in delta.get('d', []):
+        target = state
+        for key in path[:-1]:
+            target = target[key]
+        del target[path[-1]]
+    return state
+
+
+def _pack(obj):
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+##
+# Encode a state for storage at index. previous is the stored state at index - 1, if there is one.
+# Returns (encoding, data)
+def encode_state(state, index, previous=None, every=16):
+    if previous is None or index % every == 0 or not isinstance(state, dict) or not isinstance(previous, dict):
+        return SNAPSHOT, _pack(state)
+    sets, deletes = diff(previous, state)
+    return DELTA, _pack({'s': sets, 'd': deletes})
+
+
+##
+# Rebuild stored states from rows with session_id, index, state, encoding and data (State objects, or query rows
+# with those columns). Returns ({(session_id, index): state}, {session IDs whose rows were not all given}):
+# a delta is only rebuilt if every row back to its snapshot is among the rows.
+def rebuild(rows):
+    by_key = {(r.session_id, r.index): r for r in rows}
+    states, incomplete = {}, set()
+
+    for key in sorted(by_key):
+        row = by_key[key]
+        if row.encoding is None:
+            states[key] = json.loads(row.state) if row.state is not None else None
+        elif row.encoding == SNAPSHOT:
+            states[key] = _unpack(row.data)
+        elif row.encoding == DELTA:
+            previous = (key[0], key[1] - 1)
+            if previous in states:
+                states[key] = patch(states[previous], _unpack(row.data))
+            else:
+                incomplete.add(key[0])
+        else:
+            raise ValueError("Unknown state encoding {!r}".format(row.encoding))
+
+    return states, incomplete
+
+
+##
+# Re-encode every state of a session, given as {index: state}. Returns {index: (encoding, data)}, with
+# (None, JSON text) for every row when delta is False
+def encode_session(states, delta=True, every=16):
+    encoded = {}
+    for index in sorted(states):
+        if delta:
+            encoded[index] = encode_state(states[index], index, states.get(index - 1), every)
+        else:
+            encoded[index] = None, json.dumps(states[index])
+    return encoded
+
+
+def migrate(db, State, to='delta', every=16, batch=200):
+    delta = to == 'delta'
+    stored = State.encoding.is_(None) if delta else State.encoding.isnot(None)
+    converted, before, after = 0, 0, 0
+    last = ''
+
+    while True:
+        # Sessions with rows still to convert, in order of session ID
+        sessions = [s for s, in db.session.query(State.session_id).filter(stored, State.session_id > last)
+                    .distinct().order_by(State.session_id).limit(batch)]
+        if not sessions:
+            break
+        last = sessions[-1]
+
+        rows = State.query.filter(State.session_id.in_(sessions)).all()
+        states, incomplete = rebuild(rows)
+        if incomplete:
+            raise ValueError("Sessions {} have deltas without a snapshot".format(sorted(incomplete)))
+
+        for session_id in sessions:
+            session_rows = {r.index: r for r in rows if r.session_id == session_id}
+            encoded = encode_session({i: states[session_id, i] for i in session_rows}, delta, every)
+            for index, row in session_rows.items():
+                before += len(row.data if row.encoding else (row.state or '').encode('utf-8'))
+                encoding, data = encoded[index]
+                row.encoding = encoding
+                row.state, row.data = (None, data) if encoding else (data, None)
+                after += len(data if encoding else data.encode('utf-8'))
+                converted += 1
+
+        db.session.commit()
+        log.info("Converted {} states: {} bytes -> {} bytes".format(converted, before, after))
+
+    return converted, before, after
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert stored session states between JSON and delta storage')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate')
+    migrate_parser.add_argument('--to', choices=['delta', 'json'], default='delta')
+    migrate_parser.add_argument('--every', type=int, default=None,
+                                help='Snapshot interval (default: STATE_SNAPSHOT_EVERY)')
+    migrate_parser.add_argument('--batch', type=int, default=200, help='Sessions per transaction')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    from config import create_app
+    from database import db, State
+
+    app = create_app()
+    db.init_app(app)
+
+    with app.app_context():
+        migrate(db, State, to=args.to, every=args.every or app.config['STATE_SNAPSHOT_EVERY'], batch=args.batch)
@@ -0,0 +1,102 @@
+import logging
+import re
+
+from config import redis
+from database import db, Comments, CommentTags
+
+log = logging.getLogger(__name__)
+
+TAG_INDEX_PREFIX = 'flask:tagindex'
+
+# InnoDB's innodb_ft_min_token_size: shorter words are not in the full-text index
+FULLTEXT_MIN_TOKEN = 3
+
+
+##
+# Inverted index of tag ID -> set of comment IDs (and landscape ID -> comment IDs, for scoping), held as
+# Redis sets so that every gunicorn worker shares it. Multi-tag AND filters become a single SINTER.
+#
+# The index is built from the database on first use, and kept current by post_comment calling add().
+class TagIndex:
+
+    def __init__(self, prefix=TAG_INDEX_PREFIX):
+        self.prefix = prefix
+        self.ready_key = '{}:ready'.format(prefix)
+
+    def tag_key(self, tag_id):
+        return '{}:tag:{}'.format(self.prefix, tag_id)
+
+    def landscape_key(self, landscape_id):
+        return '{}:landscape:{}'.format(self.prefix, landscape_id)
+
+    ##
+    # Build the index if no worker has built it yet. Needs an app context.
+    def ensure(self):
+        if redis.exists(self.ready_key):
+            return
+
+        with redis.lock('{}:lock'.format(self.prefix), timeout=300, blocking_timeout=300):
+            if not redis.exists(self.ready_key):
+                self.rebuild()
+
+    ##
+    # (Re)build the whole index from the Comments and CommentTags tables
+    def rebuild(self):
+        log.info('Building tag index...')
+
+        for pattern in ('{}:tag:*', '{}:landscape:*'):
+            stale = list(redis.scan_iter(match=pattern.format(self.prefix)))
+            if stale:
+                redis.delete(*stale)
+
+        pipe = redis.pipeline(transaction=False)
+        for comment_id, landscape_id in db.session.query(Comments.id, Comments.landscape_id).yield_per(1000):
+            pipe.sadd(self.landscape_key(landscape_id), comment_id)
+        for comment_id, tag_id in db.session.query(CommentTags.comment_id, CommentTags.tag_id).yield_per(1000):
+            pipe.sadd(self.tag_key(tag_id), comment_id)
+        pipe.set(self.ready_key, 1)
+        pipe.execute()
+
+        log.info('Tag index built')
+
+    ##
+    # Add a newly committed comment to the index
+    def add(self, comment_id, landscape_id, tag_ids):
+        pipe = redis.pipeline(transaction=False)
+        pipe.sadd(self.landscape_key(landscape_id), comment_id)
+        for tag_id in tag_ids:
+            pipe.sadd(self.tag_key(tag_id), comment_id)
+        pipe.execute()
+
+    ##
+    # IDs of the comments carrying every one of tag_ids, optionally only those on landscape_id
+    def search(self, tag_ids, landscape_id=None):
+        self.ensure()
+
+        keys = [self.tag_key(t) for t in tag_ids]
+        if landscape_id is not None:
+            keys.append(self.landscape_key(landscape_id))
+
+        return {int(i) for i in redis.sinter(keys)}
+
+
+tag_index = TagIndex()
+
+
+##
+# Boolean-mode AGAINST() expression for a search of the comments' FULLTEXT index: every word of the query is a
+# required prefix, so 'hedge grass' finds comments with words starting 'hedge' and 'grass'. Operators in the
+# query are not passed through, and words too short to be indexed are dropped. Empty if nothing is searchable
+def search_terms(q):
+    return ' '.join('+{}*'.format(w) for w in re.findall(r'\w+', q or '') if len(w) >= FULLTEXT_MIN_TOKEN)
+
+
+##
+# Keyset pagination cursors for search results: the last row's (relevance, id), or its id alone when sorted by id
+def encode_cursor(comment_id, relevance=None):
+    return str(comment_id) if relevance is None else '{!r}:{}'.format(float(relevance), comment_id)
+
+
+def decode_cursor(cursor):
+    relevance, _, comment_id = cursor.rpartition(':')
+    return int(comment_id), float(relevance) if relevance else None
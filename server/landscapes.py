@@ -0,0 +1,148 @@
+import json
+import logging
+import threading
+
+import numpy as np
+
+from model.datafiles import store, DataFileError, LANDSCAPES, SOIL_FIELDS, SOIL_LAYERS, SITE_FIELDS, \
+    MATRIX_LEVELS, WEATHER_COLUMNS
+
+log = logging.getLogger(__name__)
+
+# Summaries only change with the input data, so they are stored under its fingerprint
+SUMMARY_KEY = 'flask:landscape:{}:{}:{}'
+
+PERCENTILES = [0, 5, 25, 50, 75, 95, 100]
+
+# First day of each month in a 365-day year
+MONTH_STARTS = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365])
+
+
+def distribution(values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+    return {
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'percentiles': dict(zip(map(str, PERCENTILES), map(float, np.percentile(values, PERCENTILES))))
+    }
+
+
+##
+# Annual and monthly rainfall and temperature, as distributions across the landscape's weather sets
+def weather_summary(landscape_id):
+    sets, days, locations = store.weather(landscape_id)
+    column = {name: days[:, :, i] for i, name in enumerate(WEATHER_COLUMNS)}
+    mean_temperature = (column['tmin'] + column['tmax']) / 2
+
+    # Totals and means of each month, for each set: shaped (sets, months)
+    n_days = days.shape[1]
+    starts = MONTH_STARTS[MONTH_STARTS < n_days]
+    monthly_rain = np.add.reduceat(column['precipitation'], starts, axis=1)
+    monthly_temperature = np.add.reduceat(mean_temperature, starts, axis=1) / np.diff(np.append(starts, n_days))
+
+    return {
+        'landscape_id': int(landscape_id),
+        'sets': len(sets),
+        'days': n_days,
+        'years': sorted({int(y) for y in np.unique(column['year'])}),
+        'location': {
+            'latitude': distribution(locations[:, 0]),
+            'longitude': distribution(locations[:, 1]),
+            'altitude': distribution(locations[:, 2])
+        },
+        'annual': {
+            'rainfall': distribution(np.nansum(column['precipitation'], axis=1)),
+            'temperature': distribution(np.nanmean(mean_temperature, axis=1)),
+            'tmin': distribution(np.nanmin(column['tmin'], axis=1)),
+            'tmax': distribution(np.nanmax(column['tmax'], axis=1)),
+            'irradiation': distribution(np.nansum(column['irradiation'], axis=1))
+        },
+        'monthly': {
+            'rainfall': [distribution(monthly_rain[:, m]) for m in range(monthly_rain.shape[1])],
+            'temperature': [distribution(monthly_temperature[:, m]) for m in range(monthly_temperature.shape[1])]
+        }
+    }
+
+
+##
+# Soil properties by layer, and site properties. Grids with more than one cell are summarised as distributions
+def soil_summary(landscape_id):
+    def value(grid):
+        grid = np.asarray(grid)
+        return float(grid.ravel()[0]) if grid.size == 1 else distribution(grid.ravel())
+
+    return {
+        'landscape_id': int(landscape_id),
+        'soil': {name: dict(zip(SOIL_LAYERS, (value(layer) for layer in store.field(landscape_id, name))))
+                 for name in SOIL_FIELDS},
+        'site': {name: value(store.field(landscape_id, name)[0]) for name in SITE_FIELDS}
+    }
+
+
+##
+# Crop transition probabilities (rows: previous crop, columns: next crop) and steady-state proportions,
+# by intensity level
+def rotations_summary(landscape_id):
+    levels = {}
+    for level in MATRIX_LEVELS:
+        crops, probabilities = store.probabilities(landscape_id, level)
+        steady_crops, proportions = store.steady_states(landscape_id, level)
+        levels[level] = {
+            'crops': crops,
+            'probabilities': np.asarray(probabilities).tolist(),
+            'steady_states': dict(zip(steady_crops, map(float, proportions)))
+        }
+    return {'landscape_id': int(landscape_id), 'levels': levels}
+
+
+SUMMARIES = {
+    'weather': weather_summary,
+    'soil': soil_summary,
+    'rotations': rotations_summary
+}
+
+
+##
+# JSON summaries of each landscape's input data. Computed at most once per deploy: kept in this process and
+# in Redis (shared with the other workers), under the input data's fingerprint.
+class LandscapeSummaries:
+
+    def __init__(self, client):
+        self.client = client
+        self.summaries = {}
+        self.lock = threading.Lock()
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = store.fingerprint()
+        return self._fingerprint
+
+    ##
+    # A summary as JSON bytes. Raises DataFileError for an unknown landscape or summary
+    def get(self, kind, landscape_id):
+        try:
+            landscape_id = int(landscape_id)
+        except (TypeError, ValueError):
+            raise DataFileError("{} is not a valid Landscape ID".format(landscape_id))
+        if landscape_id not in LANDSCAPES or kind not in SUMMARIES:
+            raise DataFileError("No {} summary for landscape {}".format(kind, landscape_id))
+
+        key = SUMMARY_KEY.format(kind, landscape_id, self.fingerprint)
+        with self.lock:
+            if key in self.summaries:
+                return self.summaries[key]
+
+        summary = self.client.get(key)
+        if summary is None:
+            log.info("Computing {} summary for landscape {}".format(kind, landscape_id))
+            summary = json.dumps(SUMMARIES[kind](landscape_id)).encode('utf-8')
+            self.client.set(key, summary)
+
+        with self.lock:
+            self.summaries[key] = summary
+        return summary
@@ -260,6 +260,30 @@ class CropModel:
 
         self.data.livestockAreas = livestock_areas
 
+    ##
+    # Set crop and livestock areas by name from a {name: area} dict, e.g. a /model POST body.
+    # Every crop and livestock type must be present; other keys are ignored.
+    def set_areas(self, data):
+
+        if not self.initialised:
+            raise CropModelInitException("Model not initialised")
+
+        for i in range(0, self.cropAreas.size()):
+            self.cropAreas[i] = float(data[self.get_crop_string(i).lower()])
+
+        for i in range(0, self.livestockAreas.size()):
+            self.livestockAreas[i] = float(data[self.get_livestock_string(i).lower()])
+
+    ##
+    # Model state and outputs after a run, with the upland grazing props used for area calculations
+    def result(self):
+        result = self.to_dict()
+        result['grazingProps'] = {
+            'lamb': self.get_upland_grazing_lamb_prop(),
+            'beef': self.get_upland_grazing_beef_prop()
+        }
+        return result
+
     ##
     # Get Lowland Area
     def get_lowland_area(self):
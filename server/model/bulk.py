@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Offline bulk scenario runner: runs a file of scenarios across a local process pool, without Redis,
+# Celery or MariaDB, and writes the results to a Parquet dataset.
+#
+# Usage (from server/):
+#   python -m model.bulk scenarios.csv results/ [--landscape 101] [--workers 8] [--resume]
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+log = logging.getLogger(__name__)
+
+# Model outputs written for each scenario: single values, and lists of values
+SCALAR_OUTPUTS = ['greenhouseGasEmissions', 'nLeach', 'profit', 'production']
+LIST_OUTPUTS = ['pesticideImpacts', 'nutritionaldelivery', 'healthRiskFactors']
+
+# Initialised models in this worker process, by landscape ID. The model library isn't thread-safe and
+# initialisation is slow, so each process keeps one model per landscape and runs its scenarios in turn.
+_models = {}
+
+
+##
+# Read scenarios from CSV, NDJSON (.ndjson/.jsonl) or Parquet. Each scenario is a {name: value} dict of
+# crop and livestock areas, optionally with a landscape_id.
+def read_scenarios(path):
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.csv':
+        with open(path, newline='') as file:
+            return list(csv.DictReader(file))
+    elif extension in ('.ndjson', '.jsonl'):
+        with open(path) as file:
+            return [json.loads(line) for line in file if line.strip()]
+    elif extension in ('.parquet', '.pq'):
+        return pq.read_table(path).to_pylist()
+
+    raise ValueError("Unsupported scenario file {}: use .csv, .ndjson/.jsonl or .parquet".format(path))
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _model(landscape_id):
+    from model.CropModel import CropModel
+
+    if landscape_id not in _models:
+        model = CropModel()
+        model.set_landscape_id(landscape_id)
+        model.initialise_model()
+        _models[landscape_id] = model
+    return _models[landscape_id]
+
+
+##
+# Run a chunk of (row, landscape_id, scenario) jobs in a worker process.
+# Returns one output record per job; failed scenarios have their error set and no outputs.
+def run_chunk(jobs):
+    import cppyy
+    from model.CropModel import CropModelException
+
+    records = []
+    for row, landscape_id, data in jobs:
+        record = {'row': row, 'landscape_id': landscape_id, 'error': None}
+        try:
+            model = _model(landscape_id)
+            model.set_areas(data)
+            model.run_model()
+            result = model.result()
+
+            record.update({k: result[k] for k in SCALAR_OUTPUTS + LIST_OUTPUTS})
+            record['errorFlag'] = result['errorFlag']
+            record['grazingLambProp'] = result['grazingProps']['lamb']
+            record['grazingBeefProp'] = result['grazingProps']['beef']
+        except (CropModelException,
+                cppyy.gbl.std.exception,
+                cppyy.gbl.std.invalid_argument,
+                KeyError,
+                ValueError) as e:
+            record['error'] = str(e)
+            # Don't let a failed run leave its state behind for the next scenario
+            _models.pop(landscape_id, None)
+        records.append(record)
+    return records
+
+
+##
+# Results are written as a directory of Parquet files (part-NNNNN.parquet), one row group each, so they
+# can be read back as one dataset, e.g. pandas.read_parquet(path). Each part is complete on disk before
+# it becomes visible, so after a crash --resume skips every row already written.
+class ResultWriter:
+
+    def __init__(self, path, input_names, resume=False):
+        self.path = path
+        self.schema = pa.schema(
+            [('row', pa.int64()), ('landscape_id', pa.int64())] +
+            [(name, pa.float64()) for name in input_names] +
+            [(name, pa.float64()) for name in SCALAR_OUTPUTS] +
+            [(name, pa.list_(pa.float64())) for name in LIST_OUTPUTS] +
+            [('errorFlag', pa.int64()), ('grazingLambProp', pa.float64()), ('grazingBeefProp', pa.float64()),
+             ('error', pa.string())])
+
+        os.makedirs(path, exist_ok=True)
+        parts = sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+        if parts and not resume:
+            raise FileExistsError("{} already holds results: use --resume to continue".format(path))
+
+        self.done = set()
+        for part in parts:
+            self.done.update(pq.read_table(part, columns=['row']).column('row').to_pylist())
+        self.parts = len(parts)
+
+    def write(self, records):
+        table = pa.Table.from_pylist(sorted(records, key=lambda r: r['row']), schema=self.schema)
+        name = os.path.join(self.path, 'part-{:05d}.parquet'.format(self.parts))
+        pq.write_table(table, name + '.tmp')
+        os.replace(name + '.tmp', name)
+
+        self.parts += 1
+        self.done.update(r['row'] for r in records)
+
+
+##
+# Run every scenario not already in the output, flushing a row group every flush_every results.
+# Returns the number of scenarios which failed.
+def run(scenarios, output, landscape_id=None, workers=None, chunk_size=16, flush_every=1000, resume=False):
+    input_names = sorted({k for s in scenarios for k in s if k != 'landscape_id'})
+    writer = ResultWriter(output, input_names, resume)
+
+    jobs = []
+    for row, scenario in enumerate(scenarios):
+        if row in writer.done:
+            continue
+        job_landscape = int(scenario.get('landscape_id') or landscape_id or 0)
+        if not job_landscape:
+            raise ValueError("Scenario {} has no landscape_id, and no --landscape was given".format(row))
+        jobs.append((row, job_landscape, {k: v for k, v in scenario.items() if k != 'landscape_id'}))
+
+    log.info("{} of {} scenarios to run".format(len(jobs), len(scenarios)))
+    jobs_by_row = {row: data for row, _, data in jobs}
+
+    # Grouping by landscape means a worker's chunk rarely needs a second model initialised
+    jobs.sort(key=lambda job: (job[1], job[0]))
+    chunks = [jobs[start:start + chunk_size] for start in range(0, len(jobs), chunk_size)]
+    chunks.reverse()
+
+    workers = workers or os.cpu_count()
+    unflushed = []
+    failed = 0
+    completed = 0
+
+    # Spawn rather than fork: workers load the model library themselves, and never inherit pyarrow's threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        pending = set()
+        try:
+            while chunks or pending:
+                while chunks and len(pending) < workers * 2:
+                    pending.add(pool.submit(run_chunk, chunks.pop()))
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    records = future.result()
+                    for record in records:
+                        record.update({k: _float(v) for k, v in jobs_by_row[record['row']].items()})
+                    failed += sum(1 for r in records if r['error'] is not None)
+                    completed += len(records)
+                    unflushed.extend(records)
+
+                if len(unflushed) >= flush_every:
+                    writer.write(unflushed)
+                    unflushed = []
+                    log.info("{} of {} scenarios done".format(completed, len(jobs)))
+        except BrokenProcessPool:
+            log.error("A worker process died: rerun with --resume to continue from the last completed row")
+            raise
+        finally:
+            # Keep whatever completed, so a crash or Ctrl-C loses as little as possible
+            if unflushed:
+                writer.write(unflushed)
+
+    log.info("{} scenarios done, {} failed".format(completed, failed))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a file of crop model scenarios on this machine')
+    parser.add_argument('scenarios', help='Scenario file: .csv, .ndjson/.jsonl or .parquet')
+    parser.add_argument('output', help='Output directory for the Parquet dataset')
+    parser.add_argument('--landscape', type=int, help='Landscape ID for scenarios without a landscape_id')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=16, help='Scenarios per job sent to a worker')
+    parser.add_argument('--flush-every', type=int, default=1000, help='Results per Parquet row group')
+    parser.add_argument('--resume', action='store_true', help='Skip scenarios already in the output')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    failures = run(read_scenarios(args.scenarios), args.output, landscape_id=args.landscape,
+                   workers=args.workers, chunk_size=args.chunk_size, flush_every=args.flush_every,
+                   resume=args.resume)
+    raise SystemExit(1 if failures else 0)
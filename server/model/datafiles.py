@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# Parsed, checksummed cache of the model's input data (FieldStats and Weather).
+#
+# The text files are parsed once into NumPy arrays, which are saved as .npy files and then memory-mapped, so
+# analysis code, notebooks and endpoints share one read-only copy without parsing anything again. Each cached
+# array records the size, mtime and SHA-256 of the files it was parsed from: it is rebuilt when they change,
+# and `verify` checks both the sources and the arrays themselves against their checksums.
+#
+# Usage (from server/):
+#   python -m model.datafiles build|verify
+#   python -m model.datafiles stage [--target /dev/shm/tgrains] [--link /FieldStats --link /Weather]
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+
+import numpy as np
+
+my_path = os.path.abspath(os.path.dirname(__file__))
+
+
+##
+# Data directories: where the Docker image puts them, or else the copies in this repository
+def _data_dir(env, name):
+    return os.environ.get(env) or ('/' + name if os.path.isdir('/' + name) else os.path.join(my_path, name))
+
+
+FIELDSTATS_DIR = _data_dir('FIELDSTATS_DIR', 'FieldStats')
+WEATHER_DIR = _data_dir('WEATHER_DIR', 'Weather')
+CACHE_DIR = os.environ.get('MODEL_DATA_CACHE', os.path.join(my_path, '.cache'))
+
+# Landscape ID: (FieldStats directory, Weather directory, weather file prefix, matrix file suffix)
+LANDSCAPES = {
+    101: ('1x1_TGRAINS_EA', 'W_TGRAINS_EA', 'WHWG', 'EA'),
+    102: ('1x1_TGRAINS_SW', 'W_TGRAINS_SW', 'CNWG', 'SW'),
+}
+
+# Single-value grids: soil properties (shallow, mid and deep layers), and site properties
+SOIL_FIELDS = ['AvP', 'BulkD', 'Clay', 'NAvP', 'NH4', 'Nit', 'SOC', 'Silt', 'SoilDepth', 'Stones', 'pH']
+SITE_FIELDS = ['Elevation', 'Latitude', 'Weather']
+SOIL_LAYERS = ['shallow', 'mid', 'deep']
+
+# Crop rotation matrices, by intensity: high, low, medium
+MATRIX_LEVELS = ['H', 'L', 'M']
+MATRIX_PATTERN = '{kind}-permagrass-fruit+others_{suffix}_{level}.txt'
+
+# Daily weather columns of a .met file. -9999 (nil) is stored as NaN
+WEATHER_COLUMNS = ['station', 'year', 'day', 'irradiation', 'tmin', 'tmax', 'vapour_pressure', 'wind',
+                   'precipitation', 'sunshine']
+WEATHER_NIL = -9999.0
+
+_LOCATION = re.compile(r'Latitude:\s*(\S+)\s+Longitude:\s*(\S+)\s+Altitude:\s*(\S+)')
+
+
+class DataFileError(ValueError):
+    pass
+
+
+def _float(token):
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+
+# ==================
+# Parsers
+
+##
+# Parse a weather .met file. Returns (daily values with a row per day and a column per WEATHER_COLUMNS,
+# [latitude, longitude, altitude]).
+def parse_met(path):
+    rows, location = [], None
+    # Units in the header use a Latin-1 degree sign
+    with open(path, encoding='latin-1') as file:
+        for line in file:
+            if line.startswith('*'):
+                match = _LOCATION.search(line)
+                if match:
+                    location = [float(v) for v in match.groups()]
+                continue
+            values = [_float(t) for t in line.split()]
+            if len(values) == len(WEATHER_COLUMNS) and None not in values:
+                rows.append(values)
+
+    if not rows:
+        raise DataFileError("{}: no daily weather rows".format(path))
+    if location is None:
+        raise DataFileError("{}: no Latitude/Longitude/Altitude header".format(path))
+
+    days = np.array(rows, dtype=np.float64)
+    if not np.array_equal(days[:, 2], np.arange(1, len(days) + 1)):
+        raise DataFileError("{}: days are not consecutive from 1".format(path))
+    days[days == WEATHER_NIL] = np.nan
+    return days, np.array(location)
+
+
+##
+# Parse a FieldStats grid: a description line, the number of rows and columns, then each layer's values
+# (soil files label their second and third layers 'mid' and 'deep', and some end in // comments). Where the
+# description says so, a cell size precedes the values. Returns an array shaped (layers, rows, cols).
+def parse_grid(path):
+    with open(path, encoding='latin-1') as file:
+        description = next(file)
+        text = ' '.join(line.split('//')[0] for line in file)
+    tokens = [v for v in (_float(t) for t in text.split()) if v is not None]
+
+    if len(tokens) < 3:
+        raise DataFileError("{}: too few values for a grid".format(path))
+
+    rows, cols, values = int(tokens[0]), int(tokens[1]), tokens[2:]
+    cells = rows * cols
+    if 'size of cell' in description and len(values) > cells and (len(values) - 1) % cells == 0:
+        values = values[1:]
+    if not values or len(values) % cells:
+        raise DataFileError("{}: {} values don't fill {}x{} layers".format(path, len(values), rows, cols))
+
+    return np.array(values, dtype=np.float64).reshape(-1, rows, cols)
+
+
+##
+# Parse a quoted, labelled matrix: a header row of column names, then a label and values per row.
+# Returns (row labels, column labels, values).
+def parse_matrix(path):
+    with open(path, encoding='latin-1') as file:
+        lines = [line.split() for line in file if line.strip()]
+
+    columns = [c.strip('"') for c in lines[0][1:]]
+    labels = [line[0].strip('"') for line in lines[1:]]
+    try:
+        values = np.array([[float(v) for v in line[1:]] for line in lines[1:]], dtype=np.float64)
+    except ValueError as e:
+        raise DataFileError("{}: {}".format(path, e))
+
+    if values.ndim != 2 or values.shape[1] != len(columns):
+        raise DataFileError("{}: rows don't match the {} header columns".format(path, len(columns)))
+    return labels, columns, values
+
+
+# ==================
+# Validation
+
+def _check_probabilities(path, labels, columns, values):
+    if labels != columns:
+        raise DataFileError("{}: row and column crops differ".format(path))
+    if np.any(values < 0) or np.any(values > 1):
+        raise DataFileError("{}: probabilities outside [0, 1]".format(path))
+
+
+def _check_steady_states(path, labels, columns, values):
+    if columns != ['prop']:
+        raise DataFileError("{}: expected a single 'prop' column".format(path))
+    if np.any(values < 0) or not np.isclose(values.sum(), 1.0, atol=1e-3):
+        raise DataFileError("{}: proportions don't sum to 1".format(path))
+
+
+def _check_weather(path, days):
+    if np.any(days[:, WEATHER_COLUMNS.index('tmin')] > days[:, WEATHER_COLUMNS.index('tmax')] + 1e-9):
+        raise DataFileError("{}: minimum temperature above maximum".format(path))
+    if np.any(days[:, WEATHER_COLUMNS.index('precipitation')] < 0):
+        raise DataFileError("{}: negative precipitation".format(path))
+
+
+# ==================
+# Cache
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+##
+# The cache of parsed arrays. Each entry is a set of .npy files plus a manifest of the sources they were
+# parsed from, and their checksums. Arrays are returned memory-mapped and read-only.
+class DataStore:
+
+    def __init__(self, cache_dir=CACHE_DIR, fieldstats_dir=FIELDSTATS_DIR, weather_dir=WEATHER_DIR):
+        self.cache_dir = cache_dir
+        self.fieldstats_dir = fieldstats_dir
+        self.weather_dir = weather_dir
+        self.loaded = {}
+        self.checksums = {}
+        self.lock = threading.Lock()
+
+    def manifest_path(self, name):
+        return os.path.join(self.cache_dir, name, 'manifest.json')
+
+    def read_manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    ##
+    # Up to date if every source still has the size and mtime it had when parsed
+    def fresh(self, manifest, sources):
+        if manifest is None or sorted(manifest['sources']) != sorted(sources):
+            return False
+        try:
+            return all(_stamp(path) == manifest['sources'][path]['stamp'] for path in sources)
+        except OSError:
+            return False
+
+    ##
+    # Parse and save an entry. Arrays are written to a temporary directory which replaces the old entry
+    # once complete, so readers never see a half-written cache
+    def write(self, name, sources, arrays, meta):
+        final = os.path.join(self.cache_dir, name)
+        temporary = final + '.tmp.{}'.format(os.getpid())
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+
+        checksums = {}
+        for key, array in arrays.items():
+            np.save(os.path.join(temporary, key + '.npy'), np.ascontiguousarray(array))
+            checksums[key] = _sha256(os.path.join(temporary, key + '.npy'))
+
+        with open(os.path.join(temporary, 'manifest.json'), 'w') as file:
+            json.dump({
+                'sources': {path: {'stamp': _stamp(path), 'sha256': _sha256(path)} for path in sources},
+                'arrays': checksums,
+                'meta': meta
+            }, file)
+
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(temporary, final)
+
+    ##
+    # Arrays and metadata of an entry, (re)building it with parse() -> (arrays, meta) if it is missing or stale
+    def entry(self, name, sources, parse):
+        with self.lock:
+            if name in self.loaded:
+                return self.loaded[name]
+
+            manifest = self.read_manifest(name)
+            if not self.fresh(manifest, sources):
+                arrays, meta = parse()
+                self.write(name, sources, arrays, meta)
+                manifest = self.read_manifest(name)
+
+            arrays = {key: np.load(os.path.join(self.cache_dir, name, key + '.npy'), mmap_mode='r')
+                      for key in manifest['arrays']}
+            self.loaded[name] = (arrays, manifest['meta'])
+            self.checksums[name] = sorted(source['sha256'] for source in manifest['sources'].values())
+            return self.loaded[name]
+
+    def landscape(self, landscape_id):
+        try:
+            return LANDSCAPES[int(landscape_id)]
+        except (KeyError, ValueError):
+            raise DataFileError("{} is not a valid Landscape ID".format(landscape_id))
+
+    ##
+    # Daily weather of every weather set for a landscape. Returns (set numbers, values shaped
+    # (sets, days, len(WEATHER_COLUMNS)), locations shaped (sets, 3) as latitude, longitude, altitude)
+    def weather(self, landscape_id):
+        _, weather_dir, prefix, _ = self.landscape(landscape_id)
+        sources = sorted(glob.glob(os.path.join(self.weather_dir, weather_dir, prefix + '.*')))
+        if not sources:
+            raise DataFileError("No weather files for landscape {}".format(landscape_id))
+
+        def parse():
+            days, locations = [], []
+            for path in sources:
+                values, location = parse_met(path)
+                _check_weather(path, values)
+                days.append(values)
+                locations.append(location)
+            if len({len(d) for d in days}) != 1:
+                raise DataFileError("Weather files for landscape {} differ in length".format(landscape_id))
+            numbers = np.array([int(os.path.splitext(p)[1][1:]) for p in sources])
+            return {'sets': numbers, 'days': np.stack(days), 'locations': np.array(locations)}, {}
+
+        arrays, _ = self.entry('weather-{}'.format(landscape_id), sources, parse)
+        return arrays['sets'], arrays['days'], arrays['locations']
+
+    ##
+    # A FieldStats grid for a landscape, shaped (layers, rows, cols)
+    def field(self, landscape_id, name):
+        if name not in SOIL_FIELDS + SITE_FIELDS:
+            raise DataFileError("Unknown field {}".format(name))
+        path = os.path.join(self.fieldstats_dir, self.landscape(landscape_id)[0], name + '.txt')
+
+        def parse():
+            grid = parse_grid(path)
+            if name in SOIL_FIELDS and len(grid) != len(SOIL_LAYERS):
+                raise DataFileError("{}: expected {} soil layers".format(path, len(SOIL_LAYERS)))
+            return {'grid': grid}, {}
+
+        arrays, _ = self.entry('field-{}-{}'.format(landscape_id, name), [path], parse)
+        return arrays['grid']
+
+    def matrix(self, landscape_id, kind, level, check):
+        if level not in MATRIX_LEVELS:
+            raise DataFileError("Unknown level {}".format(level))
+        directory, _, _, suffix = self.landscape(landscape_id)
+        path = os.path.join(self.fieldstats_dir, directory, MATRIX_PATTERN.format(kind=kind, suffix=suffix,
+                                                                                   level=level))
+
+        def parse():
+            labels, columns, values = parse_matrix(path)
+            check(path, labels, columns, values)
+            return {'values': values}, {'labels': labels, 'columns': columns}
+
+        arrays, meta = self.entry('{}-{}-{}'.format(kind, landscape_id, level), [path], parse)
+        return meta['labels'], arrays['values']
+
+    ##
+    # Crop transition probabilities: (crops, matrix with a row per previous crop and a column per next crop)
+    def probabilities(self, landscape_id, level):
+        return self.matrix(landscape_id, 'probabilities', level, _check_probabilities)
+
+    ##
+    # Steady-state crop proportions: (crops, proportions)
+    def steady_states(self, landscape_id, level):
+        labels, values = self.matrix(landscape_id, 'steadystates', level, _check_steady_states)
+        return labels, values[:, 0]
+
+    ##
+    # Build (or refresh) every entry
+    def build(self):
+        for landscape_id in LANDSCAPES:
+            self.weather(landscape_id)
+            for name in SOIL_FIELDS + SITE_FIELDS:
+                self.field(landscape_id, name)
+            for level in MATRIX_LEVELS:
+                self.probabilities(landscape_id, level)
+                self.steady_states(landscape_id, level)
+
+    ##
+    # Identifies the current input data: changes whenever any source file does
+    def fingerprint(self):
+        self.build()
+        with self.lock:
+            return hashlib.sha1(json.dumps(sorted(self.checksums.items())).encode('utf-8')).hexdigest()
+
+    ##
+    # Check every cached entry's sources and arrays against their checksums. Returns a list of problems
+    def verify(self):
+        problems = []
+        for manifest_path in sorted(glob.glob(os.path.join(self.cache_dir, '*', 'manifest.json'))):
+            directory = os.path.dirname(manifest_path)
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            for path, source in manifest['sources'].items():
+                if not os.path.exists(path) or _sha256(path) != source['sha256']:
+                    problems.append("{}: source {} has changed".format(os.path.basename(directory), path))
+            for key, checksum in manifest['arrays'].items():
+                if _sha256(os.path.join(directory, key + '.npy')) != checksum:
+                    problems.append("{}: {}.npy is corrupt".format(os.path.basename(directory), key))
+        return problems
+
+
+##
+# Copy the data directories to a RAM-backed target (e.g. /dev/shm) for the model library, skipping files
+# which are already there with the same size and mtime. Each of `links` (e.g. /FieldStats) is pointed at
+# its staged copy, but only if it is a symlink already or doesn't exist: real directories are left alone.
+def stage(target='/dev/shm/tgrains', links=(), fieldstats_dir=FIELDSTATS_DIR, weather_dir=WEATHER_DIR):
+    staged = {}
+    for source in (fieldstats_dir, weather_dir):
+        destination = os.path.join(target, os.path.basename(os.path.normpath(source)))
+        for root, _, names in os.walk(source):
+            out = os.path.join(destination, os.path.relpath(root, source))
+            os.makedirs(out, exist_ok=True)
+            for name in names:
+                src, dst = os.path.join(root, name), os.path.join(out, name)
+                if not os.path.exists(dst) or _stamp(src) != _stamp(dst):
+                    shutil.copy2(src, dst)
+        staged[os.path.basename(os.path.normpath(source))] = destination
+
+    for link in links:
+        destination = staged.get(os.path.basename(os.path.normpath(link)))
+        if destination is None:
+            raise DataFileError("{} doesn't match a staged directory".format(link))
+        if os.path.islink(link):
+            os.remove(link)
+        elif os.path.exists(link):
+            raise DataFileError("{} is a real directory: not replacing it".format(link))
+        os.symlink(destination, link)
+
+    return staged
+
+
+# Shared by everything in this process
+store = DataStore()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parsed cache of the crop model input data')
+    parser.add_argument('command', choices=['build', 'verify', 'stage'])
+    parser.add_argument('--target', default='/dev/shm/tgrains', help='Where to stage the data (stage)')
+    parser.add_argument('--link', action='append', default=[], help='Symlink to the staged copy (stage)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        store.build()
+        print("Built data cache in {}".format(store.cache_dir))
+    elif args.command == 'verify':
+        errors = store.verify()
+        print("\n".join(errors) if errors else "Data cache OK")
+        raise SystemExit(1 if errors else 0)
+    else:
+        for name, path in stage(args.target, args.link).items():
+            print("Staged {} at {}".format(name, path))
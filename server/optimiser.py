@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+
+import numpy as np
+
+from batch import evaluate, landscape_inputs
+
+log = logging.getLogger(__name__)
+
+# Objectives, and whether each is minimised (1) or maximised (-1). nutritionaldelivery is each food
+# group's share of the calories delivered, so it sums to one; the calories themselves are `production`.
+OBJECTIVES = [('greenhouseGasEmissions', 1), ('nLeach', 1), ('profit', -1), ('production', -1)]
+
+# Redis keys for the optimiser's checkpoint and front
+CHECKPOINT_KEY = 'flask:optimiser:{}:checkpoint'
+FRONT_KEY = 'flask:optimiser:{}:front'
+
+
+##
+# Constrained domination: a feasible solution beats an infeasible one; otherwise a solution dominates if it is
+# no worse on every objective and better on at least one
+def dominates(fa, va, fb, vb):
+    if va != vb:
+        return va < vb
+    return bool(np.all(fa <= fb) and np.any(fa < fb))
+
+
+##
+# NSGA-II fast non-dominated sort. Returns a list of fronts, each a list of indices into f
+def non_dominated_sort(f, violation):
+    n = len(f)
+    dominated = [[] for _ in range(n)]
+    counts = [0] * n
+
+    for p in range(n):
+        for q in range(p + 1, n):
+            if dominates(f[p], violation[p], f[q], violation[q]):
+                dominated[p].append(q)
+                counts[q] += 1
+            elif dominates(f[q], violation[q], f[p], violation[p]):
+                dominated[q].append(p)
+                counts[p] += 1
+
+    fronts = [[i for i in range(n) if counts[i] == 0]]
+    while fronts[-1]:
+        following = []
+        for p in fronts[-1]:
+            for q in dominated[p]:
+                counts[q] -= 1
+                if counts[q] == 0:
+                    following.append(q)
+        fronts.append(following)
+    return fronts[:-1]
+
+
+##
+# NSGA-II crowding distance of each member of a front. Extremes get infinity so they are always kept
+def crowding_distance(f, front):
+    distance = np.zeros(len(front))
+    if len(front) <= 2:
+        distance[:] = np.inf
+        return distance
+
+    values = f[front]
+    for m in range(values.shape[1]):
+        order = np.argsort(values[:, m])
+        distance[order[0]] = distance[order[-1]] = np.inf
+        span = values[order[-1], m] - values[order[0], m]
+        if span > 0:
+            distance[order[1:-1]] += (values[order[2:], m] - values[order[:-2], m]) / span
+    return distance
+
+
+##
+# NSGA-II search over a landscape's crop and livestock areas.
+#
+# Each generation's offspring are evaluated as one batch across the Celery workers (see batch.py), so
+# scenarios already in the result cache cost nothing. The population is checkpointed to Redis after each
+# generation and the current first front is stored for display, so a run can be resumed or watched.
+class Optimiser:
+
+    def __init__(self, celery, client, landscape_id, names, bau, max_crop_area, max_upland_area, n_crops,
+                 population=40, chunk_size=8, seed=None):
+        self.celery = celery
+        self.client = client
+        self.landscape_id = landscape_id
+        self.names = names
+        self.bau = np.array(bau, dtype=np.float64)
+        self.max_crop_area = max_crop_area
+        self.max_upland_area = max_upland_area
+        self.n_crops = n_crops
+        self.population = population
+        self.chunk_size = chunk_size
+
+        # Any crop may take up to the landscape's crop area, and any livestock its upland area, whether or not
+        # the landscape has any of it today
+        self.lower = np.zeros(len(names))
+        self.upper = np.array([max_crop_area] * n_crops + [max_upland_area] * (len(names) - n_crops),
+                              dtype=np.float64)
+        self.rng = np.random.default_rng(seed)
+
+        self.generation = 0
+        self.x = None
+        self.f = None
+        self.violation = None
+        self.results = None
+
+    ##
+    # Keep genomes inside their bounds, and the total crop area within the landscape's maximum
+    def repair(self, x):
+        x = np.clip(x, self.lower, self.upper)
+        crops = x[:, :self.n_crops].sum(axis=1)
+        over = crops > self.max_crop_area
+        x[over, :self.n_crops] *= (self.max_crop_area / crops[over])[:, None]
+        return x
+
+    def evaluate(self, x):
+        scenarios = [{'landscape_id': self.landscape_id, **dict(zip(self.names, map(float, row)))} for row in x]
+        results = evaluate(self.celery, self.client, self.landscape_id, scenarios, chunk_size=self.chunk_size)
+
+        f = np.zeros((len(x), len(OBJECTIVES)))
+        violation = np.zeros(len(x))
+        for i, result in enumerate(results):
+            if result is None or result.get('errorFlag', 0) != 0:
+                violation[i] = 1
+            else:
+                f[i] = [sign * result[key] for key, sign in OBJECTIVES]
+        return f, violation, results
+
+    ##
+    # Rank and crowding distance for every member of a population
+    def rank(self, f, violation):
+        rank = np.zeros(len(f), dtype=int)
+        crowding = np.zeros(len(f))
+        for r, front in enumerate(non_dominated_sort(f, violation)):
+            rank[front] = r
+            crowding[front] = crowding_distance(f, front)
+        return rank, crowding
+
+    ##
+    # Binary tournament on (rank, crowding), simulated binary crossover and polynomial mutation
+    def offspring(self, eta_c=15.0, eta_m=20.0, p_crossover=0.9):
+        rank, crowding = self.rank(self.f, self.violation)
+        n, d = self.x.shape
+
+        a, b = self.rng.integers(n, size=(2, n))
+        better = (rank[a] < rank[b]) | ((rank[a] == rank[b]) & (crowding[a] > crowding[b]))
+        parents = self.x[np.where(better, a, b)]
+
+        children = parents.copy()
+        for i in range(0, n - 1, 2):
+            if self.rng.random() > p_crossover:
+                continue
+            u = self.rng.random(d)
+            beta = np.where(u <= 0.5, (2 * u) ** (1 / (eta_c + 1)), (1 / (2 * (1 - u))) ** (1 / (eta_c + 1)))
+            p1, p2 = parents[i], parents[i + 1]
+            children[i] = 0.5 * ((1 + beta) * p1 + (1 - beta) * p2)
+            children[i + 1] = 0.5 * ((1 - beta) * p1 + (1 + beta) * p2)
+
+        span = self.upper - self.lower
+        mutate = self.rng.random((n, d)) < 1.0 / d
+        u = self.rng.random((n, d))
+        delta = np.where(u < 0.5, (2 * u) ** (1 / (eta_m + 1)) - 1, 1 - (2 * (1 - u)) ** (1 / (eta_m + 1)))
+        children = children + mutate * delta * span
+
+        return self.repair(children)
+
+    ##
+    # Environmental selection: whole fronts in rank order, the last one cut by crowding distance
+    def select(self, x, f, violation, results):
+        chosen = []
+        for front in non_dominated_sort(f, violation):
+            if len(chosen) + len(front) <= self.population:
+                chosen.extend(front)
+            else:
+                crowding = crowding_distance(f, front)
+                order = np.argsort(-crowding)
+                chosen.extend([front[i] for i in order[:self.population - len(chosen)]])
+                break
+
+        self.x, self.f, self.violation = x[chosen], f[chosen], violation[chosen]
+        self.results = [results[i] for i in chosen]
+
+    ##
+    # Start from BAU and random allocations across the bounds
+    def initialise(self):
+        x = self.rng.uniform(self.lower, self.upper, size=(self.population, len(self.names)))
+        x[0] = self.bau
+        x = self.repair(x)
+        f, violation, results = self.evaluate(x)
+        self.x, self.f, self.violation, self.results = x, f, violation, results
+
+    def step(self):
+        children = self.offspring()
+        f, violation, results = self.evaluate(children)
+        self.select(np.vstack([self.x, children]),
+                    np.vstack([self.f, f]),
+                    np.concatenate([self.violation, violation]),
+                    self.results + results)
+        self.generation += 1
+
+    def checkpoint(self):
+        self.client.set(CHECKPOINT_KEY.format(self.landscape_id), json.dumps({
+            'generation': self.generation,
+            'x': self.x.tolist(),
+            'results': self.results,
+            'rng': self.rng.bit_generator.state
+        }))
+
+    ##
+    # Resume from the landscape's checkpoint. Returns False if there is none
+    def resume(self):
+        checkpoint = self.client.get(CHECKPOINT_KEY.format(self.landscape_id))
+        if not checkpoint:
+            return False
+
+        checkpoint = json.loads(checkpoint)
+        self.generation = checkpoint['generation']
+        self.x = np.array(checkpoint['x'])
+        self.rng.bit_generator.state = checkpoint['rng']
+
+        # Results of the population are cached, so re-evaluating it is cheap
+        self.f, self.violation, self.results = self.evaluate(self.x)
+        return True
+
+    ##
+    # Store the current first front for display by GET /optimise
+    def store_front(self, generations):
+        front = [i for i in non_dominated_sort(self.f, self.violation)[0] if self.violation[i] == 0]
+        self.client.set(FRONT_KEY.format(self.landscape_id), json.dumps({
+            'landscape_id': self.landscape_id,
+            'generation': self.generation,
+            'generations': generations,
+            'complete': self.generation >= generations,
+            'objectives': [key for key, sign in OBJECTIVES],
+            'front': [{
+                'inputs': dict(zip(self.names, map(float, self.x[i]))),
+                'result': self.results[i]
+            } for i in front]
+        }))
+
+    def run(self, generations, resume=False):
+        if not (resume and self.resume()):
+            self.initialise()
+            self.checkpoint()
+            self.store_front(generations)
+
+        while self.generation < generations:
+            self.step()
+            self.checkpoint()
+            self.store_front(generations)
+            log.info("Generation {} of {} done for landscape {}".format(self.generation, generations,
+                                                                         self.landscape_id))
+
+
+##
+# Set up an optimiser for a landscape from its BAU record and crop/livestock strings
+def make_optimiser(celery, client, landscape_id, **kwargs):
+    names, areas, n_crops, bau = landscape_inputs(celery, client, landscape_id)
+
+    return Optimiser(celery, client, landscape_id,
+                     names=names,
+                     bau=areas,
+                     max_crop_area=bau['maxCropArea'],
+                     max_upland_area=bau['maxUplandArea'],
+                     n_crops=n_crops,
+                     **kwargs)
+
+
+if __name__ == "__main__":
+    from config import redis, create_app, make_celery
+
+    parser = argparse.ArgumentParser(description='Search for Pareto-optimal crop and livestock allocations')
+    parser.add_argument('--landscape', type=int, required=True, help='Landscape ID, e.g. 101')
+    parser.add_argument('--population', type=int, default=40)
+    parser.add_argument('--generations', type=int, default=30)
+    parser.add_argument('--chunk-size', type=int, default=8, help='Scenarios per Celery task')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    app = create_app()
+    celery = make_celery(app)
+
+    with app.app_context():
+        optimiser = make_optimiser(celery, redis, args.landscape, population=args.population,
+                                   chunk_size=args.chunk_size, seed=args.seed)
+        optimiser.run(args.generations, resume=args.resume)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from batch import iter_batch
+from emulator import CostModel
+from history import rebuild
+from tasks.results import canonical_inputs, input_hash, cached_results, load_runs
+from tasks.schedule import setup_costs
+
+log = logging.getLogger(__name__)
+
+# Statistics from the last prewarm of each landscape
+STATS_KEY = 'flask:prewarm:stats'
+
+# Celery's Redis transport keeps the default (highest) priority in the plain queue, and lower priorities in
+# separate lists. Interactive runs are sent at priorities above the prewarm's, by their expected cost (see
+# tasks/schedule.py), so these lists are all empty when they're idle.
+PREWARM_PRIORITY = 9
+INTERACTIVE_QUEUES = ['celery'] + ['celery:{}'.format(p) for p in range(1, PREWARM_PRIORITY)]
+
+
+##
+# Mine stored session states for the distinct scenarios worth prewarming, per landscape.
+#
+# Each state contributes 0.5 ** (age / half_life) to its scenario's score, so scenarios which recur across
+# many sessions (defaults, presets, forks) and those explored recently both rank highly. Returns
+# {landscape_id: [(score, scenario), ...]}, best first.
+#
+# A state's landscape comes from the state itself if stored there, or else from a comment on its session.
+# States whose landscape can't be found are skipped.
+def mine_states(db, State, Comments, days=30, half_life=7.0, chunk=1000):
+    now = datetime.utcnow()
+    since = now - timedelta(days=days)
+
+    session_landscapes = dict(db.session.query(Comments.session_id, Comments.landscape_id).distinct())
+
+    scores = {}
+    scenarios = {}
+    skipped = 0
+
+    # States are streamed in session order and rebuilt a session at a time (as export.state_records does), so only
+    # one session's rows are held at once, and each session's snapshot is read once
+    recent = db.session.query(State.session_id).filter(State.timestamp >= since).distinct()
+    query = db.session.query(State.session_id, State.index, State.timestamp, State.state, State.encoding,
+                             State.data, State.deleted) \
+        .filter(State.session_id.in_(recent)) \
+        .order_by(State.session_id, State.index) \
+        .execution_options(stream_results=True) \
+        .yield_per(chunk)
+
+    def session_states(rows):
+        states = rebuild(rows)[0]
+        for row in rows:
+            if row.timestamp >= since and not row.deleted:
+                yield row, states.get((row.session_id, row.index))
+
+    def all_states():
+        rows = []
+        for row in query:
+            if rows and row.session_id != rows[0].session_id:
+                yield from session_states(rows)
+                rows = []
+            rows.append(row)
+        yield from session_states(rows)
+
+    for row, state in all_states():
+        session_id, timestamp = row.session_id, row.timestamp
+        try:
+            landscape_id = state.get('landscape_id') or state['inputs'].get('landscape_id') or \
+                session_landscapes.get(session_id)
+            inputs = canonical_inputs(state['inputs'])
+        except (TypeError, ValueError, KeyError, AttributeError):
+            landscape_id, inputs = None, None
+
+        if not landscape_id or not inputs:
+            skipped += 1
+            continue
+
+        landscape_id = int(landscape_id)
+        h = input_hash(landscape_id, inputs)
+        age = (now - timestamp).total_seconds() / 86400.0
+        scores[landscape_id, h] = scores.get((landscape_id, h), 0.0) + 0.5 ** (age / half_life)
+        scenarios[landscape_id, h] = {'landscape_id': landscape_id, **inputs}
+
+    if skipped:
+        log.info("Skipped {} states with no inputs or landscape".format(skipped))
+
+    ranked = {}
+    for (landscape_id, h), score in scores.items():
+        ranked.setdefault(landscape_id, []).append((score, scenarios[landscape_id, h]))
+    for candidates in ranked.values():
+        candidates.sort(key=lambda c: c[0], reverse=True)
+    return ranked
+
+
+def queued(client):
+    pipe = client.pipeline(transaction=False)
+    for queue in INTERACTIVE_QUEUES:
+        pipe.llen(queue)
+    return sum(pipe.execute())
+
+
+##
+# Expected run time of a landscape's scenarios, from a cost model trained on its run log, and the landscape's setup
+# cost per task. Returns (None, setup) until enough runs have been logged
+def scenario_cost(client, landscape_id, min_samples=20):
+    setup = setup_costs(client).get(int(landscape_id), 0.0)
+    runs = load_runs(client, landscape_id)
+    if len(runs) < min_samples:
+        return None, setup
+    try:
+        model = CostModel(runs)
+    except (KeyError, ValueError, np.linalg.LinAlgError) as e:
+        log.error("Could not train a cost model for landscape {}: {}".format(landscape_id, e))
+        return None, setup
+    return lambda scenario: model.predict(canonical_inputs(scenario)), setup
+
+
+##
+# Wait until no interactive runs are queued. Returns False if that takes longer than timeout seconds.
+def wait_for_idle(client, timeout, poll_interval=1.0):
+    deadline = time.monotonic() + timeout
+    while queued(client) > 0:
+        if time.monotonic() > deadline:
+            return False
+        sleep_for = min(poll_interval, max(deadline - time.monotonic(), 0))
+        time.sleep(sleep_for)
+    return True
+
+
+##
+# Run a landscape's top uncached scenarios at low priority, within a budget of model runs and seconds.
+#
+# Scenarios are sent a few at a time, and only while no interactive runs are waiting, so the prewarm
+# only ever uses otherwise idle workers. Once run times can be estimated, they're packed into tasks expected to
+# take at most `gap` seconds, so that an interactive run arriving meanwhile waits no longer than that for a worker.
+# Returns statistics, which are also stored in Redis.
+def prewarm(celery, client, landscape_id, candidates, budget=200, max_seconds=3600, chunk_size=4,
+            max_in_flight=2, gap=30.0):
+    start = time.monotonic()
+    landscape_id = int(landscape_id)
+
+    hashes = [input_hash(landscape_id, s) for _, s in candidates]
+    cached = cached_results(client, landscape_id, hashes)
+    todo = [s for (_, s), h in zip(candidates, hashes) if h not in cached][:budget]
+
+    stats = {
+        'landscape_id': landscape_id,
+        'candidates': len(candidates),
+        'cached': len(cached),
+        'scheduled': len(todo),
+        'run': 0,
+        'failed': 0,
+        'stopped': None,
+        'estimated_seconds': None
+    }
+    cost, setup = scenario_cost(client, landscape_id)
+    if cost is not None:
+        stats['estimated_seconds'] = round(sum(cost(s) for s in todo), 1)
+    log.info("Landscape {}: {} candidate scenarios, {} already cached, prewarming {}".format(
+        landscape_id, len(candidates), len(cached), len(todo)))
+
+    batch_size = chunk_size * max_in_flight
+    for offset in range(0, len(todo), batch_size):
+        remaining = max_seconds - (time.monotonic() - start)
+        if remaining <= 0:
+            stats['stopped'] = 'time budget'
+            break
+        if not wait_for_idle(client, remaining):
+            stats['stopped'] = 'never idle'
+            break
+
+        for _, result in iter_batch(celery, client, landscape_id, todo[offset:offset + batch_size],
+                                    chunk_size=chunk_size, priority=PREWARM_PRIORITY,
+                                    max_in_flight=max_in_flight, cost=cost,
+                                    max_chunk_cost=max(gap - setup, 0.0)):
+            stats['run'] += 1
+            stats['failed'] += int(result is None)
+
+    stats['seconds'] = round(time.monotonic() - start, 1)
+    stats['timestamp'] = time.time()
+    client.hset(STATS_KEY, landscape_id, json.dumps(stats))
+    log.info("Landscape {}: prewarmed {} scenarios ({} failed) in {}s".format(
+        landscape_id, stats['run'], stats['failed'], stats['seconds']))
+    return stats
+
+
+if __name__ == "__main__":
+    from config import redis, create_app, make_celery
+    from database import db, State, Comments
+
+    parser = argparse.ArgumentParser(description='Fill the model result cache with scenarios from stored sessions')
+    parser.add_argument('--landscape', type=int, action='append', help='Landscape ID (default: all found)')
+    parser.add_argument('--days', type=int, default=30, help='Only mine states from the last N days')
+    parser.add_argument('--half-life', type=float, default=7.0, help='Recency half-life of a state, in days')
+    parser.add_argument('--budget', type=int, default=200, help='Maximum model runs per landscape')
+    parser.add_argument('--max-seconds', type=int, default=3600, help='Maximum duration per landscape')
+    parser.add_argument('--chunk-size', type=int, default=4, help='Scenarios per Celery task')
+    parser.add_argument('--gap', type=float, default=30.0, help='Longest expected duration of a task, in seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    app = create_app()
+    celery = make_celery(app)
+    db.init_app(app)
+
+    with app.app_context():
+        ranked = mine_states(db, State, Comments, days=args.days, half_life=args.half_life)
+
+        for landscape_id in args.landscape or sorted(ranked):
+            prewarm(celery, redis, landscape_id, ranked.get(landscape_id, []), budget=args.budget,
+                    max_seconds=args.max_seconds, chunk_size=args.chunk_size, gap=args.gap)
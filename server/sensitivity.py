@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from batch import iter_batch, landscape_inputs
+from emulator import SCALAR_OUTPUTS, LIST_OUTPUTS
+
+log = logging.getLogger(__name__)
+
+# Progress and partial indices of each study, for GET /sensitivity/<study_id>
+PROGRESS_KEY = 'flask:sensitivity:{}'
+STUDIES_DIR = os.environ.get('SENSITIVITY_DIR', 'studies')
+
+
+##
+# One column per model output: the single values, then each element of the list outputs
+def output_columns(result):
+    columns = {k: result[k] for k in SCALAR_OUTPUTS}
+    for k in LIST_OUTPUTS:
+        for i, v in enumerate(result[k]):
+            columns['{}_{}'.format(k, i)] = v
+    return columns
+
+
+##
+# Morris elementary effects design: `trajectories` one-at-a-time paths of d+1 points on a `levels`-level grid
+# in the unit hypercube. Returns the points (rows of each trajectory are contiguous), the input changed at
+# each step of each trajectory, and the signed step size.
+def morris_design(rng, d, trajectories, levels=4):
+    step = levels / (2.0 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1)
+
+    points = np.zeros((trajectories * (d + 1), d))
+    order = np.zeros((trajectories, d), dtype=int)
+    delta = np.zeros((trajectories, d))
+
+    for t in range(trajectories):
+        x = rng.choice(grid, size=d)
+        order[t] = rng.permutation(d)
+        points[t * (d + 1)] = x
+        for s, i in enumerate(order[t]):
+            delta[t, s] = step if x[i] + step <= 1.0 else -step
+            x = x.copy()
+            x[i] += delta[t, s]
+            points[t * (d + 1) + s + 1] = x
+
+    return points, order, delta
+
+
+##
+# Saltelli design for Sobol indices: for each of n base samples, rows A, B, then AB_i (A with input i from B)
+def sobol_design(rng, d, n):
+    a = rng.random((n, d))
+    b = rng.random((n, d))
+    points = np.zeros((n * (d + 2), d))
+    for j in range(n):
+        block = j * (d + 2)
+        points[block] = a[j]
+        points[block + 1] = b[j]
+        for i in range(d):
+            points[block + 2 + i] = a[j]
+            points[block + 2 + i, i] = b[j, i]
+    return points
+
+
+##
+# Morris mu* (mean absolute elementary effect) and sigma over the trajectories which have completed so far
+def morris_indices(y, done, order, delta, names):
+    d = len(names)
+    effects = [[] for _ in range(d)]
+    complete = 0
+
+    for t in range(len(order)):
+        rows = slice(t * (d + 1), (t + 1) * (d + 1))
+        if not done[rows].all() or np.isnan(y[rows]).any():
+            continue
+        complete += 1
+        values = y[rows]
+        for s, i in enumerate(order[t]):
+            effects[i].append((values[s + 1] - values[s]) / delta[t, s])
+
+    if not complete:
+        return None
+
+    return {
+        'samples': complete,
+        'mu_star': {n: float(np.mean(np.abs(e))) for n, e in zip(names, effects)},
+        'sigma': {n: float(np.std(e)) for n, e in zip(names, effects)}
+    }
+
+
+##
+# First-order (Saltelli 2010) and total (Jansen) Sobol indices over the base samples which have completed so far
+def sobol_indices(y, done, names):
+    d = len(names)
+    n = len(y) // (d + 2)
+    blocks = [j for j in range(n)
+              if done[j * (d + 2):(j + 1) * (d + 2)].all() and not np.isnan(y[j * (d + 2):(j + 1) * (d + 2)]).any()]
+
+    if len(blocks) < 2:
+        return None
+
+    # Centring doesn't change the estimators' expectations, but greatly reduces their variance
+    values = np.array([y[j * (d + 2):(j + 1) * (d + 2)] for j in blocks])
+    values = values - values[:, :2].mean()
+    f_a, f_b, f_ab = values[:, 0], values[:, 1], values[:, 2:]
+    variance = np.var(np.concatenate([f_a, f_b]))
+    if variance == 0:
+        return None
+
+    return {
+        'samples': len(blocks),
+        'S1': {n: float(np.mean(f_b * (f_ab[:, i] - f_a)) / variance) for i, n in enumerate(names)},
+        'ST': {n: float(0.5 * np.mean((f_a - f_ab[:, i]) ** 2) / variance) for i, n in enumerate(names)}
+    }
+
+
+##
+# A sensitivity study of one landscape's outputs to its crop and livestock areas, varied between
+# `lower` and `upper` times their BAU values.
+#
+# The design is written to the study directory up front, as Parquet: design.parquet (a column per input, in the
+# unit hypercube) and for Morris, trajectories.parquet (each trajectory's order of inputs and steps). Results are
+# collected as the workers finish them and flushed to Parquet parts (results/part-NNNNN.parquet: row numbers plus
+# a column per output), as model/bulk.py writes, so a study can be stopped and resumed without losing completed
+# runs. After each flush the indices are recomputed from the runs completed so far and published to Redis with the
+# study's progress.
+class Study:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'study.json')) as file:
+            self.manifest = json.load(file)
+
+        self.names = self.manifest['names']
+        design = pq.read_table(os.path.join(path, 'design.parquet'))
+        self.points = np.column_stack([design.column(n).to_numpy() for n in self.names])
+        self.lower = np.array(self.manifest['lower'])
+        self.upper = np.array(self.manifest['upper'])
+
+        if self.manifest['method'] == 'morris':
+            trajectories = pq.read_table(os.path.join(path, 'trajectories.parquet')).to_pydict()
+            self.order = np.array(trajectories['order'], dtype=int)
+            self.delta = np.array(trajectories['delta'])
+
+        self.done = np.zeros(len(self.points), dtype=bool)
+        self.columns = {}
+        self.parts = 0
+        self.load()
+
+    @classmethod
+    def create(cls, celery, client, landscape_id, method='morris', samples=20, lower=0.5, upper=1.5,
+               seed=None, study_id=None):
+        names, areas, n_crops, bau = landscape_inputs(celery, client, landscape_id)
+        areas = np.array(areas)
+        rng = np.random.default_rng(seed)
+
+        study_id = study_id or uuid.uuid4().hex
+        path = os.path.join(STUDIES_DIR, study_id)
+        os.makedirs(os.path.join(path, 'results'))
+
+        if method == 'morris':
+            points, order, delta = morris_design(rng, len(names), samples)
+            pq.write_table(pa.table({'order': order.tolist(), 'delta': delta.tolist()}),
+                           os.path.join(path, 'trajectories.parquet'))
+        elif method == 'sobol':
+            points = sobol_design(rng, len(names), samples)
+        else:
+            raise ValueError("Unknown method {}".format(method))
+
+        pq.write_table(pa.table({n: points[:, i] for i, n in enumerate(names)}), os.path.join(path, 'design.parquet'))
+        with open(os.path.join(path, 'study.json'), 'w') as file:
+            json.dump({
+                'id': study_id,
+                'landscape_id': landscape_id,
+                'method': method,
+                'samples': samples,
+                'names': names,
+                'lower': (areas * lower).tolist(),
+                'upper': (areas * upper).tolist()
+            }, file)
+
+        return cls(path)
+
+    def scenario(self, row):
+        areas = self.lower + self.points[row] * (self.upper - self.lower)
+        return {'landscape_id': self.manifest['landscape_id'], **dict(zip(self.names, map(float, areas)))}
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.full(len(self.points), np.nan)
+        return self.columns[name]
+
+    ##
+    # Read completed row groups back in
+    def load(self):
+        for part in sorted(glob.glob(os.path.join(self.path, 'results', 'part-*.parquet'))):
+            table = pq.read_table(part)
+            rows = table.column('row').to_numpy()
+            self.done[rows] = True
+            for name in table.column_names:
+                if name != 'row':
+                    self.column(name)[rows] = table.column(name).to_numpy()
+            self.parts += 1
+
+    ##
+    # Write results for a set of rows as a new row group
+    def flush(self, rows):
+        rows = np.array(sorted(rows))
+        table = pa.table({'row': rows, **{name: values[rows] for name, values in self.columns.items()}})
+        name = os.path.join(self.path, 'results', 'part-{:05d}.parquet'.format(self.parts))
+        pq.write_table(table, name + '.tmp')
+        os.replace(name + '.tmp', name)
+        self.parts += 1
+
+    def indices(self):
+        indices = {}
+        for name, y in self.columns.items():
+            if self.manifest['method'] == 'morris':
+                indices[name] = morris_indices(y, self.done, self.order, self.delta, self.names)
+            else:
+                indices[name] = sobol_indices(y, self.done, self.names)
+        return indices
+
+    def publish(self, client):
+        client.set(PROGRESS_KEY.format(self.manifest['id']), json.dumps({
+            'id': self.manifest['id'],
+            'landscape_id': self.manifest['landscape_id'],
+            'method': self.manifest['method'],
+            'done': int(self.done.sum()),
+            'total': len(self.points),
+            'complete': bool(self.done.all()),
+            'indices': self.indices()
+        }))
+
+    ##
+    # Run every row not yet completed, flushing a row group every flush_every results
+    def run(self, celery, client, chunk_size=8, flush_every=256):
+        remaining = [int(r) for r in np.flatnonzero(~self.done)]
+        log.info("Study {}: {} of {} runs remaining".format(self.manifest['id'], len(remaining), len(self.points)))
+        self.publish(client)
+
+        scenarios = [self.scenario(r) for r in remaining]
+        unflushed = []
+        for i, result in iter_batch(celery, client, self.manifest['landscape_id'], scenarios,
+                                    chunk_size=chunk_size):
+            row = remaining[i]
+            if result is not None:
+                for name, value in output_columns(result).items():
+                    self.column(name)[row] = value
+            # Failed runs are recorded as NaN, so they aren't retried on resume
+            self.done[row] = True
+            unflushed.append(row)
+
+            if len(unflushed) >= flush_every:
+                self.flush(unflushed)
+                unflushed = []
+                self.publish(client)
+
+        if unflushed:
+            self.flush(unflushed)
+        self.publish(client)
+
+
+if __name__ == "__main__":
+    from config import redis, create_app, make_celery
+
+    parser = argparse.ArgumentParser(description='Global sensitivity analysis of the crop model')
+    parser.add_argument('--landscape', type=int, help='Landscape ID, e.g. 101 (new studies)')
+    parser.add_argument('--method', choices=['morris', 'sobol'], default='morris')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='Morris trajectories, or Sobol base samples (runs = samples * (inputs + 2))')
+    parser.add_argument('--lower', type=float, default=0.5, help='Lower bound, as a multiple of BAU')
+    parser.add_argument('--upper', type=float, default=1.5, help='Upper bound, as a multiple of BAU')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=8, help='Scenarios per Celery task')
+    parser.add_argument('--resume', metavar='STUDY_ID', help='Resume an existing study')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    app = create_app()
+    celery = make_celery(app)
+
+    with app.app_context():
+        if args.resume:
+            study = Study(os.path.join(STUDIES_DIR, args.resume))
+        elif args.landscape:
+            study = Study.create(celery, redis, args.landscape, method=args.method, samples=args.samples,
+                                 lower=args.lower, upper=args.upper, seed=args.seed)
+        else:
+            parser.error('--landscape is required for a new study')
+
+        log.info("Study {}".format(study.manifest['id']))
+        study.run(celery, redis, chunk_size=args.chunk_size)
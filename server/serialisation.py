@@ -0,0 +1,155 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import brotli
+import msgpack
+from flask import Response, request
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_MSGPACK = 'application/msgpack'
+
+# Order of preference when a client accepts several: JSON stays the default for browsers sending */*
+MIMETYPES = [MIMETYPE_JSON, MIMETYPE_MSGPACK]
+COMPRESSIONS = ['br', 'gzip']
+
+# Bodies smaller than this aren't worth the CPU to compress
+MIN_COMPRESS_SIZE = 1024
+
+
+##
+# Encode a python object to bytes in the requested format
+def encode(obj, mimetype=MIMETYPE_JSON):
+    if mimetype == MIMETYPE_MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+##
+# Decode bytes from the given format back to a python object
+def decode(body, mimetype=MIMETYPE_JSON):
+    if mimetype == MIMETYPE_MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+##
+# Compress an encoded body with a content-encoding (br, gzip)
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+##
+# Pick the response format and compression from the request's Accept and Accept-Encoding headers
+def negotiate(accept_mimetypes, accept_encodings):
+    mimetype = accept_mimetypes.best_match(MIMETYPES, default=MIMETYPE_JSON)
+    encoding = accept_encodings.best_match(COMPRESSIONS)
+    return mimetype, encoding
+
+
+##
+# Strong ETag for an encoded body: the content hash, so any change to the content changes the tag
+def etag_for(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+##
+# Add ETag and Cache-Control headers to a response, and turn it into a 304 if the client already holds it
+def conditional(response, etag, max_age):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+##
+# Small thread-safe LRU of pre-encoded response bodies. Keys must identify immutable content
+# (a finished task ID, a content hash), as entries are never invalidated, only evicted.
+class EncodedCache:
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def get_or_put(self, key, factory):
+        if key is None:
+            return factory()
+        value = self.get(key)
+        return value if value is not None else self.put(key, factory())
+
+
+encoded_cache = EncodedCache()
+
+
+##
+# Encode (and compress) a body in a negotiated format. Returns (body, ETag, content-encoding or None).
+#
+# obj:       python object to encode, or a function returning it (only called if the body isn't cached)
+# raw:       the same object, already JSON-encoded (e.g. as stored in Redis). Sent as-is to JSON clients.
+# cache_key: if given, encoded (and compressed) bodies and their ETags are kept in encoded_cache under this key
+# etag:      whether to compute an ETag for uncached bodies
+def encoded_body(mimetype, encoding, obj=None, raw=None, cache_key=None, etag=False):
+    def _encode():
+        if raw is not None and mimetype == MIMETYPE_JSON:
+            body = raw if type(raw) is bytes else raw.encode('utf-8')
+        elif raw is not None:
+            body = encode(json.loads(raw), mimetype)
+        else:
+            body = encode(obj() if callable(obj) else obj, mimetype)
+        return body, etag_for(body) if cache_key is not None or etag else None
+
+    body, tag = encoded_cache.get_or_put(None if cache_key is None else (cache_key, mimetype, None), _encode)
+
+    if encoding is not None and len(body) >= MIN_COMPRESS_SIZE:
+        plain = body
+
+        def _compress():
+            compressed = compress(plain, encoding)
+            return compressed, etag_for(compressed)
+
+        body, tag = encoded_cache.get_or_put(None if cache_key is None else (cache_key, mimetype, encoding),
+                                             _compress)
+    else:
+        encoding = None
+
+    return body, tag, encoding
+
+
+##
+# Build a response in the format negotiated with the client. Arguments as for encoded_body;
+# max_age: if given, the response gets an ETag and Cache-Control, and is answered with 304 when unchanged
+def encoded_response(obj=None, raw=None, cache_key=None, status=200, max_age=None):
+    mimetype, encoding = negotiate(request.accept_mimetypes, request.accept_encodings)
+    body, etag, encoding = encoded_body(mimetype, encoding, obj=obj, raw=raw, cache_key=cache_key,
+                                        etag=max_age is not None)
+
+    response = Response(body, status=status, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.update(('Accept', 'Accept-Encoding'))
+
+    if max_age is not None and status == 200:
+        return conditional(response, etag, max_age)
+    return response
@@ -3,24 +3,57 @@ import logging
 import pickle
 import markdown
 import hashlib
+import hmac
 import json
 import sys
 
-from time import sleep
+from time import sleep, monotonic
+from uuid import uuid4
 from functools import reduce
-from flask import Blueprint, Response, Markup, redirect, request, render_template, jsonify, url_for
+from celery import states
+from flask import Blueprint, Response, Markup, abort, redirect, request, render_template, jsonify, url_for, \
+    stream_with_context
 from redis.exceptions import ConnectionError
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.mysql import match
 
 from config import redis, create_app, make_celery
-from database import setup_db, db, Comments, Tags, CommentTags, State, User
+from bootstrap import bootstrap
+from comment_cache import CommentPages, ALL, ANY_LANDSCAPE, landscape_scope, reply_scope
+from database import db, read_only, pool_stats, load_states, encode_stored_state, Comments, CommentTags, Results, State, User, \
+    tag_catalogue
+from emulator import EmulatorRegistry, CostModel
+from export import EXPORTS, FILTERS, MIMETYPE_NDJSON, MIMETYPE_PARQUET, export_chunks, parse_since
+from indexes import tag_index, search_terms, encode_cursor, decode_cursor, FULLTEXT_MIN_TOKEN
+from landscapes import LandscapeSummaries, SUMMARIES
+from model.datafiles import DataFileError
+from optimiser import FRONT_KEY
+from sensitivity import PROGRESS_KEY
+from prewarm import STATS_KEY as PREWARM_STATS_KEY
+from tasks.results import canonical_inputs, input_errors, input_hash, cached_results, result_cache_stats
+from tasks.memory import worker_memory
+from tasks.quarantine import QUARANTINE_TTL, QuarantinedError, quarantined, quarantined_many, quarantine_list
+from tasks.schedule import QueueEstimate, enqueue, priority_for, setup_costs
+from serialisation import encode, encoded_response, encoded_cache, etag_for, conditional
 
 app = create_app()
 log = app.logger
 celery = make_celery(app)
 
+# No DDL or precalculation here, so that workers start quickly: see bootstrap.py
 db.init_app(app)
-setup_db(app, db)
+
+emulators = EmulatorRegistry(redis,
+                             min_samples=app.config['EMULATOR_MIN_SAMPLES'],
+                             max_samples=app.config['EMULATOR_MAX_SAMPLES'],
+                             retrain_every=app.config['EMULATOR_RETRAIN_EVERY'])
+cost_models = EmulatorRegistry(redis,
+                               min_samples=app.config['COST_MIN_SAMPLES'],
+                               max_samples=app.config['COST_MAX_SAMPLES'],
+                               retrain_every=app.config['COST_RETRAIN_EVERY'],
+                               factory=CostModel)
+landscape_summaries = LandscapeSummaries(redis)
+comment_pages = CommentPages(redis, ttl=app.config['COMMENT_CACHE_TTL'])
 
 '''
 Application Routes
@@ -44,11 +77,41 @@ if app.config['FLASK_ENV'] == 'development':
         return render_template('test.html')
 
 
+    @crops.route('/pool', methods=['GET'])
+    def pool():
+        return jsonify(pool_stats.as_dict())
+
+
+    @crops.route('/cache', methods=['GET'])
+    def cache():
+        return jsonify({
+            'results': result_cache_stats(redis),
+            'prewarm': {int(k): json.loads(v) for k, v in redis.hgetall(PREWARM_STATS_KEY).items()}
+        })
+
+
+    @crops.route('/quarantine', methods=['GET'])
+    def quarantine():
+        return jsonify(quarantine_list(redis))
+
+
+    @crops.route('/memory', methods=['GET'])
+    def memory():
+        return jsonify(worker_memory(redis))
+
+
 @crops.route('/', methods=['GET'])
 def index():
     log.info(request)
-    return Response(Markup("<!DOCTYPE html>\n<title>CropModel</title>\n")
-                    + Markup(markdown.markdown(app.config['HELP_STRING']))), 200
+
+    # The help string only changes on deploy: render the Markdown once per process
+    def render():
+        body = (Markup("<!DOCTYPE html>\n<title>CropModel</title>\n")
+                + Markup(markdown.markdown(app.config['HELP_STRING']))).encode('utf-8')
+        return body, etag_for(body)
+
+    body, etag = encoded_cache.get_or_put(('index',), render)
+    return conditional(Response(body, mimetype='text/html'), etag, app.config['HTTP_CACHE_MAX_AGE'])
 
 
 @crops.route('model', methods=['POST'])
@@ -57,10 +120,169 @@ def model_post():
     data = request.get_json()
     log.info(data)
 
-    task = celery.send_task('celery_model_run', kwargs={'data': data, 'landscape_id': data['landscape_id']},
-                            expires=120, retry_limit=5)
+    if request_landscape_id(data) is None:
+        return "Bad request: landscape_id must be an integer, e.g. 101", 400
+    if input_errors(data):
+        return "Bad request: {}".format(input_errors(data)), 400
+
+    task = submit_model_run(data)
+
+    return jsonify({'task_id': task.id, 'expected_wait': QueueEstimate.load(redis).wait_for(task.id)}), 303, \
+        {'Location': url_for('crops.task_status', task_id=task.id)}
+
+
+@crops.route('model/preview', methods=['POST'])
+def model_preview():
+    data = request.get_json()
+
+    landscape_id = request_landscape_id(data)
+    if landscape_id is None:
+        return "Bad request: landscape_id must be an integer, e.g. 101", 400
+
+    # Check the inputs before anything is run
+    if input_errors(data):
+        return "Bad request: {}".format(input_errors(data)), 400
+    emulator = emulators.get(landscape_id)
+    inputs = canonical_inputs(data)
+    if emulator is not None:
+        missing = [n for n in emulator.names if n not in inputs]
+        if missing:
+            return "Bad request: missing inputs {}".format(', '.join(missing)), 400
+
+    # Start the real run straight away: the preview only covers the wait for it
+    task = submit_model_run(data)
+    response = {'task_id': task.id, 'preview': None}
+
+    if emulator is not None:
+        mean, std = emulator.predict(inputs)
+        response['preview'] = {
+            'result': mean,
+            'uncertainty': std,
+            'samples': emulator.samples
+        }
+
+    return jsonify(response), 200, {'Location': url_for('crops.task_status', task_id=task.id)}
 
-    return jsonify({'task_id': task.id}), 303, {'Location': url_for('crops.task_status', task_id=task.id)}
+
+@crops.errorhandler(QuarantinedError)
+def quarantined_scenario(e):
+    return Response("Unprocessable: this scenario is quarantined after failing the model ({})".format(e),
+                    status=422, mimetype='text/plain', headers={'Retry-After': str(QUARANTINE_TTL)})
+
+
+# Helper function: the landscape ID of a model request body as an integer, or None if it has none or it isn't one
+def request_landscape_id(data):
+    try:
+        return int(data['landscape_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Helper function: send a model run to Celery. Scenarios already in the result cache (e.g. prewarmed from
+# stored sessions by prewarm.py) aren't rerun: their result is stored as a finished task straight away.
+# Raises QuarantinedError for known-bad scenarios. Used by the gateway too
+def submit_model_run(data):
+    landscape_id = data['landscape_id']
+    result_hash = input_hash(landscape_id, data)
+    cached = cached_results(redis, landscape_id, [result_hash])
+    if cached:
+        task_id = str(uuid4())
+        celery.backend.store_result(task_id, {'result': next(iter(cached.values()))}, states.SUCCESS)
+        return celery.AsyncResult(task_id)
+
+    # Known-bad scenarios would only crash or hang a worker again
+    reason = quarantined(redis, landscape_id, result_hash)
+    if reason:
+        raise QuarantinedError(reason)
+
+    return send_model_task('celery_model_run', landscape_id, [data],
+                           kwargs={'data': data, 'landscape_id': landscape_id}, expires=120, retry_limit=5)
+
+
+##
+# Expected run time in seconds of a task running scenarios on one landscape: the landscape's setup cost per task
+# plus each scenario's, from the cost model. None until enough runs have been logged to train one
+def estimate_cost(landscape_id, scenarios):
+    model = cost_models.get(landscape_id)
+    if model is None:
+        return None
+    setup = setup_costs(redis).get(int(landscape_id), 0.0)
+    return setup + sum(model.predict(canonical_inputs(s)) for s in scenarios)
+
+
+##
+# Send a model task at a priority by its expected run time, shortest first (tasks/schedule.py), and note it on the
+# ledger of queued work
+def send_model_task(name, landscape_id, scenarios, **options):
+    seconds = estimate_cost(landscape_id, scenarios)
+    priority = priority_for(seconds, app.config['COST_PRIORITY_BOUNDS'])
+
+    # On the ledger before a worker can take it off
+    task_id = str(uuid4())
+    enqueue(redis, task_id, priority, seconds or 0.0, expires=options.get('expires'))
+    return celery.send_task(name, task_id=task_id, priority=priority, **options)
+
+
+# Submit many scenarios of one landscape in one request. Identical scenarios are only run once, cached results
+# are returned at once, and the rest are run in chunks of BATCH_CHUNK_SIZE (a model initialisation per chunk).
+#
+# Responds 202 with:
+#   cached:  [[index, result], ...] for scenarios answered from the result cache
+#   tasks:   [{'task_id', 'indices', 'expected_wait'}, ...], where a task's result is the list of results of
+#            scenarios `indices`, in order (null for a scenario which failed). Poll them with GET /status/<task_id>
+#            or POST /status
+#   same_as: [[index, first index], ...] for scenarios identical to an earlier one
+#   quarantined: [[index, reason], ...] for scenarios not run because they are quarantined (tasks/quarantine.py)
+@crops.route('model/batch', methods=['POST'])
+def model_batch():
+    data = request.get_json(force=True)
+    try:
+        landscape_id = int(data['landscape_id'])
+        scenarios = data['scenarios']
+    except (KeyError, TypeError, ValueError):
+        return "Bad request: must provide landscape_id and a list of scenarios", 400
+    if not isinstance(scenarios, list) or len(scenarios) > app.config['BATCH_MAX_SCENARIOS']:
+        return "Bad request: scenarios must be a list of at most {} scenarios".format(
+            app.config['BATCH_MAX_SCENARIOS']), 400
+    for i, scenario in enumerate(scenarios):
+        if input_errors(scenario):
+            return "Bad request: scenario {}: {}".format(i, input_errors(scenario)), 400
+
+    first, same_as = {}, []
+    for i, scenario in enumerate(scenarios):
+        h = input_hash(landscape_id, scenario)
+        if h in first:
+            same_as.append([i, first[h]])
+        else:
+            first[h] = i
+
+    cached = cached_results(redis, landscape_id, first.keys())
+    blocked = quarantined_many(redis, landscape_id, [h for h in first if h not in cached])
+    misses = [i for h, i in first.items() if h not in cached and h not in blocked]
+    chunk_size = app.config['BATCH_CHUNK_SIZE']
+
+    tasks = []
+    for start in range(0, len(misses), chunk_size):
+        indices = misses[start:start + chunk_size]
+        chunk = [scenarios[i] for i in indices]
+        task = send_model_task('celery_model_run_batch', landscape_id, chunk,
+                               kwargs={'landscape_id': landscape_id, 'scenarios': chunk}, retry_limit=5)
+        tasks.append({'task_id': task.id, 'indices': indices})
+
+    queue = QueueEstimate.load(redis)
+    for task in tasks:
+        task['expected_wait'] = queue.wait_for(task['task_id'])
+
+    log.info("Batch for landscape {}: {} scenarios, {} unique, {} cached, {} quarantined, {} tasks".format(
+        landscape_id, len(scenarios), len(first), len(cached), len(blocked), len(tasks)))
+
+    return encoded_response({
+        'landscape_id': landscape_id,
+        'cached': [[first[h], result] for h, result in cached.items()],
+        'tasks': tasks,
+        'same_as': same_as,
+        'quarantined': [[first[h], reason] for h, reason in blocked.items()]
+    }, status=202)
 
 
 @crops.route('model', methods=['GET'])
@@ -68,8 +290,9 @@ def model_get():
     redis_key = "flask:{0}:{1}".format('celery_model_get_bau', request.args.get('landscape_id'))
     result = redis.get(redis_key)
     if result:
-        result = json.loads(result)
-        return jsonify(result)
+        # Stored pre-encoded as JSON: send the bytes as they are, encoding other formats once per BAU record
+        return encoded_response(raw=result, cache_key=('bau', hashlib.sha1(result).hexdigest()),
+                                max_age=app.config['HTTP_CACHE_MAX_AGE'])
     else:
         log.error('BAU result was not found in Redis store!')
         return "500 Error: Failed to retrieve BAU result", 500
@@ -95,9 +318,11 @@ def cached_task(task_name, landscape_id):
             task = pickle.loads(exists)
             log.info("Cache HIT: {} / {} / {}".format(redis_key, task.id, task.state))
 
-            # Don't return the cache if it failed!
+            # Don't return the cache if it failed! Only a finished task's redirect may be cached by clients: one
+            # to a task still running would keep being followed if it then failed
             if task.state != "FAILURE":
-                return see_other_redirect(task)
+                return see_other_redirect(task, max_age=app.config['HTTP_CACHE_MAX_AGE']
+                                          if task.state == states.SUCCESS else None)
 
         except ConnectionError as e:
             log.error(e)
@@ -116,50 +341,145 @@ def cached_task(task_name, landscape_id):
     return see_other_redirect(task)
 
 
-# Helper function - redirect with HTTP 303 SEE OTHER
-def see_other_redirect(task):
-    return jsonify({'task_id': task.id}), 303, {'Location': url_for('crops.task_status', task_id=task.id)}
+# Helper function - redirect with HTTP 303 SEE OTHER. A max_age lets clients reuse the redirect for a while
+def see_other_redirect(task, max_age=None):
+    headers = {'Location': url_for('crops.task_status', task_id=task.id)}
+    if max_age is not None:
+        headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+    return jsonify({'task_id': task.id}), 303, headers
 
 
 @crops.route('/status/<task_id>')
 def task_status(task_id):
     task = celery.AsyncResult(task_id)
+    queue = QueueEstimate.load(redis) if task.state == states.PENDING else None
+    response = status_body(task.state, task.info, queue.wait_for(task_id) if queue else None)
+
+    # Results of finished tasks never change, so their encoded bodies can be reused by every poll
+    if task.state == 'SUCCESS':
+        return encoded_response(response, cache_key=('status', task_id),
+                                max_age=app.config['HTTP_CACHE_MAX_AGE_RESULTS'])
+    return encoded_response(response)
+
 
-    if task.state == 'PENDING':
+# The status of several tasks, as {task_id: status}, from one read of the result backend
+@crops.route('/status', methods=['POST'])
+def task_statuses():
+    data = request.get_json(force=True)
+    task_ids = data.get('task_ids') if isinstance(data, dict) else None
+    if not isinstance(task_ids, list) or len(task_ids) > app.config['BATCH_MAX_SCENARIOS']:
+        return "Bad request: task_ids must be a list of at most {} task IDs".format(
+            app.config['BATCH_MAX_SCENARIOS']), 400
+
+    values = redis.mget([celery.backend.get_key_for_task(str(t)) for t in task_ids]) if task_ids else []
+    queue = QueueEstimate.load(redis) if None in values else None
+    tasks = {}
+    for task_id, value in zip(task_ids, values):
+        if value is None:
+            tasks[task_id] = status_body(states.PENDING, None, queue.wait_for(str(task_id)))
+        else:
+            tasks[task_id] = status_body(*stored_task_meta(value))
+
+    return encoded_response({'tasks': tasks})
+
+
+# Helper function: a task's state and info, as AsyncResult.state and .info would give them, from its value in the
+# result backend. Failures are stored serialised: info is the exception itself. Used by the gateway too
+def stored_task_meta(value):
+    meta = celery.backend.decode_result(value)
+    if meta['status'] in states.EXCEPTION_STATES:
+        return meta['status'], celery.backend.exception_to_python(meta['result'])
+    return meta['status'], meta['result']
+
+
+# Helper function: the body of a task status response. A pending task's expected_wait is the estimated seconds
+# until it starts (null if unknown)
+def status_body(state, info, expected_wait=None):
+    if state == 'PENDING':
         # job did not start yet
         response = {
-            'state': task.state,
-            'status': 'Pending...'
+            'state': state,
+            'status': 'Pending...',
+            'expected_wait': expected_wait
         }
-    elif task.state != 'FAILURE':
+    elif state != 'FAILURE':
+        info = info if isinstance(info, dict) else {}
         response = {
-            'state': task.state,
-            'status': task.info.get('status', '')
+            'state': state,
+            'status': info.get('status', '')
         }
-        if 'result' in task.info:
-            response['result'] = task.info['result']
+        if 'result' in info:
+            response['result'] = info['result']
     else:
         # something went wrong in the background job
         response = {
-            'state': task.state,
-            'status': str(task.info),  # this is the exception raised
+            'state': state,
+            'status': str(info),  # this is the exception raised
         }
-    return jsonify(response)
+    return response
+
+
+@crops.route('landscape/<kind>', methods=['GET'])
+def landscape_get(kind):
+    if kind not in SUMMARIES:
+        return "Not found: no {} summary. Try {}".format(kind, ', '.join(SUMMARIES)), 404
+
+    landscape_id = request.args.get('landscape_id')
+    if landscape_id is None:
+        return 'Bad Request: Must provide landscape_id=101 or 102 as parameter!', 400
+
+    try:
+        summary = landscape_summaries.get(kind, landscape_id)
+    except DataFileError as e:
+        return "Bad request: {}".format(e), 400
+
+    return encoded_response(raw=summary, cache_key=('landscape', kind, landscape_id, landscape_summaries.fingerprint),
+                            max_age=app.config['HTTP_CACHE_MAX_AGE'])
+
+
+@crops.route('optimise', methods=['GET'])
+def optimise_get():
+    landscape_id = request.args.get('landscape_id')
+    if landscape_id is None:
+        return 'Bad Request: Must provide landscape_id=101 or 102 as parameter!', 400
+
+    front = redis.get(FRONT_KEY.format(landscape_id))
+    if not front:
+        return "Not found: no Pareto front has been computed for landscape {}".format(landscape_id), 404
+    return encoded_response(raw=front, cache_key=('front', hashlib.sha1(front).hexdigest()))
+
 
+@crops.route('sensitivity/<study_id>', methods=['GET'])
+def sensitivity_get(study_id):
+    progress = redis.get(PROGRESS_KEY.format(study_id))
+    if not progress:
+        return "Not found: no sensitivity study {}".format(study_id), 404
+    return encoded_response(raw=progress)
 
+
+# Not @read_only: a page built from a lagging replica would be cached under the generation the post just bumped,
+# and served without the new comment until it expired. Only cache misses query the database
 @crops.route('comment', methods=['GET'])
 def get_comments():
     data = request.args.to_dict(flat=True)
     log.info(data)
 
-    # Defaults for optional arguments
+    # Defaults for optional arguments. Searches are sorted by relevance unless asked otherwise
     data['size'] = 4 if 'size' not in data else int(data['size'])
     data['page'] = 1 if 'page' not in data else int(data['page'])
-    data['sort'] = 0 if 'sort' not in data else int(data['sort'])
     data['filter'] = 0 if 'filter' not in data else int(data['filter'])
+    data['sort'] = (4 if data['filter'] == 5 else 0) if 'sort' not in data else int(data['sort'])
+
+    # Pages are only rebuilt after a post which could change them: see comment_cache.py
+    cache_key = comment_pages.key(data)
+    body = comment_pages.get(cache_key)
+    if body is not None:
+        return encoded_response(raw=body, cache_key=('comments', cache_key))
 
     # Construct model query
     query = Comments.query
+    length = None  # Number of matching comments, if a filter can tell without a COUNT query
+    relevance = None  # Full-text search score, for filter=5
 
     if 'landscape_id' in data.keys():
         query = query.filter(Comments.landscape_id == data['landscape_id'])
@@ -176,15 +496,40 @@ def get_comments():
             return "Bad request: filter=3 is missing reply_id", 400
         query = query.filter(Comments.reply_id == data['reply_id'])
 
-    elif data['filter'] == 4:
-        if 'tags' not in data.keys():
+    elif data['filter'] == 4 or data['filter'] == 5:
+        if data['filter'] == 4 and 'tags' not in data.keys():
             return "Bad request: filter=4 is missing tags", 400
 
-        tag_ids = data['tags'].split(',')
-        query = query.join(CommentTags, Comments.id == CommentTags.comment_id) \
-            .filter(CommentTags.tag_id.in_(tag_ids)) \
-            .group_by(Comments.id) \
-            .having(db.func.count('*') == len(tag_ids))
+        if 'tags' in data.keys():
+            try:
+                tag_ids = {int(t) for t in data['tags'].split(',')}
+            except ValueError:
+                return "Bad request: tags must be a comma-separated list of tag IDs", 400
+
+            # Reject unknown tags without touching the comments tables
+            unknown = tag_catalogue.refresh().unknown(tag_ids)
+            if unknown:
+                return "Bad request: unknown tags {}".format(','.join(str(t) for t in sorted(unknown))), 400
+
+            # Intersect the tag (and landscape) sets in the tag index, then only fetch matching rows from SQL
+            comment_ids = tag_index.search(tag_ids, data.get('landscape_id'))
+            query = query.filter(Comments.id.in_(comment_ids))
+            length = len(comment_ids)
+
+        if data['filter'] == 5:
+            # Full-text search on the comments' FULLTEXT index, combined with any landscape and tag filters
+            terms = search_terms(data.get('q'))
+            if not terms:
+                return "Bad request: filter=5 needs q with a word of at least {} characters".format(
+                    FULLTEXT_MIN_TOKEN), 400
+            if data['sort'] not in (0, 1, 4):
+                return "Bad request: filter=5 supports sort=0, 1 or 4", 400
+
+            # Rounded so that a score read back from a cursor compares equal to the one computed in SQL
+            matched = match(Comments.text, against=terms).in_boolean_mode()
+            relevance = db.func.round(matched, 6, type_=db.Float)
+            query = query.filter(matched)
+            length = None
 
     #
     # Sorting
@@ -211,13 +556,64 @@ def get_comments():
             log.error("Bad request: ?distance=value must be passed with ?sort=3")
             return "Bad request: ?distance=value must be passed with ?sort=3", 400
 
+    elif data['sort'] == 4:
+        # Relevance, best match first
+        if relevance is None:
+            return "Bad request: sort=4 (relevance) needs filter=5", 400
+        query = query.order_by(relevance.desc(), Comments.id.desc())
+
     # Log SQL query– useful for debugging
     # log.debug(query.statement.compile(compile_kwargs={"literal_binds": True}))
 
     # Pagination (load in pages)
-    comments = query.paginate(data['page'], data['size'], True).items
+    next_cursor = None
+    if relevance is not None:
+        # Keyset pagination for search: ?after= the previous page's 'next' cursor. Deep pages cost no more than
+        # the first, and don't shift when comments are posted meanwhile. Only the first page counts the matches:
+        # the client already has the total when it asks for the next, and counting would cost a deep page a scan
+        length = query.order_by(None).count() if 'after' not in data.keys() else None
+        if 'after' in data.keys():
+            try:
+                after_id, after_relevance = decode_cursor(data['after'])
+            except ValueError:
+                return "Bad request: after is not a valid cursor", 400
+
+            if data['sort'] == 0:
+                query = query.filter(Comments.id < after_id)
+            elif data['sort'] == 1:
+                query = query.filter(Comments.id > after_id)
+            elif after_relevance is None:
+                return "Bad request: after is not a valid cursor for sort=4", 400
+            else:
+                query = query.filter(or_(relevance < after_relevance,
+                                         and_(relevance == after_relevance, Comments.id < after_id)))
+
+        rows = query.add_columns(relevance).limit(data['size'] + 1).all()
+        comments = [c for c, _ in rows[:data['size']]]
+        if len(rows) > data['size']:
+            last, score = rows[data['size'] - 1]
+            next_cursor = encode_cursor(last.id, score if data['sort'] == 4 else None)
+
+    elif length is None:
+        pagination = query.paginate(data['page'], data['size'], True)
+        comments, length = pagination.items, pagination.total
+    else:
+        # Count is already known: fetch just the page's rows. 404s match flask-sqlalchemy's paginate()
+        if data['page'] < 1:
+            abort(404)
+        comments = query.limit(data['size']).offset((data['page'] - 1) * data['size']).all()
+        if not comments and data['page'] != 1:
+            abort(404)
+
     items = [c.as_dict() for c in comments]
 
+    # Every session's history, with outputs from the results table fetched in one query
+    states = load_states([s for c in comments for s in c.session])
+    histories = []
+    for c in comments:
+        histories.append(states[:len(c.session)])
+        states = states[len(c.session):]
+
     # Modify data to output
     for i, c in enumerate(items):
         c['timestamp'] = c['timestamp'].timestamp()
@@ -225,7 +621,7 @@ def get_comments():
         c['reply'] = get_single_comment(c['reply_id']) if c['reply_id'] else None
         c['state_index'] = comments[i].state_index
         c['session'] = {
-            'history': [json.loads(s.state) for s in comments[i].session],
+            'history': histories[i],
             'count': len(comments[i].session),
             'id': comments[i].session_id,
             'opened': comments[i].session[0].timestamp.timestamp()
@@ -235,18 +631,22 @@ def get_comments():
         if data['sort'] == 3:
             c['distance'] = data['distance'] - c['distance']
 
-    # Return a json object
-    return jsonify({
+    # Return a json (or msgpack) object
+    body = encode({
         'comments': items,
-        'length': query.count(),
+        'length': length,
         'page': data['page'],
         'size': data['size'],
         'sort': data['sort'],
-        'filter': data['filter']
+        'filter': data['filter'],
+        **({'q': data['q'], 'next': next_cursor} if relevance is not None else {})
     })
+    comment_pages.put(cache_key, body)
+    return encoded_response(raw=body, cache_key=('comments', cache_key))
 
 
 @crops.route('reply', methods=['GET'])
+@read_only
 def load_comment_by_id():
     return jsonify(get_single_comment(request.args.get('id')))
 
@@ -288,7 +688,7 @@ def post_comment():
     log.info(data)
 
     # Update user object with the author's name and email
-    add_and_update_user(uid=data['user_id'], name=data['author'], email=data['email'])
+    renamed = add_and_update_user(uid=data['user_id'], name=data['author'], email=data['email'])
 
     # Add the comment to the database
     comment = Comments(
@@ -309,25 +709,26 @@ def post_comment():
         db.session.add(CommentTags(comment_id=comment.id, tag_id=tag_id))
 
     db.session.commit()
+    tag_index.add(comment.id, comment.landscape_id, data['tags'])
+
+    # Only the listings the comment appears in change, unless the author's name did too
+    scopes = [landscape_scope(comment.landscape_id), ANY_LANDSCAPE]
+    if reply_id is not None:
+        scopes.append(reply_scope(reply_id))
+    if renamed:
+        scopes.append(ALL)
+    comment_pages.invalidate(*scopes)
 
     return redirect(url_for('crops.get_comments', page=data['page'], size=data['size']), code=303)
 
 
 @crops.route('tags', methods=['GET'])
+@read_only
 def get_tags():
-    query = Tags.query.order_by(Tags.id)
-    groups = [i[0] for i in Tags.query.with_entities(Tags.group).distinct()]
-
-    return jsonify({
-        'tags': {
-            i.as_dict()['id']: {k: i.as_dict()[k] for k in i.as_dict() if k != "id"}
-            for i in query
-        },
-        'groups': {
-            g: [i['id'] for i in list(filter(lambda x: x['group'] == g, [i.as_dict() for i in query]))]
-            for g in groups
-        }
-    })
+    catalogue = tag_catalogue.refresh()
+
+    return encoded_response(lambda: {'tags': catalogue.tags, 'groups': catalogue.groups},
+                            cache_key=('tags', catalogue.version), max_age=app.config['HTTP_CACHE_MAX_AGE'])
 
 
 @crops.route('state', methods=['POST'])
@@ -341,23 +742,35 @@ def post_state():
         log.error("Bad request: missing data")
         return "Bad request: missing data", 400
 
-    log.info("{} - index {}".format(data['session_id'], data['index']))
+    # The index positions the state among its session's snapshots and deltas, so it must be a number
+    try:
+        index = int(data['index'])
+    except (TypeError, ValueError):
+        log.error("Bad request: index must be an integer")
+        return "Bad request: index must be an integer", 400
+
+    log.info("{} - index {}".format(data['session_id'], index))
 
     add_and_update_user(uid=data['user_id'])
 
     if 'state' in data.keys():
+        state, result_hash = store_outputs(data['state'], data.get('landscape_id'))
+        state, encoding, encoded = encode_stored_state(state, data['session_id'], index)
         State.create(
             session_id=data['session_id'],
-            index=data['index'],
+            index=index,
             user_id=data['user_id'],
             forked_from=data['forked_from'] if 'forked_from' in data.keys() else None,
-            state=json.dumps(data['state'])
+            state=state,
+            encoding=encoding,
+            data=encoded,
+            result_hash=result_hash
         )
 
     elif 'deleted' in data.keys():
         db.session.query(State).filter(and_(
             State.session_id == data['session_id'],
-            State.index == data['index'],
+            State.index == index,
             State.user_id == data['user_id']
         )).update({
             'deleted': data['deleted']
@@ -365,9 +778,66 @@ def post_state():
 
         db.session.commit()
 
+    # Comments show their session's history: refresh the listings of comments made in this session
+    commented = db.session.query(Comments.landscape_id, Comments.reply_id).filter(
+        Comments.session_id == data['session_id']).distinct().all()
+    if commented:
+        comment_pages.invalidate(ANY_LANDSCAPE, *[landscape_scope(l) for l, _ in commented],
+                                 *[reply_scope(r) for _, r in commented if r is not None])
+
     return Response("OK", mimetype='text/plain'), 200
 
 
+# Helper function: refer a state's outputs to the results table, shared by every state with the same inputs.
+# Only results the workers computed are shared: a row already stored under the state's input hash, or else the
+# result cache's entry. Outputs sent by the client are never stored there, as they'd stand for every session with
+# the same inputs. Returns the state to store, and the hash of its result (None if no computed result was found,
+# in which case the state keeps its own outputs).
+def store_outputs(state, landscape_id=None):
+    if not isinstance(state, dict) or 'inputs' not in state or input_errors(state['inputs']):
+        return state, None
+
+    landscape_id = landscape_id or state.get('landscape_id')
+    try:
+        landscape_id = int(landscape_id)
+    except (TypeError, ValueError):
+        return state, None
+
+    result_hash = input_hash(landscape_id, state['inputs'])
+    if db.session.query(Results.hash).filter(Results.hash == result_hash).first() is None:
+        outputs = cached_results(redis, landscape_id, [result_hash]).get(result_hash)
+        if not outputs:
+            return state, None
+        Results.store(result_hash, landscape_id, outputs)
+
+    return {k: v for k, v in state.items() if k != 'outputs'}, result_hash
+
+
+@crops.route('state', methods=['GET'])
+@read_only
+def get_state():
+    session_id = request.args.get('session_id')
+    if not session_id:
+        return "Bad request: missing session_id", 400
+
+    return encoded_response(session_history(session_id))
+
+
+# Helper function: a session's states, in order, with their stored outputs
+def session_history(session_id):
+    states = State.query.filter(State.session_id == session_id).order_by(State.index).all()
+    return {
+        'session_id': session_id,
+        'states': [{
+            'index': s.index,
+            'timestamp': s.timestamp.timestamp(),
+            'forked_from': s.forked_from,
+            'deleted': s.deleted,
+            'state': state
+        } for s, state in zip(states, load_states(states))]
+    }
+
+
 @crops.route('fork', methods=['POST'])
 def fork_session():
     data = request.get_json(force=True)
@@ -390,10 +860,46 @@ def fork_session():
             index=s.index,
             user_id=data['user_id'],
             forked_from=s.session_id,
-            state=s.state
+            state=s.state,
+            encoding=s.encoding,
+            data=s.data,
+            result_hash=s.result_hash
         )
 
-    return Response("OK", mimetype='text/plain'), 200
+    # The forked states share the originals' stored results, so they come back without rerunning the model
+    return encoded_response(session_history(data['new_session_id']))
+
+
+@crops.route('export/<table>', methods=['GET'])
+@read_only
+def export(table):
+    # Exports are only served when a token is configured, to clients presenting it
+    token = app.config['EXPORT_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(token)):
+        return Response("Unauthorized", status=401, mimetype='text/plain', headers={'WWW-Authenticate': 'Bearer'})
+
+    if table not in EXPORTS:
+        return "Not found: no {} export. Try {}".format(table, ', '.join(EXPORTS)), 404
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'parquet'):
+        return "Bad request: format must be ndjson or parquet", 400
+
+    unsupported = [f for f in ('since', 'after_id') if f in request.args and f not in FILTERS[table]]
+    if unsupported:
+        return "Bad request: the {} export doesn't support {}".format(table, ', '.join(unsupported)), 400
+
+    try:
+        since = parse_since(request.args.get('since'))
+        after_id = int(request.args['after_id']) if 'after_id' in request.args else None
+    except ValueError:
+        return "Bad request: since must be epoch seconds or an ISO 8601 date, and after_id an integer", 400
+
+    chunks = export_chunks(table, fmt, since=since, after_id=after_id, chunk=app.config['EXPORT_CHUNK_SIZE'])
+    return Response(stream_with_context(chunks), mimetype=MIMETYPE_PARQUET if fmt == 'parquet' else MIMETYPE_NDJSON,
+                    headers={'Content-Disposition': 'attachment; filename={}.{}'.format(table, fmt)})
 
 
 def generate_hash(string):
@@ -413,12 +919,14 @@ def add_and_update_user(uid, name=None, email=None):
         )
 
     elif name is not None and email is not None:
+        renamed = user.name != name or user.hash != generate_hash(email)
         user.name = name
         user.email = email
         user.hash = generate_hash(email)
         db.session.commit()
+        return renamed
 
-    return
+    return False
 
 
 #
@@ -457,6 +965,7 @@ def pre_calculate_bau():
         for i in range(n_runs):
             tasks.append(celery.send_task(task_name,
                                           kwargs={'landscape_id': landscape_id}, expires=timeout, retry_limit=5))
+        deadline = monotonic() + timeout
 
         ##
         # 2. Wait for the tasks to return (and print status to the console)
@@ -485,13 +994,20 @@ def pre_calculate_bau():
                 return idx
 
         #
-        # while-loop progress until all tasks complete
+        # while-loop progress until all tasks complete, or the timeout: bootstrap holds its lock meanwhile.
+        # Without a result, the next start tries again
         i = 0
-        while not reduce(lambda x, y: x and y, [t.ready() for t in tasks]):
+        while not reduce(lambda x, y: x and y, [t.ready() for t in tasks]) and monotonic() < deadline:
             i = progress(i, tasks)
 
         progress(i, tasks)
         sys.stdout.write("\n")
+        if not all(t.ready() for t in tasks):
+            log.error("BAU tasks for landscape_id {} did not finish within {}s. Skipping.".format(
+                landscape_id, timeout))
+            for t in tasks:
+                t.revoke()
+            continue
         log.info("Got results for landscape_id {}".format(landscape_id))
 
         ##
@@ -578,11 +1094,6 @@ if __name__ != '__main__':
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
 
-    # Run pre-startup tasks
-    #
-    with app.app_context():
-        pre_calculate_bau()
-
 '''
     Main. Does not run when running with WSGI
 '''
@@ -597,8 +1108,7 @@ if __name__ == "__main__":
 
     # Run pre-startup tasks
     #
-    with app.app_context():
-        pre_calculate_bau()
+    bootstrap(app, redis, pre_calculate_bau)
 
     app.run(**{
         'host': '0.0.0.0',
@@ -1,9 +1,22 @@
 import os
+import time
+from contextlib import contextmanager
 from celery import Celery
+from celery.exceptions import SoftTimeLimitExceeded, WorkerLostError
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, worker_shutdown, \
+    task_prerun, task_postrun, task_revoked, task_failure
 from celery.utils.log import get_task_logger
 from model.CropModel import CropModel, CropModelException
 from tasks.exceptions import TaskFailure
+from tasks.results import record_run, cache_result, input_hash
+from tasks.quarantine import quarantined, quarantine, begin_attempt, end_attempt, crash_attempt, worker_name
+from tasks.memory import MemoryWatchdog, recycle_limit_kb
+from tasks.forkserver import ForkServer, ForkedRunError, ForkedRunCrashed
+from tasks.schedule import record_setup, dequeue, unregister_worker, WorkerHeartbeat
+from tasks.warmup import warm_up
 import cppyy
+import redis
+from redis.exceptions import RedisError
 
 # Set up logger
 log = get_task_logger(__name__)
@@ -11,7 +24,215 @@ log = get_task_logger(__name__)
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
 
+CELERY_SERIALIZER = os.environ.get('CELERY_SERIALIZER', 'msgpack')
+
+# Memory each pool process may use (0: unlimited), and how much of it to keep free for the growth of a run.
+# A process past WORKER_MAX_RSS_MB - WORKER_RSS_HEADROOM_MB is replaced before it takes another task
+WORKER_MAX_RSS_MB = int(os.environ.get('WORKER_MAX_RSS_MB', 2048))
+WORKER_RSS_HEADROOM_MB = int(os.environ.get('WORKER_RSS_HEADROOM_MB', 512))
+# Also track the Python heap with tracemalloc (slows allocation down: for diagnosing leaks)
+WORKER_TRACEMALLOC = os.environ.get('WORKER_TRACEMALLOC', '0') == '1'
+
+# Prime each new pool process before it takes tasks. Warm-up runs before the process reports itself alive,
+# so the timeout for that must cover it. The ready file exists once every pool process is warmed up (for probes):
+# each process leaves a marker in WORKER_READY_FILE.d when it is, and the last one writes the file
+WORKER_WARM_UP = os.environ.get('WORKER_WARM_UP', '1') == '1'
+WORKER_PROC_ALIVE_TIMEOUT = float(os.environ.get('WORKER_PROC_ALIVE_TIMEOUT', 120))
+WORKER_READY_FILE = os.environ.get('WORKER_READY_FILE', '/tmp/celery-worker-ready')
+WORKER_READY_DIR = WORKER_READY_FILE + '.d'
+
+# Run each scenario in a fork of an initialised model held by the pool process (tasks/forkserver.py), rather than
+# on a model initialised for the task. Compare the two on the deployment with `python -m tasks.forkserver`
+WORKER_FORK_SERVER = os.environ.get('WORKER_FORK_SERVER', '0') == '1'
+
+# Hard time limits (seconds) after which a run's pool process is killed, and soft limits at which a run which is
+# still in Python is stopped with an exception. Batches of scenarios have their own
+TASK_TIME_LIMIT = int(os.environ.get('TASK_TIME_LIMIT', 300))
+TASK_SOFT_TIME_LIMIT = int(os.environ.get('TASK_SOFT_TIME_LIMIT', 240))
+BATCH_TASK_TIME_LIMIT = int(os.environ.get('BATCH_TASK_TIME_LIMIT', 1800))
+BATCH_TASK_SOFT_TIME_LIMIT = int(os.environ.get('BATCH_TASK_SOFT_TIME_LIMIT', 1740))
+
 celery_app = Celery('tasks', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+celery_app.conf.update(
+    task_serializer=CELERY_SERIALIZER,
+    result_serializer=CELERY_SERIALIZER,
+    accept_content=['msgpack', 'json'],
+    result_accept_content=['msgpack', 'json'],
+    # Priority 0 (the default) is served first: interactive runs overtake queued background work
+    broker_transport_options={'priority_steps': list(range(10)), 'sep': ':', 'queue_order_strategy': 'priority'},
+    worker_max_memory_per_child=recycle_limit_kb(WORKER_MAX_RSS_MB, WORKER_RSS_HEADROOM_MB),
+    worker_proc_alive_timeout=WORKER_PROC_ALIVE_TIMEOUT,
+    task_time_limit=TASK_TIME_LIMIT,
+    task_soft_time_limit=TASK_SOFT_TIME_LIMIT,
+)
+
+# Plain Redis client for the worker's own bookkeeping (run log etc.)
+redis_client = redis.Redis.from_url(os.environ.get('REDIS_URL', CELERY_RESULT_BACKEND))
+
+watchdog = MemoryWatchdog(redis_client, headroom_mb=WORKER_RSS_HEADROOM_MB, trace_python=WORKER_TRACEMALLOC)
+
+# This pool process's registration with the scheduler (tasks/schedule.py): started once the process is initialised
+heartbeat = None
+
+
+# Pool processes the worker starts: set in the main process before it forks them
+expected_processes = 1
+
+
+@worker_init.connect
+def expect_processes(sender=None, **kwargs):
+    global expected_processes
+    solo = 'solo' in str(getattr(sender, 'pool_cls', '')).lower()
+    expected_processes = 1 if solo else getattr(sender, 'concurrency', None) or 1
+
+    unmark_ready()
+    os.makedirs(WORKER_READY_DIR, exist_ok=True)
+    for name in os.listdir(WORKER_READY_DIR):
+        os.remove(os.path.join(WORKER_READY_DIR, name))
+
+
+##
+# Warm-up, then memory tracking from the warmed-up baseline. Losing the statistics mustn't fail a task
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    global heartbeat
+    if WORKER_WARM_UP:
+        warm_up()
+    if WORKER_FORK_SERVER:
+        prepare_templates()
+    mark_ready()
+
+    try:
+        watchdog.start()
+    except RedisError as e:
+        log.warning("Could not start memory tracking: {}".format(e))
+
+    heartbeat = WorkerHeartbeat(redis_client, worker_name())
+    try:
+        heartbeat.start()
+    except RedisError as e:
+        log.warning("Could not register worker process: {}".format(e))
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    if heartbeat is not None:
+        heartbeat.stop()
+    try:
+        unregister_worker(redis_client, worker_name())
+    except RedisError as e:
+        log.warning("Could not unregister worker process: {}".format(e))
+
+
+##
+# Mark this pool process warmed up, and write the ready file once every expected process is. Markers of processes
+# which have since been replaced don't count
+def mark_ready():
+    os.makedirs(WORKER_READY_DIR, exist_ok=True)
+    open(os.path.join(WORKER_READY_DIR, str(os.getpid())), 'w').close()
+
+    ready = 0
+    for name in os.listdir(WORKER_READY_DIR):
+        try:
+            os.kill(int(name), 0)
+            ready += 1
+        except ProcessLookupError:
+            try:
+                os.remove(os.path.join(WORKER_READY_DIR, name))
+            except FileNotFoundError:
+                pass
+        except (ValueError, PermissionError):
+            continue
+
+    if ready >= expected_processes:
+        with open(WORKER_READY_FILE, 'w') as file:
+            file.write(str(os.getppid()))
+
+
+@worker_shutdown.connect
+def unmark_ready(**kwargs):
+    try:
+        os.remove(WORKER_READY_FILE)
+    except FileNotFoundError:
+        pass
+
+
+@task_prerun.connect
+def before_task(task_id=None, task=None, **kwargs):
+    watchdog.before_task()
+    # The task is no longer waiting: take it off the server's ledger of queued work (tasks/schedule.py). The
+    # heartbeat may stall while the model runs, so the registration is kept until the task's time limit
+    try:
+        if task_id:
+            dequeue(redis_client, task_id)
+        if heartbeat is not None:
+            time_limit = task and ((task.request.timelimit or (None,))[0] or task.time_limit)
+            heartbeat.busy(time_limit or TASK_TIME_LIMIT)
+    except RedisError as e:
+        log.warning("Could not update the queue ledger: {}".format(e))
+
+
+# Tasks revoked or expired before they started never reach task_prerun: take them off the ledger here
+@task_revoked.connect
+def revoked_task(request=None, **kwargs):
+    try:
+        if request is not None and request.id:
+            dequeue(redis_client, request.id)
+    except RedisError as e:
+        log.warning("Could not update the queue ledger: {}".format(e))
+
+
+# A task whose pool process died (a fault no exception caught, or the OOM killer) never ended its attempts: the
+# main process marks them crashed, so the scenario counts towards quarantine at once (tasks/quarantine.py)
+@task_failure.connect
+def lost_worker(task_id=None, exception=None, kwargs=None, **extra):
+    if not isinstance(exception, WorkerLostError) or not kwargs or 'landscape_id' not in kwargs:
+        return
+    landscape_id = kwargs['landscape_id']
+    scenarios = kwargs.get('scenarios') or ([kwargs['data']] if 'data' in kwargs else [])
+    try:
+        for data in scenarios:
+            crash_attempt(redis_client, landscape_id, input_hash(landscape_id, data), task_id)
+    except RedisError as e:
+        log.warning("Could not record crashed attempt: {}".format(e))
+
+
+@task_postrun.connect
+def after_task(task=None, **kwargs):
+    if heartbeat is not None:
+        heartbeat.idle()
+    try:
+        warning = watchdog.after_task(task.name if task else None)
+        if warning:
+            log.warning(warning)
+    except RedisError as e:
+        log.warning("Could not record memory use: {}".format(e))
+
+
+# Errors the model library reports for bad inputs or state, and the fatal signals cppyy turns into exceptions
+# (CropModel sets signals as exceptions). After a signal, the process's memory can't be trusted
+NATIVE_ERRORS = (CropModelException,
+                 cppyy.gbl.std.exception,
+                 cppyy.gbl.std.invalid_argument)
+NATIVE_SIGNALS = tuple(getattr(cppyy.ll, name)
+                       for name in ('SegmentationViolation', 'BusError', 'IllegalInstruction', 'AbortSignal')
+                       if hasattr(cppyy.ll, name))
+
+
+# Failure state passed for a scenario in quarantine
+class Quarantined(TaskFailure):
+    pass
+
+
+# Failure state passed when a task reaches its soft time limit
+class TimedOut(TaskFailure):
+    pass
+
+
+# A native error or signal in a forked run, under a name the pool process can recognise
+class ModelFault(TaskFailure):
+    pass
+
 
 # We don't have an array length for nutritionaldelivery until run() is called.
 # Therefore, we need to define its length to return food group strings:
@@ -23,14 +244,48 @@ def initialise_model(self, landscape_id=101):
     self.update_state(state='PROGRESS', meta={'status': 'Initialising'})
 
     # Initialise crop model
+    start = time.perf_counter()
     model = CropModel()
     model.set_landscape_id(int(landscape_id))
     model.initialise_model()
+    note_setup(landscape_id, time.perf_counter() - start)
 
     self.update_state(state='PROGRESS', meta={'status': 'Running'})
     return model
 
 
+# Record a task's setup time, for estimating the cost of tasks. Losing it mustn't fail the task
+def note_setup(landscape_id, seconds):
+    try:
+        record_setup(redis_client, int(landscape_id), seconds)
+    except RedisError as e:
+        log.warning("Could not record setup time: {}".format(e))
+
+
+def template_model(landscape_id):
+    model = CropModel()
+    model.set_landscape_id(int(landscape_id))
+    model.initialise_model()
+    return model
+
+
+forkserver = ForkServer(template_model)
+
+
+##
+# Initialise the fork server's template models before the first task. A landscape which fails is retried
+# on its first run
+def prepare_templates():
+    for landscape_id in cppyy.gbl.getLandscapeIDs():
+        try:
+            forkserver.template(landscape_id)
+        except (CropModelException,
+                cppyy.gbl.std.exception,
+                cppyy.gbl.std.invalid_argument,
+                cppyy.gbl.std.filesystem.filesystem_error) as e:
+            log.error("Could not prepare the template model of landscape {}: {}".format(landscape_id, e))
+
+
 @celery_app.task(bind=True, track_started=True, name='celery_get_strings')
 def celery_get_strings(self, landscape_id):
     try:
@@ -62,7 +317,7 @@ def celery_model_get_bau(self, landscape_id):
     try:
         model = initialise_model(self, landscape_id)
         model.run_model()
-        result = append_grazing_props(model, model.to_dict())
+        result = model.result()
 
         log.info(result)
         return {'result': result}
@@ -75,32 +330,18 @@ def celery_model_get_bau(self, landscape_id):
         raise TaskFailure('Task Failed: ' + str(e))
 
 
+# Model runs aren't redelivered when their pool process dies (see run_guarded): a run which crashed a process would
+# only crash the next one too
 @celery_app.task(bind=True, track_started=True, name='celery_model_run')
 def celery_model_run(self, landscape_id, data):
+    check_quarantine(landscape_id, data)
     try:
-        model = initialise_model(self, landscape_id)
-
-        # Extract parameters from strings and mutate CropModel directly
-        max_crops = model.cropAreas.size()
-        for i in range(0, max_crops):
-            crop = model.get_crop_string(i).lower()
-            area = float(data[crop])
-            # log.info("{}={}".format(crop, area))
-            model.cropAreas[i] = area
-
-        max_livestock = model.livestockAreas.size()
-        for i in range(0, max_livestock):
-            livestock = model.get_livestock_string(i).lower()
-            area = float(data[livestock])
-            # log.info("{}={}".format(livestock, area))
-            model.livestockAreas[i] = area
-
-        try:
-            model.run_model()
-        except cppyy.gbl.std.length_error as err:
-            raise err
-
-        result = append_grazing_props(model, model.to_dict())
+        if WORKER_FORK_SERVER:
+            self.update_state(state='PROGRESS', meta={'status': 'Running'})
+            result = run_forked(self, landscape_id, data)
+        else:
+            model = initialise_model(self, landscape_id)
+            result, model = run_guarded(self, model, landscape_id, data)
 
         log.info(result)
 
@@ -114,16 +355,192 @@ def celery_model_run(self, landscape_id, data):
         raise TaskFailure('Task Failed: ' + str(e))
 
 
+# Run several scenarios on one initialised model. Results are returned in order; failed scenarios give None
+@celery_app.task(bind=True, track_started=True,
+                 time_limit=BATCH_TASK_TIME_LIMIT, soft_time_limit=BATCH_TASK_SOFT_TIME_LIMIT,
+                 name='celery_model_run_batch')
+def celery_model_run_batch(self, landscape_id, scenarios):
+    model = None
+    try:
+        if not WORKER_FORK_SERVER:
+            model = initialise_model(self, landscape_id)
+    except (CropModelException,
+            cppyy.gbl.std.exception,
+            cppyy.gbl.std.invalid_argument,
+            cppyy.gbl.std.filesystem.filesystem_error) as e:
+        log.error(e)
+        raise TaskFailure('Task Failed: ' + str(e))
+
+    results = []
+    for i, data in enumerate(scenarios):
+        self.update_state(state='PROGRESS', meta={'status': 'Running {} of {}'.format(i + 1, len(scenarios))})
+        try:
+            check_quarantine(landscape_id, data)
+            if model is None:
+                result = run_forked(self, landscape_id, data)
+            else:
+                result, model = run_guarded(self, model, landscape_id, data)
+            results.append(result)
+        except TimedOut as e:
+            # Out of time for the rest of the batch too
+            log.error(e)
+            results.extend([None] * (len(scenarios) - len(results)))
+            break
+        except (CropModelException,
+                cppyy.gbl.std.exception,
+                cppyy.gbl.std.invalid_argument,
+                TaskFailure,
+                KeyError,
+                ValueError) as e:
+            log.error(e)
+            results.append(None)
+            # Don't let a failed run leave its state behind for the next scenario
+            if model is not None:
+                model.initialise_model()
+
+    return {'result': results}
+
+
+##
+# Fail fast on a scenario in quarantine. Quarantine is best-effort: without Redis, scenarios just run
+def check_quarantine(landscape_id, data):
+    try:
+        reason = quarantined(redis_client, landscape_id, input_hash(landscape_id, data))
+    except RedisError as e:
+        log.warning("Could not check quarantine: {}".format(e))
+        return
+    if reason:
+        raise Quarantined('Scenario quarantined: ' + reason)
+
+
+##
+# Run a scenario, telling bad inputs from bad model state. Returns (result, model): the model to use from now on.
+#
+# A native error is retried once on a freshly initialised model. If that fails too the input is to blame, and is
+# quarantined. A fatal signal quarantines the input at once, and the pool process exits rather than run anything
+# else in memory the fault may have corrupted: the task fails, and the scenario fails fast in quarantine from then on.
+# Every run is registered as an attempt, so runs which never come back (killed at the hard time limit, or by a
+# fault no exception caught) count too.
+def run_guarded(self, model, landscape_id, data):
+    result_hash = input_hash(landscape_id, data)
+    with registered_attempt(self, landscape_id, result_hash):
+        try:
+            try:
+                return run_scenario(model, landscape_id, data), model
+            except NATIVE_ERRORS as e:
+                log.warning("Native error, retrying on a fresh model: {}".format(e))
+                model = initialise_model(self, landscape_id)
+                try:
+                    return run_scenario(model, landscape_id, data), model
+                except NATIVE_ERRORS as e:
+                    record_quarantine(landscape_id, result_hash, "{}: {}".format(type(e).__name__, e))
+                    raise
+        except NATIVE_SIGNALS as e:
+            record_quarantine(landscape_id, result_hash, "{}: {}".format(type(e).__name__, e))
+            log.critical("Fatal signal in the model library: replacing pool process {}".format(os.getpid()))
+            raise SystemExit(1)
+        except SoftTimeLimitExceeded:
+            raise TimedOut('Task Failed: time limit exceeded')
+
+
+##
+# Run a scenario in a fork of the landscape's template model (tasks/forkserver.py). Every run starts from the same
+# untouched template, so a native error or crash is down to the input, and quarantines it straight away; the pool
+# process carries on either way
+def run_forked(self, landscape_id, data):
+    result_hash = input_hash(landscape_id, data)
+    with registered_attempt(self, landscape_id, result_hash):
+        try:
+            (result, duration), overhead = forkserver.run(landscape_id, forked_scenario, data)
+        except ForkedRunCrashed as e:
+            record_quarantine(landscape_id, result_hash, str(e))
+            raise TaskFailure('Task Failed: ' + str(e))
+        except ForkedRunError as e:
+            if e.name != ModelFault.__name__:
+                raise TaskFailure('Task Failed: ' + str(e))
+            record_quarantine(landscape_id, result_hash, e.message)
+            raise TaskFailure('Task Failed: ' + e.message)
+        except SoftTimeLimitExceeded:
+            raise TimedOut('Task Failed: time limit exceeded')
+
+    log.debug("Forked run: {:.1f} ms run, {:.1f} ms fork overhead".format(duration * 1000, overhead * 1000))
+    note_setup(landscape_id, overhead)
+    record_scenario(landscape_id, data, result, duration)
+    return result
+
+
+# In the fork: run the scenario, naming native errors and signals for the pool process
+def forked_scenario(model, data):
+    try:
+        return compute_scenario(model, data)
+    except NATIVE_ERRORS + NATIVE_SIGNALS as e:
+        raise ModelFault("{}: {}".format(type(e).__name__, e))
+
+
+##
+# Register a run as an attempt for the duration of the block (see tasks/quarantine.py), under the task's ID and
+# with the deadline the task's hard time limit sets. Best-effort, like quarantine
+@contextmanager
+def registered_attempt(self, landscape_id, result_hash):
+    time_limit = (self.request.timelimit or (None,))[0] or self.time_limit or TASK_TIME_LIMIT
+    attempt = self.request.id
+    try:
+        if attempt is not None:
+            begin_attempt(redis_client, landscape_id, result_hash, attempt, time_limit)
+    except RedisError as e:
+        log.warning("Could not register attempt: {}".format(e))
+        attempt = None
+
+    try:
+        yield
+    finally:
+        if attempt is not None:
+            try:
+                end_attempt(redis_client, landscape_id, result_hash, attempt)
+            except RedisError as e:
+                log.warning("Could not end attempt: {}".format(e))
+
+
+def record_quarantine(landscape_id, result_hash, reason):
+    log.error("Quarantining scenario {} of landscape {}: {}".format(result_hash, landscape_id, reason))
+    try:
+        quarantine(redis_client, landscape_id, result_hash, reason)
+    except RedisError as e:
+        log.warning("Could not quarantine scenario: {}".format(e))
+
+
 ##
-# Append grazing props to model
-def append_grazing_props(model, result):
-    result['grazingProps'] = {
-        'lamb': model.get_upland_grazing_lamb_prop(),
-        'beef': model.get_upland_grazing_beef_prop()
-    }
+# Set a scenario's areas on an initialised model and run it. Results are logged and cached.
+def run_scenario(model, landscape_id, data):
+    result, duration = compute_scenario(model, data)
+    record_scenario(landscape_id, data, result, duration)
     return result
 
 
+# Set a scenario's areas on an initialised model and run it. Returns the result and the run's duration
+def compute_scenario(model, data):
+
+    model.set_areas(data)
+
+    start = time.perf_counter()
+    try:
+        model.run_model()
+    except cppyy.gbl.std.length_error as err:
+        raise err
+    duration = time.perf_counter() - start
+
+    return model.result(), duration
+
+
+# Log a run for the emulator, and cache it. Losing either mustn't fail the task
+def record_scenario(landscape_id, data, result, duration):
+    try:
+        record_run(redis_client, landscape_id, data, result, duration)
+        cache_result(redis_client, landscape_id, data, result)
+    except RedisError as e:
+        log.warning("Could not record run: {}".format(e))
+
+
 if __name__ == "__main__":
     log.info(celery_app.tasks)
     celery_app.start(argv=['celery', 'worker', '-l', 'info'])
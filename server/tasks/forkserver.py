@@ -0,0 +1,194 @@
+import ctypes
+import os
+import pickle
+import signal
+import time
+
+# Fork-server execution of model runs. Like tasks.results, this must not import cppyy: the model is supplied by
+# the caller.
+#
+# The pool process is the template: it holds an initialised model per landscape, and never runs one. Each run
+# happens in a fork of it, which shares the initialised model copy-on-write, changes only its own copy, sends
+# back the result through a pipe and exits. So no native state leaks from one run into the next, and a run which
+# faults (or corrupts the library's globals) costs only its fork, not the pool process and its warm-up.
+#
+# Forking costs a little per run, and saves reinitialising the model per run: see benchmark() to compare the two
+# modes on a deployment's own hardware.
+
+_PR_SET_PDEATHSIG = 1
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
+
+
+# A run raised an exception in its fork. name is the exception's type name: native exceptions don't pickle
+class ForkedRunError(Exception):
+
+    def __init__(self, name, message):
+        super().__init__("{}: {}".format(name, message))
+        self.name = name
+        self.message = message
+
+
+# A run's fork died without a result: killed by a signal, or exited
+class ForkedRunCrashed(Exception):
+
+    def __init__(self, status):
+        if os.WIFSIGNALED(status):
+            reason = "killed by {}".format(signal.Signals(os.WTERMSIG(status)).name)
+        else:
+            reason = "exited with status {}".format(os.waitstatus_to_exitcode(status))
+        super().__init__("Model run {}".format(reason))
+        self.status = status
+
+
+class ForkServer:
+
+    ##
+    # prepare(landscape_id) returns an initialised model: called once per landscape, in the template process
+    def __init__(self, prepare):
+        self.prepare = prepare
+        self.models = {}
+        self.pid = None
+
+    ##
+    # The landscape's template model, initialised on first use. Templates belong to the process which prepared
+    # them: a process forked from it (e.g. a replacement pool process) prepares its own
+    def template(self, landscape_id):
+        if self.pid != os.getpid():
+            self.models = {}
+            self.pid = os.getpid()
+        landscape_id = int(landscape_id)
+        if landscape_id not in self.models:
+            self.models[landscape_id] = self.prepare(landscape_id)
+        return self.models[landscape_id]
+
+    ##
+    # Call fn(model, *args) in a fork of the landscape's template model, and return what it returns (which must
+    # pickle) and the seconds the fork cost on top of the call itself.
+    #
+    # Raises ForkedRunError for an exception in fn, and ForkedRunCrashed if the fork died. An exception in this
+    # process while waiting (e.g. Celery's soft time limit) kills the fork.
+    def run(self, landscape_id, fn, *args):
+        model = self.template(landscape_id)
+
+        start = time.perf_counter()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _child(write_fd, model, fn, args)
+
+        os.close(write_fd)
+        status = None
+        try:
+            with os.fdopen(read_fd, 'rb') as pipe:
+                reply = pipe.read()
+            status = os.waitpid(pid, 0)[1]
+        finally:
+            if status is None:
+                _kill(pid)
+        elapsed = time.perf_counter() - start
+
+        if not reply:
+            raise ForkedRunCrashed(status)
+        outcome, value, duration = pickle.loads(reply)
+        if outcome == 'error':
+            raise ForkedRunError(*value)
+        return value, max(elapsed - duration, 0.0)
+
+
+##
+# The fork: run, reply and exit, without running any of the parent's exit handlers or flushing its buffers
+def _child(write_fd, model, fn, args):
+    code = 0
+    try:
+        # Don't outlive a template killed at the hard time limit
+        if _libc is not None:
+            _libc.prctl(_PR_SET_PDEATHSIG, signal.SIGKILL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        start = time.perf_counter()
+        try:
+            reply = ('ok', fn(model, *args))
+        except BaseException as e:
+            reply = ('error', (type(e).__name__, str(e)))
+        duration = time.perf_counter() - start
+        try:
+            reply = pickle.dumps(reply + (duration,), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            reply = pickle.dumps(('error', (type(e).__name__, str(e)), duration))
+
+        with os.fdopen(write_fd, 'wb') as pipe:
+            pipe.write(reply)
+    except BaseException:
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+
+##
+# Time runs of a scenario in-process, as tasks run without the fork server (initialise a model, then run it),
+# and in forks of an initialised template. Returns {mode: [seconds per run]}, plus the fork overhead per run.
+#
+# new_model(landscape_id) returns an initialised model; run(model) sets a scenario's areas and runs it
+def benchmark(new_model, run, landscape_id, runs=20):
+    timings = {'in_process': [], 'forked': [], 'fork_overhead': []}
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(new_model(landscape_id))
+        timings['in_process'].append(time.perf_counter() - start)
+
+    server = ForkServer(new_model)
+    server.template(landscape_id)
+    for _ in range(runs):
+        start = time.perf_counter()
+        _, overhead = server.run(landscape_id, run)
+        timings['forked'].append(time.perf_counter() - start)
+        timings['fork_overhead'].append(overhead)
+
+    return timings
+
+
+if __name__ == '__main__':
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(description="Compare in-process and fork-server model runs")
+    parser.add_argument('--landscape', type=int, action='append', help="Landscape ID (default: all)")
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    import cppyy
+    from model.CropModel import CropModel
+    from tasks.warmup import bau_areas
+
+    def new_model(landscape_id):
+        model = CropModel()
+        model.set_landscape_id(landscape_id)
+        model.initialise_model()
+        return model
+
+    def run_bau(model):
+        model.set_areas(bau_areas(model))
+        model.run_model()
+        return model.result()
+
+    for landscape_id in args.landscape or list(cppyy.gbl.getLandscapeIDs()):
+        timings = benchmark(new_model, run_bau, int(landscape_id), args.runs)
+        print("Landscape {} ({} runs each):".format(landscape_id, args.runs))
+        for mode, seconds in timings.items():
+            print("  {:14} median {:8.1f} ms, mean {:8.1f} ms".format(
+                mode, statistics.median(seconds) * 1000, statistics.mean(seconds) * 1000))
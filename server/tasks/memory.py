@@ -0,0 +1,125 @@
+import os
+import resource
+import socket
+import time
+import tracemalloc
+
+# Per-process memory tracking for the Celery workers. Like tasks.results, this must not import cppyy.
+#
+# Each worker process samples its resident set size (which includes everything the model library allocates)
+# around every task, and optionally the Python heap with tracemalloc, and keeps running totals in Redis.
+# Recycling itself is left to Celery's worker_max_memory_per_child, which replaces a pool process between
+# tasks once it has grown past the limit: see recycle_limit_kb().
+
+MEMORY_KEY = 'tasks:memory:{}:{}'
+MEMORY_KEY_TTL = 86400
+
+_PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+##
+# Current resident set size of this process, in kB
+def rss_kb():
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * _PAGE_KB
+
+
+##
+# Peak resident set size of this process so far, in kB (ru_maxrss is in kB on Linux)
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+##
+# Celery's worker_max_memory_per_child, in kB, for a worker which may use up to max_rss_mb per process.
+#
+# Processes are recycled once they pass the limit *after* a task, so the limit leaves headroom_mb for the
+# growth of the next task: a run is never started by a process which could be OOM-killed half way through.
+# Returns None (no recycling) if max_rss_mb is 0.
+def recycle_limit_kb(max_rss_mb, headroom_mb):
+    if max_rss_mb <= 0:
+        return None
+    return max(max_rss_mb - headroom_mb, 1) * 1024
+
+
+class MemoryWatchdog:
+
+    def __init__(self, client, headroom_mb=0, trace_python=False):
+        self.client = client
+        self.headroom_kb = headroom_mb * 1024
+        self.trace_python = trace_python
+        self.key = None
+        self.before = None
+        self.peak_before = None
+
+    ##
+    # Start tracking in a new pool process
+    def start(self):
+        self.key = MEMORY_KEY.format(socket.gethostname(), os.getpid())
+        if self.trace_python:
+            tracemalloc.start()
+
+        rss = rss_kb()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(self.key)
+        pipe.hset(self.key, mapping={'started': time.time(), 'rss_start_kb': rss, 'rss_kb': rss, 'tasks': 0})
+        pipe.expire(self.key, MEMORY_KEY_TTL)
+        pipe.execute()
+
+    def before_task(self):
+        self.before = rss_kb()
+        self.peak_before = peak_rss_kb()
+        if self.trace_python:
+            tracemalloc.reset_peak()
+
+    ##
+    # Record a task's growth. Returns a warning message if the task grew by more than the recycling headroom,
+    # i.e. a process closer to the limit could have been OOM-killed during it
+    def after_task(self, task_name):
+        if self.key is None or self.before is None:
+            return None
+
+        after = rss_kb()
+        growth = after - self.before
+        # Growth while the task ran, if it set a new high-water mark: transient allocations count too
+        peak_growth = max(peak_rss_kb() - max(self.peak_before, self.before), 0, growth)
+
+        stats = {'rss_kb': after, 'last_task': task_name, 'updated': time.time()}
+        if self.trace_python:
+            current, peak = tracemalloc.get_traced_memory()
+            stats.update({'python_kb': current // 1024, 'python_peak_kb': peak // 1024})
+
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(self.key, mapping=stats)
+        pipe.hincrby(self.key, 'tasks', 1)
+        pipe.hincrby(self.key, 'growth_total_kb', growth)
+        pipe.expire(self.key, MEMORY_KEY_TTL)
+        pipe.execute()
+        self.update_max('max_growth_kb', growth)
+        self.update_max('max_peak_growth_kb', peak_growth)
+
+        self.before = None
+        if self.headroom_kb and peak_growth > self.headroom_kb:
+            return "Task {} grew by {} kB, more than the {} kB recycling headroom".format(
+                task_name, peak_growth, self.headroom_kb)
+        return None
+
+    def update_max(self, field, value):
+        current = self.client.hget(self.key, field)
+        if current is None or value > int(current):
+            self.client.hset(self.key, field, value)
+
+
+##
+# Memory statistics of every worker process which has reported in the last day, by hostname:pid
+def worker_memory(client):
+    workers = {}
+    for key in client.scan_iter(MEMORY_KEY.format('*', '*')):
+        key = key.decode() if isinstance(key, bytes) else key
+        stats = {(k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+                 for k, v in client.hgetall(key).items()}
+        tasks = int(stats.get('tasks', 0))
+        if tasks:
+            stats['mean_growth_kb'] = int(stats.get('growth_total_kb', 0)) / tasks
+        workers[key.split(':', 2)[2]] = stats
+    return workers
@@ -0,0 +1,114 @@
+import json
+import os
+import socket
+import time
+
+# Quarantine of scenarios which crash or hang the model library. Shared between the Celery workers and the Flask
+# server, so like tasks.results this must not import cppyy or Flask.
+#
+# A scenario is quarantined, by landscape and input hash (tasks.results.input_hash), when
+#  - a worker reproduces a native fault with it on a freshly initialised model (quarantine()), or
+#  - QUARANTINE_AFTER of its runs started and never finished. Every run is registered as an attempt
+#    (begin_attempt()), with the deadline its task's time limit sets, and removed when it ends (end_attempt()).
+#    An attempt whose pool process died is marked crashed by the worker's main process (crash_attempt()); any
+#    other attempt past its deadline never came back either (killed at the hard time limit, or its host lost).
+# Model tasks aren't redelivered when their process dies, so a crashing scenario can't loop through the workers.
+# Quarantine is short-lived: both records expire after QUARANTINE_TTL, so a fixed model gets another chance.
+
+QUARANTINE_KEY = 'tasks:quarantine:{}:{}'
+ATTEMPTS_KEY = 'tasks:attempts:{}:{}'
+
+QUARANTINE_TTL = int(os.environ.get('QUARANTINE_TTL', 900))
+QUARANTINE_AFTER = int(os.environ.get('QUARANTINE_AFTER', 2))
+# Seconds past an attempt's deadline before it counts as a run which never came back
+QUARANTINE_STALE_GRACE = float(os.environ.get('QUARANTINE_STALE_GRACE', 60))
+
+
+# Raised by the server for a scenario in quarantine, rather than submitting it
+class QuarantinedError(Exception):
+    pass
+
+
+def keys(landscape_id, result_hash):
+    return QUARANTINE_KEY.format(landscape_id, result_hash), ATTEMPTS_KEY.format(landscape_id, result_hash)
+
+
+##
+# Why a scenario is quarantined, or None, from the values of its keys(): a GET and an HGETALL. Split out so that
+# async clients (gateway.py) can read the keys themselves
+def reason_from(quarantined, attempts, now=None):
+    if quarantined:
+        return json.loads(quarantined)['reason']
+
+    now = time.time() if now is None else now
+    stale = [a for a in (attempts or {}).values() if now > json.loads(a)[0] + QUARANTINE_STALE_GRACE]
+    if len(stale) >= QUARANTINE_AFTER:
+        return "{} runs crashed or timed out".format(len(stale))
+    return None
+
+
+def quarantined(client, landscape_id, result_hash):
+    return quarantined_many(client, landscape_id, [result_hash]).get(result_hash)
+
+
+##
+# {hash: reason} of the quarantined scenarios among hashes, from one round trip
+def quarantined_many(client, landscape_id, hashes):
+    hashes = list(hashes)
+    pipe = client.pipeline(transaction=False)
+    for h in hashes:
+        quarantine_key, attempts_key = keys(landscape_id, h)
+        pipe.get(quarantine_key)
+        pipe.hgetall(attempts_key)
+    values = pipe.execute()
+
+    now = time.time()
+    reasons = {h: reason_from(values[2 * i], values[2 * i + 1], now) for i, h in enumerate(hashes)}
+    return {h: reason for h, reason in reasons.items() if reason}
+
+
+def quarantine(client, landscape_id, result_hash, reason):
+    client.setex(keys(landscape_id, result_hash)[0], QUARANTINE_TTL,
+                 json.dumps({'reason': reason, 'timestamp': time.time()}))
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+##
+# Register a run, by this process, which its task's time limit will have ended within time_limit seconds.
+# attempt_id is the task's ID, so that the worker's main process can find the attempt if the run kills its process
+def begin_attempt(client, landscape_id, result_hash, attempt_id, time_limit):
+    attempts_key = keys(landscape_id, result_hash)[1]
+    pipe = client.pipeline(transaction=False)
+    pipe.hset(attempts_key, attempt_id, json.dumps([time.time() + time_limit, worker_name()]))
+    pipe.expire(attempts_key, int(QUARANTINE_TTL + time_limit + QUARANTINE_STALE_GRACE))
+    pipe.execute()
+
+
+def end_attempt(client, landscape_id, result_hash, attempt_id):
+    client.hdel(keys(landscape_id, result_hash)[1], attempt_id)
+
+
+##
+# Mark an attempt whose process died as crashed: past its deadline at once, rather than at the end of its time
+# limit. Attempts which already ended are left alone
+def crash_attempt(client, landscape_id, result_hash, attempt_id):
+    attempts_key = keys(landscape_id, result_hash)[1]
+    attempt = client.hget(attempts_key, attempt_id)
+    if attempt is not None:
+        client.hset(attempts_key, attempt_id, json.dumps([0, json.loads(attempt)[1]]))
+
+
+##
+# Every quarantined scenario, as {'landscape_id:hash': {'reason', 'timestamp', 'ttl'}}. Scenarios quarantined
+# for unfinished attempts alone are found by quarantined(), not listed here
+def quarantine_list(client):
+    listed = {}
+    for key in client.scan_iter(QUARANTINE_KEY.format('*', '*')):
+        key = key.decode() if isinstance(key, bytes) else key
+        value = client.get(key)
+        if value:
+            listed[key.split(':', 2)[2]] = {**json.loads(value), 'ttl': client.ttl(key)}
+    return listed
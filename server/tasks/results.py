@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import time
+
+import msgpack
+
+# Shared between the Celery workers and the Flask server, so this module must not import cppyy or Flask.
+# Functions take a redis client: workers pass their own, Flask passes the FlaskRedis instance.
+
+# Every completed model run is logged here, per landscape, for training the emulator
+RUN_LOG_KEY = 'tasks:runs:{}'
+RUN_COUNT_KEY = 'tasks:runs:{}:total'
+RUN_LOG_SIZE = int(os.environ.get('RUN_LOG_SIZE', 5000))
+
+# Results of completed runs, by landscape and input hash, so that repeated scenarios needn't be rerun
+RESULT_KEY = 'tasks:result:{}:{}'
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 7 * 86400))
+# Hit and miss counts of result cache lookups
+RESULT_STATS_KEY = 'tasks:result:stats'
+
+
+##
+# Reduce model inputs to a flat {name: float} dict of crop and livestock areas. Accepts both the flat
+# /model POST body ({'landscape_id': 101, 'maize': 123.0, ...}) and the nested 'inputs' of a stored
+# session state ({'crops': {'maize': {'value': 123.0, ...}}, 'livestock': {...}}). Anything else (groups or
+# items which aren't objects, items without a value, values which aren't numbers) is skipped: see input_errors
+def canonical_inputs(data):
+    if not isinstance(data, dict):
+        return {}
+    if 'crops' in data or 'livestock' in data:
+        data = {name: item['value']
+                for group in (data.get('crops'), data.get('livestock')) if isinstance(group, dict)
+                for name, item in group.items() if isinstance(item, dict) and 'value' in item}
+
+    inputs = {}
+    for name, value in data.items():
+        if name == 'landscape_id':
+            continue
+        try:
+            inputs[name] = float(value)
+        except (TypeError, ValueError):
+            continue
+    return inputs
+
+
+##
+# What's wrong with model inputs which canonical_inputs would have to skip parts of, or None if nothing is
+def input_errors(data):
+    if not isinstance(data, dict):
+        return "inputs must be an object of crop and livestock areas"
+    for group in ('crops', 'livestock'):
+        if group not in data:
+            continue
+        if not isinstance(data[group], dict):
+            return "{} must be an object".format(group)
+        for name, item in data[group].items():
+            if not isinstance(item, dict) or 'value' not in item:
+                return "{}.{} must be an object with a value".format(group, name)
+    return None
+
+
+##
+# Stable hash identifying a scenario: the landscape plus its canonical inputs
+def input_hash(landscape_id, inputs):
+    key = json.dumps([int(landscape_id), sorted(canonical_inputs(inputs).items())], separators=(',', ':'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+##
+# Append a completed run to the landscape's run log, keeping only the most recent RUN_LOG_SIZE runs
+def record_run(client, landscape_id, inputs, result, duration):
+    entry = msgpack.packb({
+        'inputs': canonical_inputs(inputs),
+        'result': result,
+        'duration': duration,
+        'timestamp': time.time()
+    }, use_bin_type=True)
+
+    pipe = client.pipeline(transaction=False)
+    pipe.lpush(RUN_LOG_KEY.format(landscape_id), entry)
+    pipe.ltrim(RUN_LOG_KEY.format(landscape_id), 0, RUN_LOG_SIZE - 1)
+    pipe.incr(RUN_COUNT_KEY.format(landscape_id))
+    pipe.execute()
+
+
+##
+# Total number of runs ever logged for the landscape (the log itself only holds the most recent)
+def count_runs(client, landscape_id):
+    return int(client.get(RUN_COUNT_KEY.format(landscape_id)) or 0)
+
+
+##
+# Most recent runs from the landscape's run log, newest first
+def load_runs(client, landscape_id, limit=RUN_LOG_SIZE):
+    entries = client.lrange(RUN_LOG_KEY.format(landscape_id), 0, limit - 1)
+    return [msgpack.unpackb(e, raw=False) for e in entries]
+
+
+##
+# Store a run's result in the result cache
+def cache_result(client, landscape_id, inputs, result):
+    client.setex(RESULT_KEY.format(landscape_id, input_hash(landscape_id, inputs)), RESULT_CACHE_TTL,
+                 msgpack.packb(result, use_bin_type=True))
+
+
+##
+# Look up cached results by input hash. Returns {hash: result} for the hashes which were found.
+def cached_results(client, landscape_id, hashes):
+    hashes = list(hashes)
+    if not hashes:
+        return {}
+    values = client.mget([RESULT_KEY.format(landscape_id, h) for h in hashes])
+    found = {h: msgpack.unpackb(v, raw=False) for h, v in zip(hashes, values) if v is not None}
+
+    pipe = client.pipeline(transaction=False)
+    pipe.hincrby(RESULT_STATS_KEY, 'hits', len(found))
+    pipe.hincrby(RESULT_STATS_KEY, 'misses', len(hashes) - len(found))
+    pipe.execute()
+    return found
+
+
+##
+# Hit and miss counts of all result cache lookups so far
+def result_cache_stats(client):
+    stats = client.hgetall(RESULT_STATS_KEY)
+    return {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in stats.items()}
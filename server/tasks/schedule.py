@@ -0,0 +1,218 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# Cost-aware scheduling of model tasks. Shared between the Celery workers and the Flask server, so like
+# tasks.results this must not import cppyy or Flask.
+#
+# The server estimates each task's run time (emulator.CostModel, trained on the run log's durations, plus the
+# landscape's per-task setup cost recorded here by the workers) and sends it at a priority by that estimate:
+# shortest expected job first. It also keeps a ledger of queued tasks and their estimates, which the workers clear
+# as they start them, so that it can tell clients how much work is ahead of a task.
+
+QUEUED_KEY = 'tasks:schedule:queued'
+SETUP_KEY = 'tasks:schedule:setup'
+WORKERS_KEY = 'tasks:schedule:workers'
+
+log = logging.getLogger(__name__)
+
+# Ledger entries of tasks which never started (lost with the broker) are dropped after this long, or after the
+# task's own expiry
+QUEUED_MAX_AGE = int(os.environ.get('SCHEDULE_QUEUED_MAX_AGE', 3600))
+# Worker processes report every WORKER_HEARTBEAT seconds (see WorkerHeartbeat), and those which haven't for
+# this long (a few missed beats) are assumed gone
+WORKER_HEARTBEAT = int(os.environ.get('SCHEDULE_WORKER_HEARTBEAT', 30))
+WORKER_STALE_AFTER = int(os.environ.get('SCHEDULE_WORKER_STALE_AFTER', 3 * WORKER_HEARTBEAT))
+# Each process reuses its last read of the ledger for this long, so that polls don't each read and decode it
+ESTIMATE_MAX_AGE = float(os.environ.get('SCHEDULE_ESTIMATE_MAX_AGE', 1.0))
+# Weight of the latest sample in the moving average of setup costs
+SETUP_SMOOTHING = 0.2
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+##
+# Fold a task's setup time (initialising the model, or the fork server's per-run overhead) into the landscape's
+# moving average. Concurrent updates may lose a sample, which an average can afford
+def record_setup(client, landscape_id, seconds):
+    current = client.hget(SETUP_KEY, landscape_id)
+    if current is not None:
+        seconds = (1 - SETUP_SMOOTHING) * float(current) + SETUP_SMOOTHING * seconds
+    client.hset(SETUP_KEY, landscape_id, seconds)
+
+
+##
+# Average setup time per task, by landscape ID
+def setup_costs(client):
+    return {int(_text(k)): float(v) for k, v in client.hgetall(SETUP_KEY).items()}
+
+
+##
+# Priority for a task expected to take `seconds`: 0 (served first) below bounds[0], 1 below bounds[1], and so on.
+# Unknown costs get priority 0, as every task did before costs were estimated
+def priority_for(seconds, bounds):
+    if seconds is None:
+        return 0
+    return bisect.bisect_right(bounds, seconds)
+
+
+##
+# Note a task on the ledger, and on this process's last read of it, so that its wait can be given at once
+def enqueue(client, task_id, priority, seconds, expires=None):
+    enqueued = time.time()
+    client.hset(QUEUED_KEY, task_id, json.dumps([priority, seconds, enqueued, expires or QUEUED_MAX_AGE]))
+    if QueueEstimate.latest is not None:
+        QueueEstimate.latest.add(task_id, priority, seconds, enqueued)
+
+
+def dequeue(client, task_id):
+    client.hdel(QUEUED_KEY, task_id)
+
+
+##
+# Record a worker process as seen at `seen` (by default, now). A time in the future keeps it counted until then
+def register_worker(client, worker, seen=None):
+    client.hset(WORKERS_KEY, worker, time.time() if seen is None else seen)
+
+
+def unregister_worker(client, worker):
+    client.hdel(WORKERS_KEY, worker)
+
+
+##
+# Keeps a worker process's registration fresh from a background thread, so that processes which have gone (killed,
+# or their host lost) drop out of the count within WORKER_STALE_AFTER.
+#
+# A model run can hold the GIL, and so stall the thread, for as long as its time limit: busy() covers the run by
+# registering the process as seen until the run's time limit is up, and idle() ends that
+class WorkerHeartbeat:
+
+    def __init__(self, client, worker, interval=WORKER_HEARTBEAT):
+        self.client = client
+        self.worker = worker
+        self.interval = interval
+        self.busy_until = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.beat()
+        self.thread = threading.Thread(target=self._run, name='worker-heartbeat', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def beat(self):
+        register_worker(self.client, self.worker, max(time.time(), self.busy_until))
+
+    def busy(self, seconds):
+        self.busy_until = time.time() + seconds
+        self.beat()
+
+    def idle(self):
+        self.busy_until = 0.0
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                log.warning("Could not refresh the worker registration: {}".format(e))
+
+
+##
+# Expected waits from one snapshot of the ledger and worker list: the estimated work queued ahead of a task,
+# spread over the worker processes. Interactive queues are served by priority, then in order of arrival.
+#
+# Built from the values of HGETALL QUEUED_KEY and HGETALL WORKERS_KEY, so that async clients (gateway.py) can
+# read those themselves; QueueEstimate.load() reads them with a sync client. Either way, a snapshot is reused
+# for ESTIMATE_MAX_AGE (see cached()), and the tasks are indexed in the order they'll be served, so each wait is
+# a lookup rather than a pass over the ledger
+class QueueEstimate:
+
+    # This process's most recent snapshot
+    latest = None
+
+    def __init__(self, queued, workers, now=None):
+        now = time.time() if now is None else now
+        self.loaded = time.monotonic()
+        self.queued = {}
+        self.stale = []
+        for task_id, entry in (queued or {}).items():
+            priority, seconds, enqueued, max_age = json.loads(entry)
+            if now - enqueued > max_age:
+                self.stale.append(task_id)
+            else:
+                self.queued[_text(task_id)] = (priority, enqueued, seconds)
+        self.workers = max(sum(1 for t in (workers or {}).values() if now - float(t) <= WORKER_STALE_AFTER), 1)
+        self.lock = threading.Lock()
+        self.order = None
+
+    ##
+    # This process's latest snapshot, if it was read less than ESTIMATE_MAX_AGE ago
+    @classmethod
+    def cached(cls):
+        estimate = cls.latest
+        if estimate is not None and time.monotonic() - estimate.loaded < ESTIMATE_MAX_AGE:
+            return estimate
+        return None
+
+    @classmethod
+    def load(cls, client):
+        estimate = cls.cached()
+        if estimate is not None:
+            return estimate
+
+        pipe = client.pipeline(transaction=False)
+        pipe.hgetall(QUEUED_KEY)
+        pipe.hgetall(WORKERS_KEY)
+        estimate = cls.latest = cls(*pipe.execute())
+        if estimate.stale:
+            client.hdel(QUEUED_KEY, *estimate.stale)
+        return estimate
+
+    ##
+    # A task queued since the snapshot was read
+    def add(self, task_id, priority, seconds, enqueued):
+        with self.lock:
+            self.queued[task_id] = (priority, enqueued, seconds)
+            self.order = None
+
+    ##
+    # The tasks in the order they'll be served, their positions, and the total seconds ahead of each position
+    def index(self):
+        with self.lock:
+            if self.order is None:
+                entries = sorted(self.queued.items(), key=lambda item: item[1][:2])
+                ahead = [0.0]
+                for _, (_, _, seconds) in entries:
+                    ahead.append(ahead[-1] + seconds)
+                self.order = ([entry[:2] for _, entry in entries],
+                              {task_id: i for i, (task_id, _) in enumerate(entries)},
+                              ahead)
+            return self.order
+
+    ##
+    # Seconds until a queued task is expected to start, or None if it isn't in the ledger (started, finished,
+    # or never estimated)
+    def wait_for(self, task_id):
+        _, positions, ahead = self.index()
+        position = positions.get(task_id)
+        if position is None:
+            return None
+        return round(ahead[position] / self.workers, 1)
+
+    ##
+    # Seconds until a task sent now at `priority` is expected to start
+    def wait_at(self, priority):
+        keys, _, ahead = self.index()
+        return round(ahead[bisect.bisect_right(keys, (priority, float('inf')))] / self.workers, 1)
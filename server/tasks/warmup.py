@@ -0,0 +1,83 @@
+import os
+import time
+
+import cppyy
+from celery.utils.log import get_task_logger
+from model.CropModel import CropModel, CropModelException
+
+log = get_task_logger(__name__)
+
+# Where the model library reads its inputs from: the Docker image copies them to /FieldStats and /Weather
+MODEL_DATA_DIRS = os.environ.get('MODEL_DATA_DIRS', '/FieldStats:/Weather').split(':')
+
+_READ_CHUNK = 1 << 20
+
+
+##
+# Read every file under the model's data directories once, so the first runs find them in the page cache
+def touch_data_files(directories=MODEL_DATA_DIRS):
+    files, size = 0, 0
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                try:
+                    with open(os.path.join(root, name), 'rb') as file:
+                        while True:
+                            chunk = file.read(_READ_CHUNK)
+                            if not chunk:
+                                break
+                            size += len(chunk)
+                    files += 1
+                except OSError as e:
+                    log.warning("Warm-up could not read {}: {}".format(name, e))
+    return files, size
+
+
+##
+# Instantiate the cppyy templates and exception classes the tasks use, so that cling compiles them now
+def instantiate_templates():
+    cppyy.gbl.std.vector['double']()
+    cppyy.gbl.std.vector['int']()
+    for exception in (cppyy.gbl.std.exception,
+                      cppyy.gbl.std.invalid_argument,
+                      cppyy.gbl.std.length_error,
+                      cppyy.gbl.std.filesystem.filesystem_error):
+        exception.__name__
+
+
+##
+# The landscape's own initial areas, as set_areas() takes them: a realistic scenario, and valid for every landscape.
+# Needs an initialised model
+def bau_areas(model):
+    return {model.get_crop_string(i).lower(): model.cropAreas[i] for i in range(model.cropAreas.size())} | \
+        {model.get_livestock_string(i).lower(): model.livestockAreas[i] for i in range(model.livestockAreas.size())}
+
+
+##
+# Prime a fresh worker process before it takes its first task: touch the data files, instantiate templates,
+# and initialise and run every landscape once (which also JIT-compiles the shim's code paths).
+# A landscape which fails is logged and skipped, so that the worker still starts.
+def warm_up():
+    start = time.perf_counter()
+
+    files, size = touch_data_files()
+    log.info("Warm-up: read {} data files ({:.1f} MB)".format(files, size / 1e6))
+
+    instantiate_templates()
+
+    landscape_ids = list(cppyy.gbl.getLandscapeIDs())
+    for landscape_id in landscape_ids:
+        try:
+            model = CropModel()
+            model.set_landscape_id(int(landscape_id))
+            model.initialise_model()
+            model.set_areas(bau_areas(model))
+            model.run_model()
+            model.result()
+        except (CropModelException,
+                cppyy.gbl.std.exception,
+                cppyy.gbl.std.invalid_argument,
+                cppyy.gbl.std.filesystem.filesystem_error) as e:
+            log.error("Warm-up of landscape {} failed: {}".format(landscape_id, e))
+
+    log.info("Warm-up of landscapes {} done in {:.1f}s".format(landscape_ids, time.perf_counter() - start))